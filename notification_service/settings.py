@@ -1,6 +1,7 @@
 # flake8: noqa
 import os
 from pathlib import Path
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -121,6 +122,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_PAGINATION_CLASS': 'notifications.pagination.IdCursorPagination',
 }
 
 
@@ -136,42 +138,196 @@ SPECTACULAR_SETTINGS = {
 BROKER_TRANSPORT = 'redis'
 CELERY_BROKER_URL = 'redis://redis:6379/0'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
+# dispatch - запуск рассылок, delivery - отправка сообщений,
+# reporting - отчеты. Отправка обслуживается отдельным воркером, запуск
+# рассылок и отчеты - общим.
+CELERY_TASK_ROUTES = {
+    'notifications.tasks.send_messages_for_mailing': {'queue': 'dispatch'},
+    'notifications.tasks.dispatch_mailing_wave': {'queue': 'dispatch'},
+    'notifications.tasks.check_mailing_completion': {'queue': 'dispatch'},
+    'notifications.tasks.release_parked_messages': {'queue': 'dispatch'},
+    'notifications.tasks.wait_until': {'queue': 'dispatch'},
+    'notifications.tasks.reschedule_deferred_messages': {
+        'queue': 'dispatch'
+    },
+    'notifications.tasks.send_message': {'queue': 'delivery'},
+    'notifications.tasks.send_message_batch': {'queue': 'delivery'},
+    'notifications.tasks.send_mail_statistic': {'queue': 'reporting'},
+    'notifications.tasks.archive_messages': {'queue': 'reporting'},
+    'notifications.tasks.delete_mailing': {'queue': 'reporting'},
+    'notifications.tasks.delete_client': {'queue': 'reporting'},
+}
+# Задачи с eta не подтверждаются до выполнения и по истечении
+# visibility_timeout передаются другому воркеру, поэтому он должен быть
+# больше самой долгой отсрочки задачи с запасом на отставание очереди.
+# Отсрочки дольше CELERY_TASK_MAX_ETA секунд продлеваются промежуточными
+# задачами. Приоритет 0 - наивысший, он действует внутри очереди.
+# Очереди воркера опрашиваются по кругу: при строгом порядке очередей
+# отчеты не выполняются, пока в dispatch есть задачи.
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'round_robin',
+    'visibility_timeout': int(os.getenv('CELERY_VISIBILITY_TIMEOUT', 43200)),
+}
+CELERY_TASK_MAX_ETA = int(os.getenv('CELERY_TASK_MAX_ETA', 3600))
+if CELERY_BROKER_TRANSPORT_OPTIONS['visibility_timeout'] <= (
+    2 * CELERY_TASK_MAX_ETA
+):
+    raise ImproperlyConfigured(
+        'CELERY_VISIBILITY_TIMEOUT должен быть больше двух '
+        'CELERY_TASK_MAX_ETA'
+    )
+# Воркер не резервирует лишние задачи, иначе приоритетные задачи ждут
+# уже полученные низкоприоритетные
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+CELERY_TASK_ACKS_LATE = True
+
+MAILING_DISPATCH_CHUNK_SIZE = int(
+    os.getenv('MAILING_DISPATCH_CHUNK_SIZE', 1000)
+)
+# single - одна задача на сообщение, batch - пачка сообщений на задачу
+MAILING_DELIVERY_MODE = os.getenv('MAILING_DELIVERY_MODE', 'single')
+MAILING_BATCH_SIZE = int(os.getenv('MAILING_BATCH_SIZE', 100))
+# Период проверки завершения рассылки, секунды
+MAILING_COMPLETION_CHECK_INTERVAL = int(
+    os.getenv('MAILING_COMPLETION_CHECK_INTERVAL', 600)
+)
+
+# Воркеры кешируют состояние рассылки на MAILING_STATE_CACHE_TTL секунд,
+# в Redis оно хранится MAILING_STATE_TTL секунд
+MAILING_STATE_CACHE_TTL = float(os.getenv('MAILING_STATE_CACHE_TTL', 1))
+MAILING_STATE_TTL = int(os.getenv('MAILING_STATE_TTL', 86400))
+# Задачи отправки берут рассылку из кеша процесса на MAILING_CACHE_SIZE
+# рассылок, снимок перечитывается не реже раза в MAILING_CACHE_TTL секунд
+MAILING_CACHE_SIZE = int(os.getenv('MAILING_CACHE_SIZE', 256))
+MAILING_CACHE_TTL = float(os.getenv('MAILING_CACHE_TTL', 300))
+
+CLIENT_IMPORT_CHUNK_SIZE = int(os.getenv('CLIENT_IMPORT_CHUNK_SIZE', 5000))
+
+SEND_API_URL = os.getenv('SEND_API_URL', 'https://probe.fbrq.cloud/v1/send/')
+SEND_API_TIMEOUT = float(os.getenv('SEND_API_TIMEOUT', 10))
+SEND_API_POOL_SIZE = int(os.getenv('SEND_API_POOL_SIZE', 10))
+# sync - последовательные запросы, async - конкурентные запросы в asyncio
+SEND_DELIVERY_BACKEND = os.getenv('SEND_DELIVERY_BACKEND', 'sync')
+SEND_API_CONCURRENCY = int(os.getenv('SEND_API_CONCURRENCY', 100))
+SEND_RESULTS_BATCH_SIZE = int(os.getenv('SEND_RESULTS_BATCH_SIZE', 100))
+# Задержка повторной отправки растет от базовой до максимальной, секунды
+SEND_RETRY_BASE_DELAY = int(os.getenv('SEND_RETRY_BASE_DELAY', 60))
+SEND_RETRY_MAX_DELAY = int(os.getenv('SEND_RETRY_MAX_DELAY', 3600))
+# Раз в SEND_RETRY_SWEEP_INTERVAL секунд в очередь заново ставятся
+# отложенные сообщения и сообщения прерванных пачек, время попытки
+# которых прошло больше чем SEND_RETRY_SWEEP_DELAY секунд назад. Задержка
+# должна превышать отставание очереди delivery и время отправки пачки,
+# иначе сообщение получит вторую задачу.
+SEND_RETRY_SWEEP_INTERVAL = float(
+    os.getenv('SEND_RETRY_SWEEP_INTERVAL', 300)
+)
+SEND_RETRY_SWEEP_DELAY = float(os.getenv('SEND_RETRY_SWEEP_DELAY', 600))
+# Статусы сообщений записываются пачками по SEND_STATUS_BUFFER_SIZE, но не
+# позже чем через SEND_STATUS_FLUSH_INTERVAL секунд. 1 отключает буфер.
+SEND_STATUS_BUFFER_SIZE = int(os.getenv('SEND_STATUS_BUFFER_SIZE', 100))
+SEND_STATUS_FLUSH_INTERVAL = float(
+    os.getenv('SEND_STATUS_FLUSH_INTERVAL', 1)
+)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://redis:6379/0')
+
+# Ограничение частоты запросов к API отправки, запросов в секунду.
+# 0 отключает ограничение.
+SEND_RATE_LIMIT = float(os.getenv('SEND_RATE_LIMIT', 50))
+SEND_RATE_LIMIT_BURST = int(os.getenv('SEND_RATE_LIMIT_BURST', 10))
+# Лимиты для кодов операторов в формате "916:20,926:10"
+SEND_RATE_LIMITS_BY_OPERATOR = {
+    int(code): float(rate)
+    for code, rate in (
+        item.split(':')
+        for item in os.getenv('SEND_RATE_LIMITS_BY_OPERATOR', '').split(',')
+        if item
+    )
+}
+# redis - общие для всех воркеров лимиты, memory - лимиты процесса
+SEND_RATE_LIMIT_BACKEND = os.getenv('SEND_RATE_LIMIT_BACKEND', 'redis')
+# При ответах 429 и 5xx скорость умножается на SEND_RATE_LIMIT_DECREASE
+# не чаще раза в SEND_RATE_LIMIT_COOLDOWN секунд, при успешных ответах
+# растет на SEND_RATE_LIMIT_INCREASE. Рост записывается в бакеты раз в
+# SEND_RATE_LIMIT_REPORT_BATCH успешных ответов процесса.
+SEND_RATE_LIMIT_MIN = float(os.getenv('SEND_RATE_LIMIT_MIN', 1))
+SEND_RATE_LIMIT_DECREASE = float(os.getenv('SEND_RATE_LIMIT_DECREASE', 0.5))
+SEND_RATE_LIMIT_INCREASE = float(os.getenv('SEND_RATE_LIMIT_INCREASE', 0.1))
+SEND_RATE_LIMIT_COOLDOWN = float(os.getenv('SEND_RATE_LIMIT_COOLDOWN', 1))
+SEND_RATE_LIMIT_REPORT_BATCH = int(
+    os.getenv('SEND_RATE_LIMIT_REPORT_BATCH', 20)
+)
+# Сколько секунд задача отправки ждет токен, прежде чем отложить сообщение
+SEND_RATE_LIMIT_MAX_WAIT = float(os.getenv('SEND_RATE_LIMIT_MAX_WAIT', 1))
+
+# Автомат отправки размыкается, если за SEND_CIRCUIT_WINDOW секунд из не
+# менее чем SEND_CIRCUIT_MIN_REQUESTS запросов доля ошибок достигла
+# SEND_CIRCUIT_FAILURE_RATIO. Через SEND_CIRCUIT_OPEN_TIMEOUT секунд
+# выполняется пробный запрос.
+SEND_CIRCUIT_BREAKER_BACKEND = os.getenv(
+    'SEND_CIRCUIT_BREAKER_BACKEND', 'redis'
+)
+SEND_CIRCUIT_FAILURE_RATIO = float(
+    os.getenv('SEND_CIRCUIT_FAILURE_RATIO', 0.5)
+)
+SEND_CIRCUIT_MIN_REQUESTS = int(os.getenv('SEND_CIRCUIT_MIN_REQUESTS', 20))
+SEND_CIRCUIT_WINDOW = float(os.getenv('SEND_CIRCUIT_WINDOW', 60))
+SEND_CIRCUIT_OPEN_TIMEOUT = float(os.getenv('SEND_CIRCUIT_OPEN_TIMEOUT', 30))
+SEND_CIRCUIT_PROBE_TIMEOUT = float(
+    os.getenv('SEND_CIRCUIT_PROBE_TIMEOUT', SEND_API_TIMEOUT)
+)
+# Период проверки отложенных на время недоступности API сообщений, секунды
+SEND_CIRCUIT_RELEASE_INTERVAL = float(
+    os.getenv('SEND_CIRCUIT_RELEASE_INTERVAL', 30)
+)
 
 LOGGING_DIR = os.path.join(BASE_DIR, 'logs')
 
 if not os.path.exists(LOGGING_DIR):
     os.makedirs(LOGGING_DIR)
 
+# Журналы пишутся фоновым потоком пачками по LOG_BUFFER_SIZE строк, не
+# реже раза в LOG_FLUSH_INTERVAL секунд, и ротируются по LOG_MAX_BYTES.
+# Каждый процесс пишет и ротирует свой файл. Номера файлов завершенных
+# процессов переходят к новым, поэтому файлов не больше, чем процессов.
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+LOG_BUFFER_SIZE = int(os.getenv('LOG_BUFFER_SIZE', 100))
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', 1))
+
+LOG_HANDLER = {
+    'level': 'INFO',
+    'class': 'notifications.logs.QueueFileHandler',
+    'formatter': 'json',
+    'max_bytes': LOG_MAX_BYTES,
+    'backup_count': LOG_BACKUP_COUNT,
+    'capacity': LOG_BUFFER_SIZE,
+    'flush_interval': LOG_FLUSH_INTERVAL,
+    'encoding': 'utf-8',
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
-        'verbose': {
-            'format': '{levelname} {asctime} {module} {message}',
-            'style': '{',
+        'json': {
+            '()': 'notifications.logs.JsonFormatter',
         }
     },
     'handlers': {
         'mailing': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(LOGGING_DIR, 'mailing.log'),
-            'formatter': 'verbose',
-            'encoding': 'utf-8'
+            **LOG_HANDLER,
+            'filename': os.path.join(LOGGING_DIR, 'mailing.%(slot)d.log'),
         },
         'message': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(LOGGING_DIR, 'message.log'),
-            'formatter': 'verbose',
-            'encoding': 'utf-8',
+            **LOG_HANDLER,
+            'filename': os.path.join(LOGGING_DIR, 'message.%(slot)d.log'),
         },
         'client': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': os.path.join(LOGGING_DIR, 'client.log'),
-            'formatter': 'verbose',
-            'encoding': 'utf-8'
+            **LOG_HANDLER,
+            'filename': os.path.join(LOGGING_DIR, 'client.%(slot)d.log'),
         },
     },
     'loggers': {
@@ -200,3 +356,20 @@ EMAIL_USE_SSL = False
 
 SERVER_EMAIL = EMAIL_HOST_USER
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+
+# Отправлять статистику по всем рассылкам одним письмом
+MAILING_STATISTIC_DIGEST = (
+    os.getenv('MAILING_STATISTIC_DIGEST', 'true').lower() == 'true'
+)
+
+# Сообщения рассылок, закончившихся больше MESSAGE_RETENTION_DAYS дней
+# назад, выгружаются в MESSAGE_ARCHIVE_DIR и удаляются из базы
+MESSAGE_RETENTION_DAYS = int(os.getenv('MESSAGE_RETENTION_DAYS', 90))
+MESSAGE_ARCHIVE_DIR = os.getenv(
+    'MESSAGE_ARCHIVE_DIR', os.path.join(BASE_DIR, 'archive')
+)
+MESSAGE_ARCHIVE_CHUNK_SIZE = int(
+    os.getenv('MESSAGE_ARCHIVE_CHUNK_SIZE', 5000)
+)
+# Сообщения удаляемых рассылок, клиентов и архива удаляются пачками
+MESSAGE_DELETE_CHUNK_SIZE = int(os.getenv('MESSAGE_DELETE_CHUNK_SIZE', 5000))
@@ -6,9 +6,12 @@ from drf_spectacular.views import (
     SpectacularRedocView
 )
 
+from notifications.views import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('notifications.urls')),
+    path('metrics', metrics, name='metrics'),
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path(
         'api/docs/',
@@ -2,7 +2,7 @@ from django.contrib import admin
 # from phonenumber_field.formfields import PhoneNumberField
 # from phonenumber_field.widgets import PhoneNumberPrefixWidget
 
-from .models import Client, Mailing, Message
+from .models import Client, Mailing, MailingStats, Message
 
 
 @admin.register(Client)
@@ -22,6 +22,27 @@ class MailingAdmin(admin.ModelAdmin):
     )
 
 
+@admin.register(MailingStats)
+class MailingStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        'mailing',
+        'total',
+        'successful',
+        'failed',
+        'pending',
+        'last_sent_at'
+    )
+
+
 @admin.register(Message)
 class MessageAdmin(admin.ModelAdmin):
-    pass
+    list_display = (
+        'id',
+        'mailing',
+        'client',
+        'status',
+        'attempts',
+        'send_date',
+        'next_attempt_at'
+    )
+    list_filter = ('status',)
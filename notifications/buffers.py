@@ -0,0 +1,133 @@
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Message
+from .statistics import get_stats_bucket, update_mailing_stats
+
+message_logger = logging.getLogger('message')
+
+# Поля сообщения, которые меняет попытка отправки
+STATUS_FIELDS = [
+    'status', 'send_date', 'attempts', 'next_attempt_at', 'parked',
+    'last_error'
+]
+
+
+class MailingChanges:
+    """Изменения счетчиков одной рассылки, накопленные в буфере."""
+
+    def __init__(self):
+        self.created = 0
+        self.transitions = []
+        self.last_sent_at = None
+
+    def add(self, created, transition, sent_at):
+        self.created += int(created)
+        self.transitions.append(transition)
+        if sent_at and (not self.last_sent_at or sent_at > self.last_sent_at):
+            self.last_sent_at = sent_at
+
+
+class StatusBuffer:
+    """Буфер отложенной записи статусов сообщений.
+
+    Изменения сообщений копятся в памяти воркера и записываются одним
+    bulk_update, когда в буфере набирается size сообщений или через
+    interval секунд после первого изменения. Повторное изменение того же
+    сообщения заменяет предыдущее, счетчики статистики рассылки
+    обновляются одним UPDATE на рассылку. Колбэки изменений, например
+    постановка следующей попытки, выполняются после записи. Сообщение,
+    уже записанное вызывающим кодом, передается с saved=True: в буфере
+    остается только изменение счетчиков.
+    """
+
+    def __init__(self, size, interval):
+        self.size = size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.timer = None
+        self.reset()
+
+    def reset(self):
+        self.messages = {}
+        self.changes = defaultdict(MailingChanges)
+        self.callbacks = []
+
+    def add(self, message, old_bucket, created=False, callback=None,
+            saved=False):
+        """Добавляет изменение сообщения и при переполнении пишет буфер."""
+        with self.lock:
+            if saved:
+                # Прежнее изменение не должно перезаписать сохраненное
+                self.messages.pop(message.id, None)
+            else:
+                self.messages[message.id] = message
+            self.changes[message.mailing_id].add(
+                created,
+                (old_bucket, get_stats_bucket(message)),
+                message.send_date
+            )
+            if callback is not None:
+                self.callbacks.append(callback)
+            full = len(self.messages) >= self.size
+            if not full and self.timer is None:
+                self.timer = threading.Timer(
+                    self.interval, self.flush_in_background
+                )
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные изменения и выполняет колбэки."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            messages = list(self.messages.values())
+            changes = self.changes
+            callbacks = self.callbacks
+            self.reset()
+
+        try:
+            if messages:
+                Message.objects.bulk_update(messages, STATUS_FIELDS)
+            for mailing_id, mailing_changes in changes.items():
+                update_mailing_stats(
+                    mailing_id,
+                    created=mailing_changes.created,
+                    transitions=mailing_changes.transitions,
+                    last_sent_at=mailing_changes.last_sent_at
+                )
+        finally:
+            for callback in callbacks:
+                callback()
+
+    def flush_in_background(self):
+        try:
+            self.flush()
+        except Exception as e:
+            message_logger.error(
+                'Ошибка при записи статусов сообщений: %s', e
+            )
+        finally:
+            connection.close()
+
+
+_status_buffer = None
+
+
+def get_status_buffer():
+    """Возвращает буфер статусов сообщений процесса воркера."""
+    global _status_buffer
+    if _status_buffer is None:
+        _status_buffer = StatusBuffer(
+            size=settings.SEND_STATUS_BUFFER_SIZE,
+            interval=settings.SEND_STATUS_FLUSH_INTERVAL
+        )
+    return _status_buffer
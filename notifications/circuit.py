@@ -0,0 +1,304 @@
+import abc
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import redis
+from django.conf import settings
+
+from .state import get_redis
+
+message_logger = logging.getLogger('message')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# Переходы состояния, которые возвращает record()
+OPENED = 'opened'
+REOPENED = 'reopened'
+RECOVERED = 'recovered'
+
+# KEYS - ключ состояния, ARGV - время ожидания результата пробы.
+# Возвращает разрешение на запрос и время до следующей попытки.
+ALLOW_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local circuit = redis.call(
+    'HMGET', KEYS[1], 'state', 'opened_until', 'probe_until'
+)
+if circuit[1] ~= 'open' then
+    return {1, '0'}
+end
+local opened_until = tonumber(circuit[2]) or 0
+if now < opened_until then
+    return {0, tostring(opened_until - now)}
+end
+local probe_until = tonumber(circuit[3]) or 0
+if now < probe_until then
+    return {0, tostring(probe_until - now)}
+end
+redis.call('HSET', KEYS[1], 'probe_until', now + tonumber(ARGV[1]))
+return {1, '0'}
+"""
+
+# KEYS - ключ состояния, ARGV - признак ошибки, доля ошибок, минимум
+# запросов, длина окна и время размыкания. Возвращает переход состояния.
+RECORD_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local failed = tonumber(ARGV[1])
+local open_timeout = tonumber(ARGV[5])
+local circuit = redis.call(
+    'HMGET', KEYS[1],
+    'state', 'opened_until', 'window_start', 'total', 'failures'
+)
+if circuit[1] == 'open' then
+    if now < (tonumber(circuit[2]) or 0) then
+        return ''
+    end
+    if failed == 1 then
+        redis.call(
+            'HSET', KEYS[1],
+            'opened_until', now + open_timeout, 'probe_until', 0
+        )
+        return 'reopened'
+    end
+    redis.call('DEL', KEYS[1])
+    return 'recovered'
+end
+local window_start = tonumber(circuit[3]) or now
+local total = tonumber(circuit[4]) or 0
+local failures = tonumber(circuit[5]) or 0
+if now - window_start >= tonumber(ARGV[4]) then
+    window_start = now
+    total = 0
+    failures = 0
+end
+total = total + 1
+failures = failures + failed
+if total >= tonumber(ARGV[3]) and failures / total >= tonumber(ARGV[2]) then
+    redis.call(
+        'HSET', KEYS[1],
+        'state', 'open', 'opened_until', now + open_timeout,
+        'probe_until', 0, 'window_start', now, 'total', 0, 'failures', 0
+    )
+    return 'opened'
+end
+redis.call(
+    'HSET', KEYS[1],
+    'state', 'closed', 'window_start', window_start,
+    'total', total, 'failures', failures
+)
+return ''
+"""
+
+
+class CircuitOpenError(Exception):
+    """Запрос не выполнен, так как автомат отправки разомкнут."""
+
+    def __init__(self, retry_after):
+        super().__init__(f'Повторить через {retry_after:.0f} с.')
+        self.retry_after = retry_after
+
+
+def is_failure(status_code, error=None):
+    """Проверяет, что результат запроса говорит о недоступности API."""
+    return error is not None or status_code is None or status_code >= 500
+
+
+class CircuitBreaker(abc.ABC):
+    """Автомат, прекращающий запросы к недоступному провайдеру отправки.
+
+    Автомат размыкается, когда за окно SEND_CIRCUIT_WINDOW секунд доля
+    неудачных запросов достигает SEND_CIRCUIT_FAILURE_RATIO. Через
+    SEND_CIRCUIT_OPEN_TIMEOUT секунд пропускается один пробный запрос:
+    при успехе автомат замыкается, при ошибке снова размыкается.
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.key = f'send_circuit:{provider}'
+
+    @abc.abstractmethod
+    def allow(self):
+        """Возвращает разрешение на запрос и время до следующей попытки."""
+
+    def record(self, failed):
+        """Учитывает результат запроса и возвращает переход состояния."""
+        transition = self.update(failed)
+        if transition == OPENED:
+            message_logger.warning(
+                f'API отправки {self.provider} недоступен, отправка '
+                f'приостановлена на {settings.SEND_CIRCUIT_OPEN_TIMEOUT} с.'
+            )
+        elif transition == REOPENED:
+            message_logger.warning(
+                f'Пробный запрос к API отправки {self.provider} не удался.'
+            )
+        elif transition == RECOVERED:
+            message_logger.info(
+                f'API отправки {self.provider} снова доступен.'
+            )
+        return transition
+
+    @abc.abstractmethod
+    def update(self, failed):
+        """Обновляет состояние автомата и возвращает переход состояния."""
+
+    @abc.abstractmethod
+    def get_state(self):
+        """Возвращает состояние автомата и время до следующей попытки."""
+
+
+class RedisCircuitBreaker(CircuitBreaker):
+    """Автомат с состоянием в Redis, общим для всех воркеров.
+
+    При недоступности Redis запросы не ограничиваются, а автомат
+    считается замкнутым.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.allow_script = get_redis().register_script(ALLOW_SCRIPT)
+        self.record_script = get_redis().register_script(RECORD_SCRIPT)
+
+    def allow(self):
+        try:
+            allowed, retry_after = self.allow_script(
+                keys=[self.key], args=[settings.SEND_CIRCUIT_PROBE_TIMEOUT]
+            )
+        except redis.RedisError as e:
+            message_logger.warning('Автомат отправки недоступен: %r', e)
+            return True, 0
+        return bool(allowed), float(retry_after)
+
+    def update(self, failed):
+        try:
+            transition = self.record_script(keys=[self.key], args=[
+                int(failed),
+                settings.SEND_CIRCUIT_FAILURE_RATIO,
+                settings.SEND_CIRCUIT_MIN_REQUESTS,
+                settings.SEND_CIRCUIT_WINDOW,
+                settings.SEND_CIRCUIT_OPEN_TIMEOUT,
+            ])
+        except redis.RedisError as e:
+            message_logger.warning('Автомат отправки недоступен: %r', e)
+            return ''
+        return transition.decode()
+
+    def get_state(self):
+        try:
+            seconds, microseconds = get_redis().time()
+            circuit = {
+                key.decode(): value.decode()
+                for key, value in get_redis().hgetall(self.key).items()
+            }
+        except redis.RedisError as e:
+            message_logger.warning('Автомат отправки недоступен: %r', e)
+            return get_circuit_state({}, 0)
+        return get_circuit_state(circuit, seconds + microseconds / 1000000)
+
+
+class LocalCircuitBreaker(CircuitBreaker):
+    """Автомат с состоянием в памяти процесса.
+
+    Подходит для тестов и запуска с одним воркером.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.circuit = {}
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.time()
+            if self.circuit.get('state') != OPEN:
+                return True, 0
+            if now < self.circuit['opened_until']:
+                return False, self.circuit['opened_until'] - now
+            if now < self.circuit['probe_until']:
+                return False, self.circuit['probe_until'] - now
+            self.circuit['probe_until'] = (
+                now + settings.SEND_CIRCUIT_PROBE_TIMEOUT
+            )
+            return True, 0
+
+    def update(self, failed):
+        with self.lock:
+            now = time.time()
+            circuit = self.circuit
+            if circuit.get('state') == OPEN:
+                if now < circuit['opened_until']:
+                    return ''
+                if failed:
+                    circuit['opened_until'] = (
+                        now + settings.SEND_CIRCUIT_OPEN_TIMEOUT
+                    )
+                    circuit['probe_until'] = 0
+                    return REOPENED
+                circuit.clear()
+                return RECOVERED
+
+            if now - circuit.get('window_start', now) >= (
+                settings.SEND_CIRCUIT_WINDOW
+            ):
+                circuit.clear()
+            circuit.setdefault('window_start', now)
+            circuit['total'] = circuit.get('total', 0) + 1
+            circuit['failures'] = circuit.get('failures', 0) + int(failed)
+            if (
+                circuit['total'] >= settings.SEND_CIRCUIT_MIN_REQUESTS and
+                circuit['failures'] / circuit['total'] >=
+                settings.SEND_CIRCUIT_FAILURE_RATIO
+            ):
+                circuit.clear()
+                circuit.update({
+                    'state': OPEN,
+                    'opened_until': now + settings.SEND_CIRCUIT_OPEN_TIMEOUT,
+                    'probe_until': 0,
+                })
+                return OPENED
+            circuit['state'] = CLOSED
+            return ''
+
+    def get_state(self):
+        with self.lock:
+            return get_circuit_state(dict(self.circuit), time.time())
+
+
+def get_circuit_state(circuit, now):
+    """Приводит сохраненное состояние автомата к ответу API."""
+    retry_after = 0
+    state = circuit.get('state') or CLOSED
+    if state == OPEN:
+        retry_after = max(0, float(circuit['opened_until']) - now)
+        if not retry_after:
+            state = HALF_OPEN
+    return {
+        'state': state,
+        'retry_after': round(retry_after, 3),
+        'requests': int(circuit.get('total', 0)),
+        'failures': int(circuit.get('failures', 0)),
+    }
+
+
+CIRCUIT_BREAKER_BACKENDS = {
+    'redis': RedisCircuitBreaker,
+    'memory': LocalCircuitBreaker,
+}
+
+_circuit_breaker = None
+
+
+def get_circuit_breaker():
+    """Возвращает автомат отправки для провайдера из SEND_API_URL."""
+    global _circuit_breaker
+    if _circuit_breaker is None:
+        backend = CIRCUIT_BREAKER_BACKENDS[
+            settings.SEND_CIRCUIT_BREAKER_BACKEND
+        ]
+        _circuit_breaker = backend(urlparse(settings.SEND_API_URL).netloc)
+    return _circuit_breaker
@@ -0,0 +1,231 @@
+import asyncio
+import time
+from collections import namedtuple
+
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from requests.adapters import HTTPAdapter
+
+from .circuit import CircuitOpenError, get_circuit_breaker, is_failure
+from .metrics import observe_send
+from .ratelimit import get_rate_limiter
+
+DeliveryResult = namedtuple(
+    'DeliveryResult',
+    ['message', 'status_code', 'error', 'latency'],
+    defaults=[None]
+)
+
+_session = None
+
+
+def get_session():
+    """Возвращает общую для процесса keep-alive сессию к API отправки."""
+    global _session
+    if _session is None:
+        adapter = HTTPAdapter(
+            pool_connections=settings.SEND_API_POOL_SIZE,
+            pool_maxsize=settings.SEND_API_POOL_SIZE,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Authorization'] = f'Bearer {settings.API_TOKEN}'
+        _session = session
+    return _session
+
+
+def get_send_url(message_id):
+    """Возвращает адрес API для отправки сообщения."""
+    return f'{settings.SEND_API_URL.rstrip("/")}/{message_id}'
+
+
+def get_payload(message_id, phone_number, text):
+    """Возвращает тело запроса на отправку сообщения."""
+    return {
+        'id': message_id,
+        'phone': int(phone_number),
+        'text': text
+    }
+
+
+def get_latency(started):
+    """Возвращает время запроса в секундах от момента started."""
+    return round(time.monotonic() - started, 3)
+
+
+def send_message_request(message_id, phone_number, text, session=None):
+    """Отправляет сообщение во внешний API и возвращает ответ."""
+    session = session or get_session()
+    return session.post(
+        get_send_url(message_id),
+        json=get_payload(message_id, phone_number, text),
+        timeout=settings.SEND_API_TIMEOUT,
+    )
+
+
+def deliver_messages(messages, text, on_results):
+    """Отправляет сообщения бэкендом из настройки SEND_DELIVERY_BACKEND.
+
+    У сообщений должен быть загружен клиент. Частота запросов ограничена
+    общим для воркеров ограничителем. Пока автомат отправки разомкнут,
+    запросы не выполняются, а результатом будет CircuitOpenError.
+    Результаты передаются в on_results пачками по SEND_RESULTS_BATCH_SIZE
+    штук.
+    """
+    if settings.SEND_DELIVERY_BACKEND == 'async':
+        asyncio.run(deliver_messages_async(messages, text, on_results))
+    else:
+        deliver_messages_sync(messages, text, on_results)
+
+
+def record_response(rate_limiter, circuit_breaker, code_operator,
+                    status_code):
+    """Учитывает ответ API в ограничителе частоты и автомате отправки."""
+    rate_limiter.report(code_operator, status_code)
+    circuit_breaker.record(is_failure(status_code))
+
+
+def deliver_messages_sync(messages, text, on_results):
+    """Последовательно отправляет сообщения через общую сессию."""
+    session = get_session()
+    rate_limiter = get_rate_limiter()
+    circuit_breaker = get_circuit_breaker()
+    results = []
+    for message in messages:
+        code_operator = message.client.code_operator
+        allowed, retry_after = circuit_breaker.allow()
+        if not allowed:
+            results.append(
+                DeliveryResult(message, None, CircuitOpenError(retry_after))
+            )
+            continue
+        rate_limiter.wait(code_operator)
+        started = time.monotonic()
+        try:
+            response = send_message_request(
+                message.id, message.client.phone_number, text,
+                session=session
+            )
+            latency = get_latency(started)
+            record_response(
+                rate_limiter, circuit_breaker, code_operator,
+                response.status_code
+            )
+            observe_send('sync', response.status_code, latency)
+            results.append(
+                DeliveryResult(message, response.status_code, None, latency)
+            )
+        except requests.RequestException as e:
+            latency = get_latency(started)
+            circuit_breaker.record(True)
+            observe_send('sync', None, latency)
+            results.append(DeliveryResult(message, None, e, latency))
+
+        if len(results) >= settings.SEND_RESULTS_BATCH_SIZE:
+            on_results(results)
+            results = []
+
+    if results:
+        on_results(results)
+
+
+def close_connection_after(on_results):
+    """Оборачивает on_results, закрывая после вызова соединение с базой.
+
+    Результаты пишутся в потоках пула, соединения которых не проверяет и
+    не закрывает Celery.
+    """
+    def save_results(results):
+        try:
+            on_results(results)
+        finally:
+            connection.close()
+    return save_results
+
+
+async def deliver_messages_async(messages, text, on_results):
+    """Отправляет сообщения конкурентно, не более SEND_API_CONCURRENCY сразу.
+
+    Новые запросы создаются по мере завершения уже запущенных, а
+    запись результатов выполняется в потоке пула, не останавливая
+    запросы в полете. Записи разных задач не ждут друг друга в общем
+    потоке. Обращения к ограничителю частоты и автомату отправки тоже
+    выполняются в потоках пула, чтобы запросы к Redis не останавливали
+    цикл событий.
+    """
+    import httpx
+
+    concurrency = settings.SEND_API_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+    rate_limiter = get_rate_limiter()
+    circuit_breaker = get_circuit_breaker()
+    save_results = sync_to_async(
+        close_connection_after(on_results), thread_sensitive=False
+    )
+    results = []
+
+    async with httpx.AsyncClient(
+        headers={'Authorization': f'Bearer {settings.API_TOKEN}'},
+        limits=httpx.Limits(max_connections=concurrency),
+        timeout=settings.SEND_API_TIMEOUT,
+    ) as client:
+
+        async def send(message):
+            code_operator = message.client.code_operator
+            async with semaphore:
+                allowed, retry_after = await asyncio.to_thread(
+                    circuit_breaker.allow
+                )
+                if not allowed:
+                    return DeliveryResult(
+                        message, None, CircuitOpenError(retry_after)
+                    )
+                await rate_limiter.wait_async(code_operator)
+                started = time.monotonic()
+                try:
+                    response = await client.post(
+                        get_send_url(message.id),
+                        json=get_payload(
+                            message.id, message.client.phone_number, text
+                        ),
+                    )
+                    latency = get_latency(started)
+                    await asyncio.to_thread(
+                        record_response, rate_limiter, circuit_breaker,
+                        code_operator, response.status_code
+                    )
+                    observe_send('async', response.status_code, latency)
+                    return DeliveryResult(
+                        message, response.status_code, None, latency
+                    )
+                except httpx.HTTPError as e:
+                    latency = get_latency(started)
+                    await asyncio.to_thread(circuit_breaker.record, True)
+                    observe_send('async', None, latency)
+                    return DeliveryResult(message, None, e, latency)
+
+        async def collect(pending):
+            nonlocal results
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            results.extend(task.result() for task in done)
+            if len(results) >= settings.SEND_RESULTS_BATCH_SIZE:
+                batch, results = results, []
+                await save_results(batch)
+            return pending
+
+        pending = set()
+        for message in messages:
+            if len(pending) >= concurrency:
+                pending = await collect(pending)
+            pending.add(asyncio.ensure_future(send(message)))
+
+        while pending:
+            pending = await collect(pending)
+
+    if results:
+        await save_results(results)
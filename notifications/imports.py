@@ -0,0 +1,110 @@
+import re
+from itertools import islice
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import MAX_LENGTH, Client
+from .timezones import is_valid_timezone
+
+PHONE_NUMBER_RE = re.compile(r'^7\d{10}$')
+UPDATE_FIELDS = ('code_operator', 'tag', 'timezone')
+MAX_REPORTED_ERRORS = 1000
+CODE_OPERATOR_FIELD = Client._meta.get_field('code_operator')
+
+
+def validate_client_row(row):
+    """Проверяет строку импорта и возвращает данные клиента и ошибки."""
+    if not isinstance(row, dict):
+        return None, {'non_field_errors': 'Некорректная строка'}
+
+    errors = {}
+    phone_number = str(row.get('phone_number') or '')
+    if not PHONE_NUMBER_RE.match(phone_number):
+        errors['phone_number'] = (
+            'Введите корректный номер телефона в формате 7XXXXXXXXXX'
+        )
+
+    code_operator = row.get('code_operator')
+    if str(code_operator) != phone_number[1:4]:
+        errors['code_operator'] = 'Код оператора не совпадает с кодом в номере'
+    else:
+        try:
+            CODE_OPERATOR_FIELD.run_validators(int(code_operator))
+        except ValidationError as e:
+            errors['code_operator'] = ' '.join(e.messages)
+
+    tag = row.get('tag')
+    if not tag or len(str(tag)) > MAX_LENGTH:
+        errors['tag'] = 'Тег обязателен и не длиннее 100 символов'
+
+    if not is_valid_timezone(row.get('timezone')):
+        errors['timezone'] = 'Неизвестный часовой пояс'
+
+    if errors:
+        return None, errors
+    return {
+        'phone_number': phone_number,
+        'code_operator': int(code_operator),
+        'tag': str(tag),
+        'timezone': row['timezone'],
+    }, None
+
+
+def save_clients(clients):
+    """Создает новых и обновляет существующих клиентов пачки.
+
+    Клиенты сопоставляются по номеру телефона одним запросом, новые
+    вставляются через bulk_create, существующие обновляются через
+    bulk_update.
+    """
+    existing_ids = dict(
+        Client.objects.filter(phone_number__in=clients)
+        .values_list('phone_number', 'id')
+    )
+    new_clients = []
+    updated_clients = []
+    for phone_number, data in clients.items():
+        client = Client(**data)
+        if phone_number in existing_ids:
+            client.id = existing_ids[phone_number]
+            updated_clients.append(client)
+        else:
+            new_clients.append(client)
+
+    with transaction.atomic():
+        Client.objects.bulk_create(new_clients, ignore_conflicts=True)
+        Client.objects.bulk_update(updated_clients, UPDATE_FIELDS)
+    return len(new_clients), len(updated_clients)
+
+
+def import_clients(rows):
+    """Импортирует клиентов пачками по CLIENT_IMPORT_CHUNK_SIZE строк.
+
+    Возвращает число созданных и обновленных клиентов и ошибки по номерам
+    строк. Строки с ошибками пропускаются, при повторе номера телефона
+    в загрузке используется последняя строка.
+    """
+    report = {'created': 0, 'updated': 0, 'errors_count': 0, 'errors': []}
+    rows = enumerate(rows, start=1)
+    while True:
+        chunk = list(islice(rows, settings.CLIENT_IMPORT_CHUNK_SIZE))
+        if not chunk:
+            return report
+
+        clients = {}
+        for row_number, row in chunk:
+            data, errors = validate_client_row(row)
+            if errors:
+                report['errors_count'] += 1
+                if len(report['errors']) < MAX_REPORTED_ERRORS:
+                    report['errors'].append(
+                        {'row': row_number, 'errors': errors}
+                    )
+                continue
+            clients[data['phone_number']] = data
+
+        created, updated = save_clients(clients)
+        report['created'] += created
+        report['updated'] += updated
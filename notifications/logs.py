@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import queue
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Поля записи, которые передаются через extra и попадают в JSON
+STRUCTURED_FIELDS = (
+    'mailing_id', 'message_id', 'client_id', 'status', 'latency'
+)
+
+
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись журнала в строку JSON."""
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created).astimezone()
+            .isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class BatchRotatingFileHandler(RotatingFileHandler):
+    """Ротируемый файловый обработчик, записывающий строки пачками.
+
+    Строки накапливаются в буфере и записываются в файл одной операцией,
+    когда их становится capacity или когда вызывается flush().
+    """
+
+    def __init__(self, filename, capacity=100, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.capacity = capacity
+        self.buffer = []
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+            if len(self.buffer) >= self.capacity:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                data = self.terminator.join(self.buffer) + self.terminator
+                self.buffer = []
+                if self.stream is None:
+                    self.stream = self._open()
+                if (
+                    self.maxBytes and
+                    self.stream.tell() + len(data) >= self.maxBytes
+                ):
+                    self.doRollover()
+                    # С delay=True файл после ротации не открывается
+                    if self.stream is None:
+                        self.stream = self._open()
+                self.stream.write(data)
+            super().flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+class BatchQueueListener(QueueListener):
+    """Слушатель очереди, сбрасывающий буферы обработчиков при простое."""
+
+    def __init__(self, queue, *handlers, flush_interval=1.0):
+        super().__init__(queue, *handlers)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, timeout=self.flush_interval)
+            except queue.Empty:
+                if not block:
+                    raise
+                for handler in self.handlers:
+                    handler.flush()
+
+
+class QueueFileHandler(QueueHandler):
+    """Обработчик, записывающий журнал в файл в отдельном потоке.
+
+    Вызов логгера только кладет запись в очередь. Форматирование и
+    запись пачками в ротируемый файл выполняет фоновый поток, который
+    сбрасывает буфер не реже раза в flush_interval секунд.
+
+    Имя файла может содержать %(slot)d - номер файла процесса. Так
+    каждый процесс, в том числе созданный через fork, пишет и ротирует
+    свой файл: при ротации общего файла процессы переименовывают его друг
+    у друга и теряют записи. Процесс занимает наименьший номер, файл
+    которого не заблокирован другим живым процессом. Номера завершенных
+    процессов занимают новые, поэтому число файлов не растет с
+    перезапусками воркеров. Без fcntl номером служит номер процесса.
+    """
+
+    def __init__(self, filename, max_bytes=0, backup_count=0,
+                 capacity=100, flush_interval=1.0, encoding=None):
+        super().__init__(queue.SimpleQueue())
+        self.filename = filename
+        self.target_kwargs = {
+            'capacity': capacity,
+            'maxBytes': max_bytes,
+            'backupCount': backup_count,
+            'encoding': encoding,
+            'delay': True,
+        }
+        self.target = None
+        self.slot_lock = None
+        self.flush_interval = flush_interval
+        self.listener = None
+        self.start()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.restart)
+
+    def get_filename(self, slot):
+        """Возвращает имя файла журнала с номером slot."""
+        return os.path.abspath(self.filename % {'slot': slot})
+
+    def acquire_filename(self):
+        """Занимает свободный номер файла и возвращает имя файла.
+
+        Номер занят, пока процесс держит блокировку файла name.lock.
+        Блокировка снимается при закрытии обработчика или завершении
+        процесса.
+        """
+        if fcntl is None:
+            return self.get_filename(os.getpid())
+        slot = 0
+        while True:
+            filename = self.get_filename(slot)
+            lock = open(filename + '.lock', 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                slot += 1
+                continue
+            self.slot_lock = lock
+            return filename
+
+    def release_filename(self):
+        """Освобождает номер файла, занятый обработчиком."""
+        if self.slot_lock is not None:
+            self.slot_lock.close()
+            self.slot_lock = None
+
+    def start(self):
+        """Запускает фоновый поток записи, в том числе после fork."""
+        self.queue = queue.SimpleQueue()
+        # После fork блокировка принадлежит и родителю, копия ему не нужна
+        self.release_filename()
+        filename = self.acquire_filename()
+        if self.target is not None:
+            # Строки в буфере унаследованы от родителя, их запишет он
+            self.target.buffer = []
+            if self.target.baseFilename != filename:
+                self.target.close()
+                self.target = None
+        if self.target is None:
+            self.target = BatchRotatingFileHandler(
+                filename, **self.target_kwargs
+            )
+            self.target.setFormatter(self.formatter)
+        self.listener = BatchQueueListener(
+            self.queue, self.target, flush_interval=self.flush_interval
+        )
+        self.listener.start()
+
+    def restart(self):
+        """Перезапускает запись в процессе, созданном через fork.
+
+        Закрытый обработчик не занимает номер файла в новом процессе.
+        """
+        if self.listener is not None:
+            self.start()
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def handle(self, record):
+        # Очередь потокобезопасна, блокировка обработчика не нужна.
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def prepare(self, record):
+        # Очередь не покидает процесс, поэтому запись форматируется
+        # в фоновом потоке, а не в вызывающем.
+        return record
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        self.target.close()
+        self.release_filename()
+        super().close()
@@ -0,0 +1,5 @@
+from notifications.services import ArchiveMessages
+
+
+class Command(ArchiveMessages):
+    """Команда выгрузки сообщений закончившихся рассылок в архив."""
@@ -0,0 +1,5 @@
+from notifications.services import ConvertMessageStatuses
+
+
+class Command(ConvertMessageStatuses):
+    """Команда перевода прежних статусов сообщений в новые."""
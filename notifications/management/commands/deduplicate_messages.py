@@ -0,0 +1,5 @@
+from notifications.services import DeduplicateMessages
+
+
+class Command(DeduplicateMessages):
+    """Команда удаления повторных сообщений клиенту в рассылке."""
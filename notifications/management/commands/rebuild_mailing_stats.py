@@ -0,0 +1,5 @@
+from notifications.services import RebuildMailingStats
+
+
+class Command(RebuildMailingStats):
+    """Команда пересчета счетчиков статистики рассылок."""
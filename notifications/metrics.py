@@ -0,0 +1,53 @@
+from prometheus_client import Counter, Histogram
+
+LATENCY_BUCKETS = (
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')
+)
+LAG_BUCKETS = (
+    1, 5, 15, 30, 60, 300, 900, 1800, 3600, 4 * 3600, 24 * 3600,
+    float('inf')
+)
+
+SEND_REQUEST_SECONDS = Histogram(
+    'notifications_send_request_seconds',
+    'Время запроса к API отправки.',
+    ['backend'],
+    buckets=LATENCY_BUCKETS,
+)
+SEND_RESPONSES = Counter(
+    'notifications_send_responses_total',
+    'Ответы API отправки по статусам, error - ошибка соединения.',
+    ['status'],
+)
+SEND_LAG_SECONDS = Histogram(
+    'notifications_send_lag_seconds',
+    'Отставание отправки сообщения от планового времени.',
+    buckets=LAG_BUCKETS,
+)
+DISPATCH_SECONDS = Histogram(
+    'notifications_dispatch_seconds',
+    'Время выполнения задач запуска рассылки.',
+    ['task'],
+    buckets=LATENCY_BUCKETS,
+)
+VIEW_SECONDS = Histogram(
+    'notifications_view_seconds',
+    'Время ответа эндпоинтов статистики.',
+    ['view'],
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def observe_send(backend, status_code, latency):
+    """Учитывает запрос к API отправки: статус ответа и время запроса."""
+    SEND_RESPONSES.labels(
+        'error' if status_code is None else status_code
+    ).inc()
+    if latency is not None:
+        SEND_REQUEST_SECONDS.labels(backend).observe(latency)
+
+
+def observe_lag(planned, sent):
+    """Учитывает отставание фактической отправки от плановой."""
+    if planned is not None:
+        SEND_LAG_SECONDS.observe(max(0, (sent - planned).total_seconds()))
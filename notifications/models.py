@@ -1,13 +1,30 @@
-import pytz
 from django.db import models
 # from datetime import datetime
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.core.exceptions import ValidationError
 
+from .timezones import validate_timezone
+
 # from phonenumber_field.modelfields import PhoneNumberField
 
 
 MAX_LENGTH = 100
+# Приоритет рассылки: чем больше значение, тем раньше отправка
+MAX_PRIORITY = 9
+DEFAULT_PRIORITY = 4
+
+
+class MailingState(models.TextChoices):
+    """Состояния рассылки.
+
+    Отправка идет только у активной рассылки. Приостановленную рассылку
+    можно возобновить, отмененную - нет, удаляемая скрыта из API.
+    """
+
+    ACTIVE = 'active', 'Активна'
+    PAUSED = 'paused', 'Приостановлена'
+    CANCELLED = 'cancelled', 'Отменена'
+    DELETING = 'deleting', 'Удаляется'
 
 
 class Mailing(models.Model):
@@ -44,6 +61,16 @@ class Mailing(models.Model):
         blank=True,
         null=True,
     )
+    priority = models.PositiveSmallIntegerField(
+        default=DEFAULT_PRIORITY,
+        validators=[MaxValueValidator(MAX_PRIORITY)]
+    )
+    version = models.PositiveIntegerField(default=1)
+    state = models.CharField(
+        max_length=16,
+        choices=MailingState.choices,
+        default=MailingState.ACTIVE
+    )
 
     def clean(self) -> None:
         if self.filter_tag is None and self.filter_code_operator is None:
@@ -63,6 +90,43 @@ class Mailing(models.Model):
         super().save(*args, **kwargs)
 
 
+class MailingStats(models.Model):
+    """Модель для хранения счетчиков сообщений рассылки."""
+
+    mailing = models.OneToOneField(
+        Mailing,
+        on_delete=models.CASCADE,
+        related_name='stats'
+    )
+    total = models.PositiveIntegerField(default=0)
+    successful = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    pending = models.PositiveIntegerField(default=0)
+    last_sent_at = models.DateTimeField(
+        blank=True,
+        null=True
+    )
+    # Сообщения рассылки выгружены в архив, счетчики окончательные
+    archived = models.BooleanField(default=False)
+
+
+class MessageStatus(models.TextChoices):
+    """Статусы сообщения рассылки.
+
+    QUEUED - сообщение ждет первой попытки, DEFERRED - отложено до
+    next_attempt_at, SENDING - передано в API в составе пачки, SENT -
+    доставлено, FAILED - попытки закончились ошибками, EXPIRED - рассылка
+    истекла до первой попытки.
+    """
+
+    QUEUED = 'queued', 'В очереди'
+    DEFERRED = 'deferred', 'Отложено'
+    SENDING = 'sending', 'Отправляется'
+    SENT = 'sent', 'Отправлено'
+    FAILED = 'failed', 'Не отправлено'
+    EXPIRED = 'expired', 'Истекло'
+
+
 class Message(models.Model):
     """Модель для хранения информации о сообщениях рассылок."""
 
@@ -70,7 +134,22 @@ class Message(models.Model):
         blank=True,
         null=True
     )
-    status = models.IntegerField()
+    status = models.CharField(
+        max_length=16,
+        choices=MessageStatus.choices,
+        default=MessageStatus.QUEUED
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.CharField(
+        max_length=MAX_LENGTH * 2,
+        blank=True,
+        default=''
+    )
+    next_attempt_at = models.DateTimeField(
+        blank=True,
+        null=True
+    )
+    parked = models.BooleanField(default=False)
     mailing = models.ForeignKey(
         Mailing,
         on_delete=models.CASCADE,
@@ -82,12 +161,53 @@ class Message(models.Model):
         related_name='clients'
     )
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['mailing', 'status'],
+                name='message_mailing_status_idx'
+            ),
+            models.Index(fields=['send_date'], name='message_send_date_idx'),
+            models.Index(
+                fields=['id'],
+                condition=models.Q(parked=True),
+                name='message_parked_idx'
+            ),
+            models.Index(
+                fields=['next_attempt_at'],
+                condition=models.Q(
+                    status__in=[MessageStatus.DEFERRED, MessageStatus.SENDING],
+                    parked=False
+                ),
+                name='message_retry_idx'
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['mailing', 'client'],
+                name='message_mailing_client_unique'
+            ),
+        ]
+
+
+class ClientQuerySet(models.QuerySet):
+    """Запросы выборки клиентов."""
+
+    def for_mailing(self, mailing):
+        """Возвращает клиентов, подходящих под фильтры рассылки."""
+        filters = {}
+        if mailing.filter_tag:
+            filters['tag'] = mailing.filter_tag
+        if mailing.filter_code_operator:
+            filters['code_operator'] = mailing.filter_code_operator
+        if not filters:
+            return self.none()
+        return self.filter(is_deleting=False, **filters)
+
 
 class Client(models.Model):
     """Модель для хранения информации о клиентах."""
 
-    TIMEZONES = tuple(zip(pytz.all_timezones, pytz.all_timezones))
-
     phone_number = models.CharField(max_length=12, unique=True)
     code_operator = models.IntegerField(
         validators=[
@@ -96,7 +216,26 @@ class Client(models.Model):
         ]
     )
     tag = models.CharField(max_length=MAX_LENGTH)
-    timezone = models.CharField(max_length=32, choices=TIMEZONES)
+    timezone = models.CharField(
+        max_length=32,
+        validators=[validate_timezone]
+    )
+    # Клиент удаляется фоновой задачей и скрыт из API и рассылок
+    is_deleting = models.BooleanField(default=False)
+
+    objects = ClientQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['tag', 'code_operator'],
+                name='client_tag_operator_idx'
+            ),
+            models.Index(
+                fields=['code_operator'],
+                name='client_operator_idx'
+            ),
+        ]
 
     def clean(self) -> None:
         if self.phone_number:
@@ -0,0 +1,103 @@
+import codecs
+import csv
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+def decode_lines(stream, encoding, invalid_lines):
+    """Декодирует поток построчно.
+
+    Строка с ошибкой кодировки не прерывает разбор: ее номер добавляется
+    в invalid_lines, а сама она декодируется с заменой символов.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)()
+    except LookupError:
+        raise ParseError(f'Неизвестная кодировка: {encoding}')
+    for number, line in enumerate(stream, start=1):
+        try:
+            yield decoder.decode(line)
+        except UnicodeDecodeError:
+            decoder.reset()
+            invalid_lines.add(number)
+            yield line.decode(encoding, 'replace')
+
+
+class NDJSONParser(BaseParser):
+    """Парсер потока JSON-объектов, по одному в строке.
+
+    Строки разбираются по мере чтения. Вместо строки с некорректным JSON
+    или в неверной кодировке возвращается None, чтобы ошибка попала в отчет
+    по строкам.
+    """
+
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        invalid_lines = set()
+        return self.iter_rows(
+            decode_lines(stream, encoding, invalid_lines), invalid_lines
+        )
+
+    @staticmethod
+    def iter_rows(lines, invalid_lines=()):
+        """Разбирает непустые строки как JSON."""
+        for number, line in enumerate(lines, start=1):
+            if number in invalid_lines:
+                yield None
+                continue
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+class CSVParser(BaseParser):
+    """Парсер CSV с заголовком, строки разбираются по мере чтения.
+
+    Вместо строки с ошибкой формата или кодировки возвращается None.
+    Некорректный заголовок отклоняет весь запрос до импорта первой строки.
+    """
+
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        invalid_lines = set()
+        return self.iter_rows(
+            decode_lines(stream, encoding, invalid_lines), invalid_lines
+        )
+
+    @staticmethod
+    def iter_rows(lines, invalid_lines=None):
+        """Возвращает строки CSV как словари по заголовку."""
+        invalid_lines = set() if invalid_lines is None else invalid_lines
+        reader = csv.DictReader(lines)
+        try:
+            reader.fieldnames
+        except csv.Error as error:
+            raise ParseError(f'Некорректный заголовок CSV: {error}')
+        if invalid_lines:
+            raise ParseError('Заголовок CSV в неверной кодировке')
+        line_num = reader.line_num
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error:
+                row = None
+            # Строка CSV может занимать несколько строк файла
+            if any(line_num < n <= reader.line_num for n in invalid_lines):
+                invalid_lines.clear()
+                row = None
+            line_num = reader.line_num
+            yield row
@@ -0,0 +1,294 @@
+import abc
+import asyncio
+import logging
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+
+import redis
+from django.conf import settings
+
+from .state import get_redis
+
+message_logger = logging.getLogger('message')
+
+BUCKET_TTL = 3600
+
+# KEYS - бакеты, ARGV - емкость, время жизни и скорости бакетов.
+# Токен забирается сразу из всех бакетов, либо ни из одного.
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local burst = tonumber(ARGV[1])
+local ttl = tonumber(ARGV[2])
+local wait = 0
+local buckets = {}
+for i, key in ipairs(KEYS) do
+    local max_rate = tonumber(ARGV[i + 2])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts', 'rate')
+    local rate = math.min(tonumber(bucket[3]) or max_rate, max_rate)
+    local tokens = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+    buckets[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local tokens = buckets[i]
+    if wait == 0 then
+        tokens = tokens - 1
+    end
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', key, ttl)
+end
+return tostring(wait)
+"""
+
+# KEYS - бакеты, ARGV - направление, шаг роста, множитель снижения,
+# минимальная скорость, пауза между снижениями, время жизни и скорости.
+ADAPT_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local increase = ARGV[1] == '1'
+local step = tonumber(ARGV[2])
+local factor = tonumber(ARGV[3])
+local min_rate = tonumber(ARGV[4])
+local cooldown = tonumber(ARGV[5])
+local ttl = tonumber(ARGV[6])
+for i, key in ipairs(KEYS) do
+    local max_rate = tonumber(ARGV[i + 6])
+    local bucket = redis.call('HMGET', key, 'rate', 'decreased_at')
+    local rate = math.min(tonumber(bucket[1]) or max_rate, max_rate)
+    if increase then
+        redis.call('HSET', key, 'rate', math.min(max_rate, rate + step))
+    elseif now - (tonumber(bucket[2]) or 0) >= cooldown then
+        redis.call(
+            'HSET', key,
+            'rate', math.max(min_rate, rate * factor),
+            'decreased_at', now
+        )
+    end
+    redis.call('EXPIRE', key, ttl)
+end
+"""
+
+
+def is_throttled(status_code):
+    """Проверяет, что ответ API означает перегрузку провайдера."""
+    return status_code == 429 or status_code >= 500
+
+
+class TokenBucketRateLimiter(abc.ABC):
+    """Ограничитель частоты запросов к провайдеру отправки.
+
+    Запрос проходит через общий бакет провайдера и, если для кода
+    оператора задан свой лимит, через бакет оператора. Скорость бакетов
+    снижается в разы при ответах 429 и 5xx и постепенно возвращается к
+    заданной при успешных ответах. Успешные ответы копятся в процессе и
+    повышают скорость одним обращением к бакетам на
+    SEND_RATE_LIMIT_REPORT_BATCH ответов.
+    """
+
+    def __init__(self, provider, rate, burst, operator_rates=None):
+        self.provider = provider
+        self.rate = rate
+        self.burst = burst
+        self.operator_rates = operator_rates or {}
+        self.successes = Counter()
+        self.successes_lock = threading.Lock()
+
+    def get_buckets(self, code_operator):
+        """Возвращает ключи и предельные скорости бакетов запроса."""
+        buckets = ((f'send_rate:{self.provider}', self.rate),)
+        operator_rate = self.operator_rates.get(code_operator)
+        if operator_rate:
+            buckets += (
+                (f'send_rate:{self.provider}:{code_operator}', operator_rate),
+            )
+        return buckets
+
+    def acquire(self, code_operator=None):
+        """Забирает токен и возвращает 0 или время ожидания токена."""
+        if not self.rate:
+            return 0
+        return self.take(self.get_buckets(code_operator))
+
+    def wait(self, code_operator=None, timeout=None):
+        """Ждет токен не дольше timeout секунд и сообщает, получен ли он."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.acquire(code_operator)
+            if not delay:
+                return True
+            if deadline is not None and time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+
+    async def wait_async(self, code_operator=None):
+        """Ждет токен, не блокируя цикл событий.
+
+        Токен забирается в потоке пула, ожидание - через asyncio.sleep.
+        """
+        while True:
+            delay = await asyncio.to_thread(self.acquire, code_operator)
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    def report(self, code_operator, status_code):
+        """Подстраивает скорость бакетов под ответ API."""
+        if not self.rate or status_code is None:
+            return
+        buckets = self.get_buckets(code_operator)
+        if status_code == 200:
+            with self.successes_lock:
+                self.successes[buckets] += 1
+                successes = self.successes[buckets]
+                if successes < settings.SEND_RATE_LIMIT_REPORT_BATCH:
+                    return
+                del self.successes[buckets]
+            self.adapt(buckets, increase=True, successes=successes)
+        elif is_throttled(status_code):
+            with self.successes_lock:
+                self.successes.pop(buckets, None)
+            self.adapt(buckets, increase=False)
+
+    @abc.abstractmethod
+    def take(self, buckets):
+        """Забирает токен из всех бакетов и возвращает 0 или ожидание."""
+
+    @abc.abstractmethod
+    def adapt(self, buckets, increase, successes=1):
+        """Повышает скорость бакетов на successes шагов или снижает ее."""
+
+
+class RedisRateLimiter(TokenBucketRateLimiter):
+    """Ограничитель частоты с бакетами в Redis, общими для всех воркеров.
+
+    При недоступности Redis запросы не ограничиваются.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquire_script = get_redis().register_script(ACQUIRE_SCRIPT)
+        self.adapt_script = get_redis().register_script(ADAPT_SCRIPT)
+
+    def take(self, buckets):
+        keys, rates = zip(*buckets)
+        try:
+            return float(self.acquire_script(
+                keys=keys, args=[self.burst, BUCKET_TTL, *rates]
+            ))
+        except redis.RedisError as e:
+            message_logger.warning(
+                'Ограничитель частоты отправки недоступен: %r', e
+            )
+            return 0
+
+    def adapt(self, buckets, increase, successes=1):
+        keys, rates = zip(*buckets)
+        try:
+            self.adapt_script(keys=keys, args=[
+                int(increase),
+                settings.SEND_RATE_LIMIT_INCREASE * successes,
+                settings.SEND_RATE_LIMIT_DECREASE,
+                settings.SEND_RATE_LIMIT_MIN,
+                settings.SEND_RATE_LIMIT_COOLDOWN,
+                BUCKET_TTL,
+                *rates
+            ])
+        except redis.RedisError as e:
+            message_logger.warning(
+                'Ограничитель частоты отправки недоступен: %r', e
+            )
+
+
+class LocalRateLimiter(TokenBucketRateLimiter):
+    """Ограничитель частоты с бакетами в памяти процесса.
+
+    Подходит для тестов и запуска с одним воркером.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def get_bucket(self, key, max_rate):
+        bucket = self.buckets.setdefault(key, {
+            'tokens': self.burst,
+            'ts': time.monotonic(),
+            'rate': max_rate,
+            'decreased_at': 0,
+        })
+        bucket['rate'] = min(bucket['rate'], max_rate)
+        return bucket
+
+    def take(self, buckets):
+        with self.lock:
+            now = time.monotonic()
+            wait = 0
+            states = []
+            for key, max_rate in buckets:
+                bucket = self.get_bucket(key, max_rate)
+                bucket['tokens'] = min(
+                    self.burst,
+                    bucket['tokens']
+                    + max(0, now - bucket['ts']) * bucket['rate']
+                )
+                bucket['ts'] = now
+                if bucket['tokens'] < 1:
+                    wait = max(
+                        wait, (1 - bucket['tokens']) / bucket['rate']
+                    )
+                states.append(bucket)
+            if not wait:
+                for bucket in states:
+                    bucket['tokens'] -= 1
+            return wait
+
+    def adapt(self, buckets, increase, successes=1):
+        with self.lock:
+            now = time.monotonic()
+            for key, max_rate in buckets:
+                bucket = self.get_bucket(key, max_rate)
+                if increase:
+                    bucket['rate'] = min(
+                        max_rate,
+                        bucket['rate']
+                        + settings.SEND_RATE_LIMIT_INCREASE * successes
+                    )
+                elif (
+                    now - bucket['decreased_at']
+                    >= settings.SEND_RATE_LIMIT_COOLDOWN
+                ):
+                    bucket['rate'] = max(
+                        settings.SEND_RATE_LIMIT_MIN,
+                        bucket['rate'] * settings.SEND_RATE_LIMIT_DECREASE
+                    )
+                    bucket['decreased_at'] = now
+
+
+RATE_LIMITER_BACKENDS = {
+    'redis': RedisRateLimiter,
+    'memory': LocalRateLimiter,
+}
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """Возвращает ограничитель частоты запросов к API отправки."""
+    global _rate_limiter
+    if _rate_limiter is None:
+        backend = RATE_LIMITER_BACKENDS[settings.SEND_RATE_LIMIT_BACKEND]
+        _rate_limiter = backend(
+            provider=urlparse(settings.SEND_API_URL).netloc,
+            rate=settings.SEND_RATE_LIMIT,
+            burst=settings.SEND_RATE_LIMIT_BURST,
+            operator_rates=settings.SEND_RATE_LIMITS_BY_OPERATOR,
+        )
+    return _rate_limiter
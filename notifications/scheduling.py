@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+from .timezones import get_timezone
+
+
+def get_send_time(mailing, timezone_name, now=None):
+    """Возвращает время отправки для клиентов из заданного часового пояса.
+
+    Если у рассылки не задан временной интервал или локальное время уже
+    входит в него, возвращает None. Иначе возвращает ближайшее начало
+    интервала по местному времени.
+    """
+    if mailing.start_time is None or mailing.end_time is None:
+        return None
+
+    client_timezone = get_timezone(timezone_name)
+    local_now = (now or timezone.now()).astimezone(client_timezone)
+    current_time = local_now.time()
+    if mailing.start_time <= current_time <= mailing.end_time:
+        return None
+
+    send_date = local_now.date()
+    if current_time > mailing.end_time:
+        send_date += timedelta(days=1)
+    return client_timezone.normalize(
+        client_timezone.localize(
+            datetime.combine(send_date, mailing.start_time)
+        )
+    )
+
+
+def get_send_times(mailing, timezone_names, now=None):
+    """Возвращает время отправки для каждого из часовых поясов.
+
+    Время вычисляется один раз на пояс относительно общего момента now.
+    """
+    now = now or timezone.now()
+    return {
+        timezone_name: get_send_time(mailing, timezone_name, now)
+        for timezone_name in set(timezone_names)
+    }
+
+
+def group_timezones_by_send_time(mailing, timezone_names, now=None):
+    """Группирует часовые пояса по времени отправки сообщений рассылки."""
+    timezones_by_send_time = {}
+    send_times = get_send_times(mailing, timezone_names, now)
+    for timezone_name, send_time in sorted(send_times.items()):
+        timezones_by_send_time.setdefault(send_time, []).append(
+            timezone_name
+        )
+    return timezones_by_send_time
+
+
+def get_planned_send_time(mailing, timezone_name, now=None):
+    """Возвращает плановое время первой отправки сообщения клиенту.
+
+    Это начало рассылки или, если у рассылки задан временной интервал и
+    он начался позже, начало текущего интервала по местному времени.
+    """
+    if mailing.start_time is None:
+        return mailing.start_date
+
+    client_timezone = get_timezone(timezone_name)
+    local_now = (now or timezone.now()).astimezone(client_timezone)
+    window_start = client_timezone.normalize(
+        client_timezone.localize(
+            datetime.combine(local_now.date(), mailing.start_time)
+        )
+    )
+    return max(mailing.start_date, window_start)
@@ -3,12 +3,35 @@ from rest_framework import serializers
 from .models import Client, Mailing, Message
 
 
+def serialize_values(serializer, rows, fields):
+    """Сериализует словари из QuerySet.values() полями сериализатора.
+
+    Поля сериализатора привязываются один раз на весь список, а не на
+    каждый объект, что заметно быстрее ModelSerializer(many=True).
+    """
+    converters = [
+        (
+            field,
+            serializer.fields[field].source,
+            serializer.fields[field].to_representation
+        )
+        for field in fields
+    ]
+    return [
+        {
+            field: None if row[source] is None else convert(row[source])
+            for field, source, convert in converters
+        }
+        for row in rows
+    ]
+
+
 class ClientSerializer(serializers.ModelSerializer):
     """Сериализатор модели клиента."""
 
     class Meta:
         model = Client
-        fields = '__all__'
+        exclude = ('is_deleting',)
 
     def validate(self, attrs):
         phone_number = attrs.get('phone_number')
@@ -37,6 +60,7 @@ class MailingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Mailing
         fields = '__all__'
+        read_only_fields = ('version', 'state')
 
     def validate(self, attrs):
         start_date = attrs.get('start_date')
@@ -1,9 +1,21 @@
+import csv
+import gzip
 import os
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.core.mail import send_mail
+from django.core.mail import send_mail, send_mass_mail
+from django.db import connection, transaction
+from django.db.models import (
+    Count, Exists, F, Max, OuterRef, Q, Subquery, Value
+)
+from django.db.models.functions import Greatest
 from django.utils import timezone
-from notifications.models import Mailing
+from notifications.models import (
+    Mailing, MailingState, MailingStats, Message, MessageStatus
+)
+from notifications.statistics import (
+    FAILED, PENDING, get_bucket_statuses, update_mailing_stats
+)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,39 +32,438 @@ class SendStatisticEmail(BaseCommand):
         try:
             previous_day_start = timezone.now() - timezone.timedelta(days=1)
             previous_day_end = timezone.now()
+            previous_day = (previous_day_start, previous_day_end)
 
-            mailings = Mailing.objects.filter(
-                messages__send_date__range=(
-                    previous_day_start, previous_day_end
-                )
-            ).distinct()
+            active_mailings = Message.objects.filter(
+                send_date__range=previous_day
+            ).values('mailing_id')
 
-            for mailing in mailings:
-                successful_mailings_count = mailing.messages.filter(
-                    status=200,
-                    send_date__gte=previous_day_start,
-                    send_date__lte=previous_day_end
-                ).count()
+            statistics = list(
+                Message.objects.filter(mailing_id__in=active_mailings)
+                .values('mailing_id')
+                .annotate(
+                    day_successful_messages=Count(
+                        'id',
+                        filter=Q(
+                            status=MessageStatus.SENT,
+                            send_date__range=previous_day
+                        )
+                    ),
+                    total_messages=Count('id'),
+                    successful_messages=Count(
+                        'id', filter=Q(status=MessageStatus.SENT)
+                    ),
+                    failed_messages=Count(
+                        'id', filter=Q(status__in=get_bucket_statuses(FAILED))
+                    ),
+                    pending_messages=Count(
+                        'id',
+                        filter=Q(status__in=get_bucket_statuses(PENDING))
+                    ),
+                )
+                .order_by('mailing_id')
+            )
 
-                self.send_statistics(mailing, successful_mailings_count)
+            if statistics:
+                self.send_statistics(statistics)
 
             self.stdout.write(self.style.SUCCESS('Статистика отправлена'))
 
         except Exception as e:
             self.stderr.write(self.style.ERROR(f'Error: {e}'))
 
-    def send_statistics(self, mailing, successful_mailings_count):
-        """Отправляет статистику по рассылке на заданные email."""
-        subject = f'Статистика по рассылке номер {mailing.id}'
-        message = (
-            f'За сутки - {successful_mailings_count} '
-            f'успешно отправленных сообщений.'
-        )
+    def send_statistics(self, statistics):
+        """Отправляет статистику по рассылкам на заданные email.
 
-        send_mail(
-            subject,
-            message,
-            settings.EMAIL_HOST_USER,
-            email_list,
+        При включенной настройке MAILING_STATISTIC_DIGEST отправляется одно
+        письмо по всем рассылкам, иначе по письму на рассылку через одно
+        SMTP-соединение.
+        """
+        if settings.MAILING_STATISTIC_DIGEST:
+            send_mail(
+                'Статистика по рассылкам за сутки',
+                '\n'.join(
+                    f'Рассылка номер {row["mailing_id"]}. '
+                    f'{self.get_statistic_text(row)}'
+                    for row in statistics
+                ),
+                settings.EMAIL_HOST_USER,
+                email_list,
+                fail_silently=False,
+            )
+            return
+
+        send_mass_mail(
+            [
+                (
+                    f'Статистика по рассылке номер {row["mailing_id"]}',
+                    self.get_statistic_text(row),
+                    settings.EMAIL_HOST_USER,
+                    email_list,
+                )
+                for row in statistics
+            ],
             fail_silently=False,
         )
+
+    @staticmethod
+    def get_statistic_text(row):
+        """Возвращает текст статистики по одной рассылке.
+
+        Отправленные за сутки сообщения считаются по дате отправки,
+        остальные счетчики - по всем сообщениям рассылки.
+        """
+        return (
+            f'За сутки - {row["day_successful_messages"]} '
+            f'успешно отправленных сообщений. '
+            f'Всего сообщений - {row["total_messages"]}: '
+            f'отправлено - {row["successful_messages"]}, '
+            f'не отправлено - {row["failed_messages"]}, '
+            f'ожидают отправки - {row["pending_messages"]}.'
+        )
+
+
+def delete_in_chunks(queryset, on_delete=None):
+    """Удаляет строки выборки пачками по id и возвращает их число.
+
+    Каждая пачка удаляется отдельным DELETE по диапазону id, поэтому
+    блокировки держатся недолго, а строки не загружаются в память. Если
+    передан on_delete, он вызывается с выборкой пачки перед ее удалением
+    в той же транзакции.
+    """
+    deleted = 0
+    chunk_size = settings.MESSAGE_DELETE_CHUNK_SIZE
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    while True:
+        last_id = ids[chunk_size - 1:chunk_size].first()
+        chunk = queryset
+        if last_id is not None:
+            chunk = queryset.filter(id__lte=last_id)
+        with transaction.atomic():
+            if on_delete is not None:
+                on_delete(chunk)
+            deleted += chunk.delete()[0]
+        if last_id is None:
+            return deleted
+
+
+def expire_unsent_messages(mailing_id):
+    """Завершает неотправленные сообщения рассылки и возвращает их число.
+
+    Сообщения в очереди и отложенные, в том числе автоматом отправки,
+    получают статус failed, если попытки были, и expired, если нет.
+    Сообщения обновляются пачками по id, счетчики рассылки меняются в
+    транзакции каждой пачки. Сообщения, которые отправляются сейчас,
+    не изменяются.
+    """
+    expired = 0
+    after_id = 0
+    unsent = Message.objects.filter(
+        mailing_id=mailing_id,
+        status__in=[MessageStatus.QUEUED, MessageStatus.DEFERRED]
+    )
+    while True:
+        ids = list(
+            unsent.filter(id__gt=after_id)
+            .order_by('id')
+            .values_list('id', flat=True)[
+                :settings.MAILING_DISPATCH_CHUNK_SIZE
+            ]
+        )
+        if not ids:
+            return expired
+        with transaction.atomic():
+            chunk = unsent.filter(id__in=ids)
+            chunk_expired = chunk.filter(attempts__gt=0).update(
+                status=MessageStatus.FAILED,
+                next_attempt_at=None,
+                parked=False
+            ) + chunk.filter(attempts=0).update(
+                status=MessageStatus.EXPIRED,
+                next_attempt_at=None,
+                parked=False
+            )
+            update_mailing_stats(
+                mailing_id, transitions=[(PENDING, FAILED)] * chunk_expired
+            )
+        expired += chunk_expired
+        after_id = ids[-1]
+
+
+def count_mailing_stats(messages):
+    """Возвращает счетчики статистики по рассылкам сообщений."""
+    statistics = (
+        messages.values('mailing_id')
+        .annotate(
+            total=Count('id'),
+            successful=Count('id', filter=Q(status=MessageStatus.SENT)),
+            pending=Count(
+                'id', filter=Q(status__in=get_bucket_statuses(PENDING))
+            ),
+            last_sent_at=Max('send_date'),
+        )
+        .order_by('mailing_id')
+    )
+    for row in statistics.iterator():
+        row['failed'] = row['total'] - row['successful'] - row['pending']
+        yield row
+
+
+def subtract_mailing_stats(messages):
+    """Вычитает сообщения выборки из счетчиков их рассылок.
+
+    Счетчики всех рассылок выборки обновляются одним UPDATE: число
+    сообщений рассылки в каждом счетчике считает подзапрос. Счетчики
+    рассылок, сообщения которых выгружены в архив, не меняются.
+    """
+    mailing_messages = (
+        messages.filter(mailing_id=OuterRef('mailing_id'))
+        .order_by()
+        .values('mailing_id')
+    )
+
+    def count(**filters):
+        return Subquery(
+            mailing_messages.annotate(count=Count('id', filter=Q(**filters)))
+            .values('count')
+        )
+
+    MailingStats.objects.filter(
+        mailing_id__in=messages.values('mailing_id'), archived=False
+    ).update(**{
+        field: Greatest(F(field) - field_count, Value(0))
+        for field, field_count in (
+            ('total', count()),
+            ('successful', count(status=MessageStatus.SENT)),
+            ('failed', count(status__in=get_bucket_statuses(FAILED))),
+            ('pending', count(status__in=get_bucket_statuses(PENDING))),
+        )
+    })
+
+
+def get_status_rank(status):
+    """Возвращает ранг статуса сообщения: чем больше, тем лучше.
+
+    Понимает и прежние статусы - коды ответа API, где 0 означает, что
+    сообщение еще не отправлялось.
+    """
+    status = str(status)
+    if status in (MessageStatus.SENT, '200'):
+        return 2
+    if status in get_bucket_statuses(PENDING) or status == '0':
+        return 1
+    return 0
+
+
+class DeduplicateMessages(BaseCommand):
+    """Сервис удаления повторных сообщений клиенту в одной рассылке.
+
+    Запускается перед миграцией, которая добавляет уникальность пары
+    рассылка - клиент. Из повторов остается сообщение с лучшим статусом,
+    а при равных статусах - последнее созданное. Команда читает только
+    поля, которые были у сообщения до смены статусов, поэтому работает и
+    со старой схемой базы.
+    """
+
+    help = 'Удаление повторных сообщений клиенту в рассылке.'
+
+    def handle(self, *args, **kwargs):
+        if Message._meta.db_table not in (
+            connection.introspection.table_names()
+        ):
+            return
+
+        duplicates = list(
+            Message.objects.values('mailing_id', 'client_id')
+            .annotate(count=Count('id'))
+            .filter(count__gt=1)
+            .order_by()
+        )
+        deleted = 0
+        redundant_ids = []
+        for duplicate in duplicates:
+            messages = list(
+                Message.objects.filter(
+                    mailing_id=duplicate['mailing_id'],
+                    client_id=duplicate['client_id']
+                ).values_list('id', 'status')
+            )
+            best_id, _ = max(
+                messages,
+                key=lambda message: (get_status_rank(message[1]), message[0])
+            )
+            redundant_ids.extend(
+                message_id for message_id, _ in messages
+                if message_id != best_id
+            )
+            if len(redundant_ids) >= settings.MESSAGE_DELETE_CHUNK_SIZE:
+                deleted += self.delete_messages(redundant_ids)
+                redundant_ids = []
+        deleted += self.delete_messages(redundant_ids)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Удалено {deleted} повторных сообщений '
+            f'для {len(duplicates)} клиентов'
+        ))
+
+    @staticmethod
+    def delete_messages(message_ids):
+        if not message_ids:
+            return 0
+        return Message.objects.filter(id__in=message_ids).delete()[0]
+
+
+class ConvertMessageStatuses(BaseCommand):
+    """Сервис перевода прежних статусов сообщений в новые.
+
+    Раньше статусом сообщения был код ответа API: 200 - доставлено, 0 -
+    еще не отправлялось, остальные коды - ошибка запроса. Недоставленные
+    сообщения закончившихся рассылок получают окончательный статус,
+    остальные откладываются до текущего времени, и их ставит в очередь
+    reschedule_deferred_messages. Затем счетчики рассылок
+    пересчитываются.
+    """
+
+    help = 'Перевод прежних статусов сообщений - кодов ответа API.'
+
+    def handle(self, *args, **kwargs):
+        now = timezone.now()
+        messages = Message.objects.exclude(status__in=MessageStatus.values)
+        ended = Q(mailing__end_date__lt=now)
+
+        with transaction.atomic():
+            converted = messages.filter(status='200').update(
+                status=MessageStatus.SENT, attempts=1
+            )
+            converted += messages.filter(ended, status='0').update(
+                status=MessageStatus.EXPIRED
+            )
+            converted += messages.filter(status='0').update(
+                status=MessageStatus.DEFERRED, next_attempt_at=now
+            )
+            # Код ответа переносится в last_error до смены статуса
+            converted += messages.filter(ended).update(
+                last_error=F('status'), status=MessageStatus.FAILED,
+                attempts=1
+            )
+            converted += messages.update(
+                last_error=F('status'), status=MessageStatus.DEFERRED,
+                attempts=1, next_attempt_at=now
+            )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Переведено {converted} сообщений с прежними статусами'
+        ))
+        if converted:
+            RebuildMailingStats(
+                stdout=self.stdout, stderr=self.stderr
+            ).handle()
+
+
+class RebuildMailingStats(BaseCommand):
+    """Сервис пересчета счетчиков статистики рассылок с нуля.
+
+    Счетчики рассылок, сообщения которых выгружены в архив, не
+    пересчитываются.
+    """
+
+    help = 'Пересчет счетчиков статистики рассылок по сообщениям.'
+
+    def handle(self, *args, **kwargs):
+        messages = Message.objects.exclude(mailing__stats__archived=True)
+
+        with transaction.atomic():
+            MailingStats.objects.filter(archived=False).delete()
+            MailingStats.objects.bulk_create(
+                (
+                    MailingStats(**row)
+                    for row in count_mailing_stats(messages)
+                ),
+                batch_size=1000
+            )
+
+        self.stdout.write(self.style.SUCCESS('Статистика пересчитана'))
+
+
+class ArchiveMessages(BaseCommand):
+    """Сервис выгрузки сообщений закончившихся рассылок в архив.
+
+    Сообщения каждой рассылки записываются в файл mailing_<id>.csv.gz в
+    MESSAGE_ARCHIVE_DIR и удаляются из базы пачками. Счетчики рассылки
+    пересчитываются перед удалением и дальше не меняются.
+    """
+
+    help = 'Выгрузка в архив сообщений закончившихся рассылок.'
+
+    columns = (
+        'id', 'mailing_id', 'client_id', 'status', 'attempts', 'last_error',
+        'send_date'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            help='Выгружать рассылки, закончившиеся больше дней назад.'
+        )
+
+    def handle(self, *args, **kwargs):
+        days = kwargs.get('days')
+        if days is None:
+            days = settings.MESSAGE_RETENTION_DAYS
+        finished_before = timezone.now() - timezone.timedelta(days=days)
+        mailing_ids = list(
+            Mailing.objects.filter(
+                Exists(Message.objects.filter(mailing=OuterRef('pk'))),
+                end_date__lt=finished_before,
+            )
+            .exclude(state=MailingState.DELETING)
+            .order_by('id')
+            .values_list('id', flat=True)
+        )
+
+        os.makedirs(settings.MESSAGE_ARCHIVE_DIR, exist_ok=True)
+        archived = sum(
+            self.archive_mailing(mailing_id) for mailing_id in mailing_ids
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f'В архив выгружено {archived} сообщений '
+            f'из {len(mailing_ids)} рассылок'
+        ))
+
+    def archive_mailing(self, mailing_id):
+        """Выгружает и удаляет сообщения рассылки, возвращает их число.
+
+        Если выгрузка прервалась после пересчета счетчиков, повторный
+        запуск только удаляет оставшиеся сообщения.
+        """
+        messages = Message.objects.filter(mailing_id=mailing_id)
+        if not MailingStats.objects.filter(
+            mailing_id=mailing_id, archived=True
+        ).exists():
+            self.write_archive(mailing_id, messages)
+            with transaction.atomic():
+                for row in count_mailing_stats(messages):
+                    MailingStats.objects.update_or_create(
+                        mailing_id=mailing_id,
+                        defaults={**row, 'archived': True}
+                    )
+
+        return delete_in_chunks(messages)
+
+    def write_archive(self, mailing_id, messages):
+        """Записывает сообщения рассылки в сжатый CSV-файл."""
+        path = os.path.join(
+            settings.MESSAGE_ARCHIVE_DIR, f'mailing_{mailing_id}.csv.gz'
+        )
+        rows = messages.order_by('id').values_list(*self.columns).iterator(
+            chunk_size=settings.MESSAGE_ARCHIVE_CHUNK_SIZE
+        )
+        with gzip.open(
+            f'{path}.tmp', 'wt', encoding='utf-8', newline=''
+        ) as archive:
+            writer = csv.writer(archive)
+            writer.writerow(self.columns)
+            writer.writerows(rows)
+        os.replace(f'{path}.tmp', path)
@@ -0,0 +1,11 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Mailing
+from .state import invalidate_mailing_state
+
+
+@receiver([post_save, post_delete], sender=Mailing)
+def invalidate_mailing_cache(sender, instance, **kwargs):
+    """Сбрасывает кешированное воркерами состояние измененной рассылки."""
+    invalidate_mailing_state(instance.id)
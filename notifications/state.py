@@ -0,0 +1,149 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import redis
+from django.conf import settings
+
+from .models import Mailing
+
+mailing_logger = logging.getLogger('mailing')
+
+# stamp меняется при каждой публикации, то есть при любом изменении
+# рассылки, и по нему проверяются снимки рассылок в кеше процесса
+MailingStamp = namedtuple('MailingStamp', ['state', 'version', 'stamp'])
+
+_redis = None
+
+# Состояния рассылок, прочитанные процессом: id -> (годно до, значение)
+_mailing_states = {}
+
+# Снимки рассылок процесса: id -> (метка, годен до, рассылка)
+_mailings = OrderedDict()
+_mailings_lock = threading.Lock()
+
+
+def get_redis():
+    """Возвращает общий для процесса клиент Redis.
+
+    Redis хранит состояние, которое должно быть общим для всех воркеров.
+    """
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(settings.REDIS_URL)
+    return _redis
+
+
+def get_mailing_state_key(mailing_id):
+    return f'mailing_state:{mailing_id}'
+
+
+def set_mailing_state(mailing, only_missing=False):
+    """Публикует состояние и версию рассылки для воркеров.
+
+    С only_missing значение записывается, только если его еще нет, чтобы
+    прочитанное из базы состояние не затерло опубликованное позже.
+    """
+    mailing_state = MailingStamp(
+        mailing.state, mailing.version, str(time.time_ns())
+    )
+    _mailing_states.pop(mailing.id, None)
+    try:
+        get_redis().set(
+            get_mailing_state_key(mailing.id),
+            ':'.join(map(str, mailing_state)),
+            ex=settings.MAILING_STATE_TTL,
+            nx=only_missing
+        )
+    except redis.RedisError as e:
+        mailing_logger.warning('Состояние рассылок недоступно: %r', e)
+    return mailing_state
+
+
+def invalidate_mailing_state(mailing_id):
+    """Сбрасывает опубликованное состояние рассылки после ее изменения.
+
+    Воркеры перечитают состояние из базы с новой меткой и обновят
+    снимок рассылки.
+    """
+    _mailing_states.pop(mailing_id, None)
+    try:
+        get_redis().delete(get_mailing_state_key(mailing_id))
+    except redis.RedisError as e:
+        mailing_logger.warning('Состояние рассылок недоступно: %r', e)
+
+
+def is_fresh(mailing_state, version):
+    """Проверяет, что состояние не старше версии задачи."""
+    return mailing_state is not None and (
+        version is None or mailing_state.version >= version
+    )
+
+
+def get_mailing_state(mailing_id, version=None):
+    """Возвращает состояние рассылки или None, если ее нет.
+
+    Значение кешируется в процессе на MAILING_STATE_CACHE_TTL секунд и
+    читается из Redis, а если там его нет или оно старше версии задачи
+    version - из базы.
+    """
+    now = time.monotonic()
+    cached = _mailing_states.get(mailing_id)
+    if cached is not None and cached[0] > now and (
+        cached[1] is None or is_fresh(cached[1], version)
+    ):
+        return cached[1]
+
+    mailing_state = None
+    try:
+        value = get_redis().get(get_mailing_state_key(mailing_id))
+    except redis.RedisError as e:
+        mailing_logger.warning('Состояние рассылок недоступно: %r', e)
+        value = None
+    if value is not None:
+        state, current_version, stamp = value.decode().split(':')
+        mailing_state = MailingStamp(state, int(current_version), stamp)
+
+    if not is_fresh(mailing_state, version):
+        mailing = Mailing.objects.filter(id=mailing_id).only(
+            'state', 'version'
+        ).first()
+        if mailing is not None:
+            mailing_state = set_mailing_state(
+                mailing, only_missing=mailing_state is None
+            )
+        else:
+            mailing_state = None
+
+    _mailing_states[mailing_id] = (
+        now + settings.MAILING_STATE_CACHE_TTL, mailing_state
+    )
+    return mailing_state
+
+
+def get_mailing(mailing_id, version=None):
+    """Возвращает снимок рассылки из кеша процесса.
+
+    Снимок годен MAILING_CACHE_TTL секунд, пока метка состояния рассылки
+    не изменилась, в кеше хранится до MAILING_CACHE_SIZE последних
+    рассылок. Снимок общий для задач процесса, изменять его нельзя.
+    """
+    mailing_state = get_mailing_state(mailing_id, version)
+    stamp = mailing_state.stamp if mailing_state is not None else None
+    now = time.monotonic()
+    with _mailings_lock:
+        cached = _mailings.get(mailing_id)
+        if cached is not None and cached[0] == stamp and cached[1] > now:
+            _mailings.move_to_end(mailing_id)
+            return cached[2]
+
+    mailing = Mailing.objects.get(id=mailing_id)
+    with _mailings_lock:
+        _mailings[mailing_id] = (
+            stamp, now + settings.MAILING_CACHE_TTL, mailing
+        )
+        _mailings.move_to_end(mailing_id)
+        while len(_mailings) > settings.MAILING_CACHE_SIZE:
+            _mailings.popitem(last=False)
+    return mailing
@@ -0,0 +1,64 @@
+from collections import Counter
+
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import MailingStats, MessageStatus
+
+SUCCESSFUL = 'successful'
+FAILED = 'failed'
+PENDING = 'pending'
+
+# Счетчики статистики для статусов сообщения
+STATUS_BUCKETS = {
+    MessageStatus.QUEUED: PENDING,
+    MessageStatus.DEFERRED: PENDING,
+    MessageStatus.SENDING: PENDING,
+    MessageStatus.SENT: SUCCESSFUL,
+    MessageStatus.FAILED: FAILED,
+    MessageStatus.EXPIRED: FAILED,
+}
+
+
+def get_bucket_statuses(bucket):
+    """Возвращает статусы сообщений, которые учитываются в счетчике."""
+    return [
+        status for status, status_bucket in STATUS_BUCKETS.items()
+        if status_bucket == bucket
+    ]
+
+
+def get_stats_bucket(message):
+    """Возвращает счетчик статистики, к которому относится сообщение."""
+    return STATUS_BUCKETS[message.status]
+
+
+def update_mailing_stats(mailing_id, created=0, transitions=(),
+                         last_sent_at=None):
+    """Применяет изменения к счетчикам рассылки одним UPDATE.
+
+    created - число новых сообщений, transitions - пары счетчиков
+    (до, после) для сообщений, сменивших статус. Счетчики изменяются
+    через F-выражения, поэтому одновременные обновления из разных
+    воркеров не теряются.
+    """
+    deltas = Counter({'total': created, PENDING: created})
+    for old_bucket, new_bucket in transitions:
+        if old_bucket != new_bucket:
+            deltas[old_bucket] -= 1
+            deltas[new_bucket] += 1
+
+    updates = {
+        field: F(field) + delta for field, delta in deltas.items() if delta
+    }
+    if last_sent_at is not None:
+        updates['last_sent_at'] = Greatest(
+            Coalesce('last_sent_at', Value(last_sent_at)), Value(last_sent_at)
+        )
+    if not updates:
+        return
+
+    stats = MailingStats.objects.filter(mailing_id=mailing_id)
+    if not stats.update(**updates):
+        MailingStats.objects.get_or_create(mailing_id=mailing_id)
+        stats.update(**updates)
@@ -1,179 +1,908 @@
-from datetime import datetime, timedelta
-import pytz
+from datetime import timedelta
+from functools import partial
+import random
+import time
 import requests
 import logging
-import time
 from celery import shared_task, group
 from celery.schedules import crontab
-from .models import Mailing, Message, Client
+from celery.signals import worker_process_shutdown, worker_shutdown
+from .models import (
+    MAX_PRIORITY, Client, Mailing, MailingState, Message, MessageStatus
+)
+from django.db import transaction
+from django.db.models import Count, Q
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.conf import settings
 
 from notification_service.celery import app as celery_app
 
-from .services import SendStatisticEmail
+from .buffers import STATUS_FIELDS, get_status_buffer
+from .delivery import deliver_messages, get_latency, send_message_request
+from .circuit import (
+    HALF_OPEN, OPEN, CircuitOpenError, get_circuit_breaker, is_failure
+)
+from .metrics import DISPATCH_SECONDS, observe_lag, observe_send
+from .ratelimit import get_rate_limiter
+from .scheduling import (
+    get_planned_send_time, get_send_time, get_send_times,
+    group_timezones_by_send_time
+)
+from .statistics import (
+    PENDING, get_bucket_statuses, get_stats_bucket, update_mailing_stats
+)
+from .state import get_mailing, get_mailing_state
+from .services import (
+    ArchiveMessages, SendStatisticEmail, delete_in_chunks,
+    subtract_mailing_stats
+)
 
 mailing_logger = logging.getLogger('mailing')
 message_logger = logging.getLogger('message')
 client_logger = logging.getLogger('client')
 
+LAST_ERROR_LENGTH = Message._meta.get_field('last_error').max_length
+# Статусы сообщений, которые могут остаться без задачи отправки
+RESCHEDULED_STATUSES = [MessageStatus.DEFERRED, MessageStatus.SENDING]
 
-@shared_task
-def send_messages_for_mailing(mailing_id):
-    """Запускает отправку сообщений клиентам рассылки."""
+
+def get_clients_chunk(clients, after_id=None):
+    """Возвращает следующую пачку клиентов по возрастанию id.
+
+    Пачки выбираются по условию id > after_id (keyset-пагинация), без
+    OFFSET и без загрузки всей выборки в память.
+    """
+    clients = clients.order_by('id').only('id', 'timezone')
+    if after_id is not None:
+        clients = clients.filter(id__gt=after_id)
+    return list(clients[:settings.MAILING_DISPATCH_CHUNK_SIZE])
+
+
+def is_stale(mailing, version):
+    """Проверяет, что задача поставлена для прежней версии рассылки.
+
+    Задачи неактивной рассылки тоже считаются устаревшими.
+    """
+    return mailing.state != MailingState.ACTIVE or (
+        version is not None and version != mailing.version
+    )
+
+
+def is_cancelled(mailing_id, version):
+    """Проверяет по кешу состояний, что задача рассылки больше не нужна.
+
+    Проверка не обращается к базе, пока состояние рассылки есть в кеше,
+    поэтому задачи отмененной рассылки снимаются с очереди сразу.
+    """
+    mailing_state = get_mailing_state(mailing_id, version)
+    if mailing_state is None:
+        return True
+    return mailing_state.state != MailingState.ACTIVE or (
+        version is not None and version != mailing_state.version
+    )
+
+
+def get_task_priority(mailing):
+    """Возвращает приоритет задач рассылки в брокере.
+
+    В Redis меньшее значение означает более высокий приоритет, а у
+    рассылки - наоборот.
+    """
+    return MAX_PRIORITY - mailing.priority
+
+
+def apply_at(task, eta, args=(), kwargs=None, priority=None):
+    """Ставит задачу в очередь на время eta.
+
+    Задача с eta не подтверждается до выполнения и по истечении
+    visibility_timeout передается другому воркеру. Поэтому в брокере
+    задача откладывается не дальше чем на CELERY_TASK_MAX_ETA секунд, а
+    более долгую отсрочку продлевает задача wait_until.
+    """
+    max_eta = timezone.now() + timedelta(seconds=settings.CELERY_TASK_MAX_ETA)
+    if eta is not None and eta > max_eta:
+        return wait_until.apply_async(
+            args=[task.name, eta.isoformat(), args, kwargs, priority],
+            eta=max_eta,
+            priority=priority
+        )
+    return task.apply_async(
+        args=args, kwargs=kwargs, eta=eta, priority=priority
+    )
+
+
+@shared_task(ignore_result=True)
+def wait_until(task_name, eta, args, kwargs, priority=None):
+    """Продлевает отсрочку задачи task_name до времени eta."""
+    apply_at(
+        celery_app.tasks[task_name], parse_datetime(eta),
+        args=args, kwargs=kwargs, priority=priority
+    )
+
+
+def build_message_tasks(mailing, clients):
+    """Формирует по одной задаче отправки на каждого клиента."""
+    priority = get_task_priority(mailing)
+    return [
+        send_message.s(
+            mailing.id, client.id, version=mailing.version
+        ).set(priority=priority)
+        for client in clients
+    ]
+
+
+def build_batch_tasks(mailing, clients):
+    """Формирует задачи пакетной отправки по MAILING_BATCH_SIZE клиентов."""
+    batch_size = settings.MAILING_BATCH_SIZE
+    priority = get_task_priority(mailing)
+    client_ids = [client.id for client in clients]
+    return [
+        send_message_batch.s(
+            mailing.id,
+            client_ids[start:start + batch_size],
+            version=mailing.version
+        ).set(priority=priority)
+        for start in range(0, len(client_ids), batch_size)
+    ]
+
+
+@shared_task(acks_late=True)
+@DISPATCH_SECONDS.labels('send_messages_for_mailing').time()
+def send_messages_for_mailing(mailing_id, version=None):
+    """Запускает отправку сообщений клиентам рассылки.
+
+    Клиенты делятся на волны по времени открытия интервала отправки в их
+    часовых поясах. Волны, интервал которых уже открыт, запускаются сразу,
+    остальные планируются на время открытия, поэтому число отложенных
+    задач зависит от числа поясов, а не клиентов. Итоги рассылки подводит
+    check_mailing_completion.
+
+    Задачи всех этапов несут версию рассылки и ничего не делают, если
+    рассылка была изменена, приостановлена или отменена после их
+    постановки.
+    """
     try:
+        if is_cancelled(mailing_id, version):
+            return
+        mailing = Mailing.objects.get(id=mailing_id)
+        if is_stale(mailing, version):
+            mailing_logger.info(
+                f'Запуск рассылки {mailing_id} версии {version} пропущен, '
+                f'актуальная версия {mailing.version}.'
+            )
+            return
+
+        timezone_names = (
+            Client.objects.for_mailing(mailing)
+            .order_by()
+            .values_list('timezone', flat=True)
+            .distinct()
+        )
+        waves = group_timezones_by_send_time(mailing, timezone_names)
+
+        mailing_logger.info(
+            f'Рассылка {mailing_id} началась, волн отправки: {len(waves)}.'
+        )
+        for send_time, wave_timezones in waves.items():
+            apply_at(
+                dispatch_mailing_wave, send_time,
+                args=[mailing_id, wave_timezones],
+                kwargs={'version': mailing.version},
+                priority=get_task_priority(mailing)
+            )
+
+        check_mailing_completion.apply_async(
+            args=[mailing_id],
+            kwargs={'version': mailing.version},
+            countdown=settings.MAILING_COMPLETION_CHECK_INTERVAL,
+            priority=get_task_priority(mailing)
+        )
+
+    except Exception as e:
+        mailing_logger.error(
+            f'В рассылке {mailing_id} произошла ошибка - {e}'
+        )
+
+
+@shared_task(acks_late=True)
+@DISPATCH_SECONDS.labels('dispatch_mailing_wave').time()
+def dispatch_mailing_wave(mailing_id, timezones, after_id=None,
+                          version=None):
+    """Ставит в очередь отправку сообщений клиентам волны рассылки.
+
+    За один запуск обрабатывается одна пачка клиентов, после чего задача
+    ставит в очередь следующую пачку, начиная с id последнего клиента.
+    Если воркер упадет, задача будет доставлена повторно и продолжит
+    волну с той же пачки. Если интервал отправки закрылся, пока волна
+    ставилась в очередь, волна переносится на его следующее открытие с
+    той же пачки, а не откладывает сообщения клиентов по одному.
+    """
+    try:
+        if is_cancelled(mailing_id, version):
+            return
         mailing = Mailing.objects.get(id=mailing_id)
+        if is_stale(mailing, version):
+            return
+        if timezone.now() > mailing.end_date:
+            mailing_logger.info(
+                f'Время действия рассылки {mailing_id} истекло. '
+                f'Отправка новых сообщений прекращена.'
+            )
+            return
 
-        if mailing.filter_tag and mailing.filter_code_operator:
-            clients = Client.objects.filter(
-                tag=mailing.filter_tag,
-                code_operator=mailing.filter_code_operator
-            )
-        elif mailing.filter_tag:
-            clients = Client.objects.filter(tag=mailing.filter_tag)
-        elif mailing.filter_code_operator:
-            clients = Client.objects.filter(
-                code_operator=mailing.filter_code_operator
-            )
-
-        mailing_logger.info(f'Рассылка {mailing_id} началась.')
-        tasks = []
-        for client in clients:
-            if timezone.now() > mailing.end_date:
-                mailing_logger.info(
-                    f'Время действия рассылки {mailing_id} истекло. '
-                    f'Отправка новых сообщений прекращена.'
+        waves = group_timezones_by_send_time(mailing, timezones)
+        for send_time, wave_timezones in waves.items():
+            if send_time is not None:
+                delay_mailing_wave(
+                    mailing, wave_timezones, after_id, send_time
                 )
-                break
-            send_time = calculate_send_time(mailing, client)
-            task = send_message.s(mailing.id, client.id)
-            if send_time:
-                task = task.set(eta=send_time)
-            tasks.append(task)
+        timezones = waves.get(None)
+        if not timezones:
+            return
+
+        clients = Client.objects.for_mailing(mailing).filter(
+            timezone__in=timezones
+        )
+        chunk = get_clients_chunk(clients, after_id=after_id)
+        if not chunk:
+            return
+
+        if settings.MAILING_DELIVERY_MODE == 'batch':
+            tasks = build_batch_tasks(mailing, chunk)
+        else:
+            tasks = build_message_tasks(mailing, chunk)
+        group(tasks).apply_async()
+
+        dispatch_mailing_wave.apply_async(
+            args=[mailing_id, timezones, chunk[-1].id],
+            kwargs={'version': version},
+            priority=get_task_priority(mailing)
+        )
+
+    except Exception as e:
+        mailing_logger.error(
+            f'В рассылке {mailing_id} произошла ошибка - {e}'
+        )
+
+
+def delay_mailing_wave(mailing, timezones, after_id, send_time):
+    """Переносит волну рассылки на время открытия интервала отправки.
+
+    Если интервал откроется после окончания рассылки, волна завершается.
+    """
+    if send_time > mailing.end_date:
+        mailing_logger.info(
+            f'Интервал отправки рассылки {mailing.id} для поясов '
+            f'{", ".join(timezones)} откроется после ее окончания. '
+            f'Отправка волны прекращена.'
+        )
+        return
+    mailing_logger.info(
+        f'Интервал отправки рассылки {mailing.id} для поясов '
+        f'{", ".join(timezones)} закрыт, волна перенесена на {send_time}.'
+    )
+    apply_at(
+        dispatch_mailing_wave, send_time,
+        args=[mailing.id, timezones, after_id],
+        kwargs={'version': mailing.version},
+        priority=get_task_priority(mailing)
+    )
+
+
+@shared_task
+def check_mailing_completion(mailing_id, version=None):
+    """Подводит итоги рассылки по статусам ее сообщений.
+
+    Пока есть неотправленные сообщения и рассылка не истекла, задача
+    перепланирует сама себя.
+    """
+    try:
+        if is_cancelled(mailing_id, version):
+            return
+        mailing = Mailing.objects.get(id=mailing_id)
+        if is_stale(mailing, version):
+            return
+        recipients_count = Client.objects.for_mailing(mailing).count()
 
-        task_group = group(tasks)
-        result = task_group.apply_async()
+        counts = mailing.messages.aggregate(
+            total=Count('id'),
+            successful=Count('id', filter=Q(status=MessageStatus.SENT)),
+            pending=Count(
+                'id', filter=Q(status__in=get_bucket_statuses(PENDING))
+            ),
+        )
 
-        while not result.ready():
-            time.sleep(60)
+        in_progress = (
+            counts['pending'] or counts['total'] < recipients_count
+        )
+        if in_progress and timezone.now() <= mailing.end_date:
+            check_mailing_completion.apply_async(
+                args=[mailing_id],
+                kwargs={'version': version},
+                countdown=settings.MAILING_COMPLETION_CHECK_INTERVAL,
+                priority=get_task_priority(mailing)
+            )
+            return
 
-        if result.successful():
+        if counts['successful'] == recipients_count:
             mailing_logger.info(
                 f'Все сообщения рассылки {mailing_id} успешно отправлены.'
             )
         else:
             mailing_logger.warning(
-                f'Несколько сообщений рассылки {mailing_id} не отправлены.'
+                f'Несколько сообщений рассылки {mailing_id} не отправлены. '
+                f'Отправлено {counts["successful"]} '
+                f'из {recipients_count}.'
             )
 
     except Exception as e:
         mailing_logger.error(
-            f'В рассылке {mailing_id} произошла ошибка - {e}'
+            f'Ошибка при подведении итогов рассылки {mailing_id} - {e}'
         )
 
 
-@shared_task
-def send_message(mailing_id, client_id):
-    """Отправляет сообщение клиенту."""
+def get_retry_time(mailing, attempts):
+    """Возвращает время следующей попытки отправки сообщения.
+
+    Задержка растет экспоненциально с числом попыток и содержит случайную
+    составляющую. Если попытка не успевает до конца рассылки, возвращает
+    None.
+    """
+    delay = min(
+        settings.SEND_RETRY_MAX_DELAY,
+        settings.SEND_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0)
+    )
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    retry_time = timezone.now() + timedelta(seconds=delay)
+    if retry_time > mailing.end_date:
+        return None
+    return retry_time
+
+
+def get_log_extra(message, **fields):
+    """Возвращает поля сообщения для структурированной записи журнала."""
+    return {
+        'mailing_id': message.mailing_id,
+        'message_id': message.id,
+        'client_id': message.client_id,
+        **fields
+    }
+
+
+def get_throttled_time(mailing):
+    """Возвращает время попытки сообщения, не дождавшегося токена отправки.
+
+    Если попытка не успевает до конца рассылки, возвращает None.
+    """
+    delay = settings.SEND_RATE_LIMIT_MAX_WAIT * random.uniform(1, 2)
+    retry_time = timezone.now() + timedelta(seconds=delay)
+    if retry_time > mailing.end_date:
+        return None
+    return retry_time
+
+
+def defer_message(message, next_attempt_at):
+    """Откладывает сообщение до времени следующей попытки.
+
+    Если попытка не успевает до конца рассылки (next_attempt_at - None),
+    сообщение не отправлено, а если попыток не было - истекло.
+    """
+    message.next_attempt_at = next_attempt_at
+    if next_attempt_at is not None:
+        message.status = MessageStatus.DEFERRED
+    elif message.attempts:
+        message.status = MessageStatus.FAILED
+    else:
+        message.status = MessageStatus.EXPIRED
+
+
+def set_last_error(message, error):
+    """Сохраняет текст последней ошибки отправки сообщения."""
+    message.last_error = str(error)[:LAST_ERROR_LENGTH]
+
+
+def mark_sent(message):
+    """Отмечает сообщение доставленным."""
+    message.status = MessageStatus.SENT
+    message.send_date = timezone.now()
+    message.next_attempt_at = None
+    message.last_error = ''
+
+
+def park_message(message, retry_after):
+    """Откладывает сообщение до восстановления API отправки.
+
+    Для отложенного сообщения задача не ставится: его возвращает в
+    отправку release_parked_messages.
+    """
+    message.status = MessageStatus.DEFERRED
+    message.parked = True
+    message.next_attempt_at = timezone.now() + timedelta(seconds=retry_after)
+
+
+def schedule_message(mailing, message):
+    """Ставит отправку сообщения в очередь на время next_attempt_at."""
+    apply_at(
+        send_message, message.next_attempt_at,
+        args=[mailing.id, message.client_id],
+        kwargs={'message_id': message.id, 'version': mailing.version},
+        priority=get_task_priority(mailing)
+    )
+
+
+@shared_task(ignore_result=True)
+def send_message(mailing_id, client_id, message_id=None, version=None):
+    """Выполняет одну попытку отправки сообщения клиенту.
+
+    Если передан message_id, повторно отправляется уже созданное сообщение.
+    Клиенту рассылки создается не больше одного сообщения, уже
+    доставленные сообщения повторно не отправляются. Удаляемому или
+    удаленному клиенту сообщение не отправляется. Повторные попытки,
+    отправка вне временного интервала клиента и ожидание ограничителя
+    частоты дольше SEND_RATE_LIMIT_MAX_WAIT не занимают воркер: задача
+    перепланируется на нужное время. Пока автомат отправки разомкнут,
+    сообщение откладывается без задачи в очереди.
+
+    Новый статус сообщения записывается через буфер статусов, следующая
+    попытка ставится в очередь после его записи. Статус доставленного
+    сообщения записывается сразу, до подтверждения задачи, чтобы
+    повторно доставленная задача его не отправила. Результат первой
+    попытки тоже записывается сразу: сообщение в статусе queued без
+    задачи никто не вернет в отправку. Рассылка берется из кеша снимков
+    процесса.
+    """
     try:
-        mailing = Mailing.objects.get(id=mailing_id)
-        client = Client.objects.get(id=client_id)
-        message = Message.objects.create(
-            status=0,
-            mailing=mailing,
-            client=client
-        )
-
-        url = f'https://probe.fbrq.cloud/v1/send/{message.id}'
-        headers = {'Authorization': f'Bearer {settings.API_TOKEN}'}
-        data = {
-            'id': message.id,
-            'phone': int(client.phone_number),
-            'text': mailing.text
-        }
-
-        while timezone.now() <= mailing.end_date:
-            send_time = calculate_send_time(mailing, client)
-
-            if send_time and send_time > timezone.now():
-                time.sleep((send_time - timezone.now()).seconds)
-
-            response = requests.post(url, headers=headers, json=data)
-
-            if response.status_code == 200:
-                message.status = 200
-                message.send_date = timezone.now()
-                message_logger.info(
-                    f'Сообщение - {message.id} рассылки - '
-                    f'{mailing_id} успешно отправлено '
-                    f'клиенту {client_id}.'
-                )
-                client_logger.info(
-                    f'Клиенту {client_id} отправлено сообщение {message.id}.'
-                )
-                break
+        if is_cancelled(mailing_id, version):
+            return
+        mailing = get_mailing(mailing_id, version)
+        if is_stale(mailing, version):
+            return
+        client = Client.objects.filter(
+            id=client_id, is_deleting=False
+        ).first()
+        if client is None:
+            return
+        if message_id is None:
+            message, created = Message.objects.get_or_create(
+                mailing=mailing,
+                client=client
+            )
+        else:
+            message = Message.objects.get(id=message_id)
+            created = False
+        if message.status == MessageStatus.SENT:
+            return
+
+        old_bucket = get_stats_bucket(message)
+        queued = message.status == MessageStatus.QUEUED
+        planned_at = message.next_attempt_at
+        message.next_attempt_at = None
+        message.parked = False
+        rate_limiter = get_rate_limiter()
+        circuit_breaker = get_circuit_breaker()
+
+        send_time = calculate_send_time(mailing, client)
+        if send_time and send_time > timezone.now():
+            defer_message(
+                message, send_time if send_time <= mailing.end_date else None
+            )
+        elif timezone.now() <= mailing.end_date:
+            allowed, retry_after = circuit_breaker.allow()
+            if not allowed:
+                park_message(message, retry_after)
+            elif not rate_limiter.wait(
+                client.code_operator,
+                timeout=settings.SEND_RATE_LIMIT_MAX_WAIT
+            ):
+                defer_message(message, get_throttled_time(mailing))
             else:
-                message.status = response.status_code
-                message_logger.warning(
-                    f'Ошибка запроса {response.status_code} при отправке '
-                    f'сообщения {message.id} рассылки {mailing_id} '
-                    f'клиенту {client_id}.'
+                message.attempts += 1
+                observe_lag(
+                    planned_at or get_planned_send_time(
+                        mailing, client.timezone
+                    ),
+                    timezone.now()
+                )
+                started = time.monotonic()
+                try:
+                    response = send_message_request(
+                        message.id, client.phone_number, mailing.text
+                    )
+                    rate_limiter.report(
+                        client.code_operator, response.status_code
+                    )
+                    circuit_breaker.record(is_failure(response.status_code))
+                except requests.RequestException as e:
+                    response = None
+                    circuit_breaker.record(True)
+                    set_last_error(message, repr(e))
+                    message_logger.warning(
+                        'Ошибка соединения при отправке сообщения %s '
+                        'рассылки %s клиенту %s: %r',
+                        message.id, mailing_id, client_id, e,
+                        extra=get_log_extra(message)
+                    )
+                latency = get_latency(started)
+                observe_send(
+                    'single',
+                    response.status_code if response is not None else None,
+                    latency
                 )
-                message_logger.warning(response.text)
 
-            time.sleep(60)
+                if response is not None and response.status_code == 200:
+                    mark_sent(message)
+                    message_logger.info(
+                        'Сообщение - %s рассылки - %s успешно отправлено '
+                        'клиенту %s.',
+                        message.id, mailing_id, client_id,
+                        extra=get_log_extra(
+                            message, status=200, latency=latency
+                        )
+                    )
+                    client_logger.info(
+                        'Клиенту %s отправлено сообщение %s.',
+                        client_id, message.id,
+                        extra=get_log_extra(message)
+                    )
+                else:
+                    if response is not None:
+                        set_last_error(
+                            message,
+                            f'{response.status_code} {response.text}'
+                        )
+                        message_logger.warning(
+                            'Ошибка запроса %s при отправке сообщения %s '
+                            'рассылки %s клиенту %s: %s',
+                            response.status_code, message.id, mailing_id,
+                            client_id, response.text,
+                            extra=get_log_extra(
+                                message,
+                                status=response.status_code,
+                                latency=latency
+                            )
+                        )
+                    defer_message(
+                        message, get_retry_time(mailing, message.attempts)
+                    )
         else:
+            defer_message(message, None)
+
+        if message.status in (MessageStatus.FAILED, MessageStatus.EXPIRED):
             message_logger.info(
-                f'Время действия рассылки {mailing_id} истекло, '
-                f'сообщение {message.id} не было отправлено '
-                f'клиенту {client_id}.'
+                'Время действия рассылки %s истекло, сообщение %s не было '
+                'отправлено клиенту %s.',
+                mailing_id, message.id, client_id,
+                extra=get_log_extra(message, status=message.status)
             )
 
-        message.save()
+        callback = None
+        if message.next_attempt_at is not None and not message.parked:
+            callback = partial(schedule_message, mailing, message)
+        saved = queued or message.status == MessageStatus.SENT
+        if saved:
+            message.save(update_fields=STATUS_FIELDS)
+            if callback is not None:
+                callback()
+                callback = None
+        get_status_buffer().add(
+            message, old_bucket, created=created, callback=callback,
+            saved=saved
+        )
 
     except Exception as e:
         message_logger.error(
-            f'Сообщение {message.id}. Ошибка при отправке: {e}'
+            'Сообщение рассылки %s клиенту %s. Ошибка при отправке: %s',
+            mailing_id, client_id, e,
+            extra={'mailing_id': mailing_id, 'client_id': client_id}
         )
 
 
-def calculate_send_time(mailing, client):
-    """Возвращает время отправки сообщения с учетом часового пояса клиента."""
+@shared_task(ignore_result=True)
+def send_message_batch(mailing_id, client_ids, version=None):
+    """Отправляет сообщение рассылки пачке клиентов в одной задаче.
+
+    Сообщения создаются и обновляются пакетно, запросы выполняет бэкенд
+    из настройки SEND_DELIVERY_BACKEND. Уже доставленные клиентам
+    сообщения пропускаются, неотправленные передаются на повторную
+    отправку в send_message. Клиенты, у которых интервал отправки уже
+    закрылся, отправляются повторным запуском пачки при открытии
+    интервала. Статусы пачки записываются до подтверждения задачи.
+    """
     try:
-        client_timezone = pytz.timezone(client.timezone)
-        current_datetime = datetime.now(client_timezone)
-        current_time = timezone.now().astimezone(client_timezone).time()
-        client_datetime = datetime.combine(
-            current_datetime.date(), current_time
+        if is_cancelled(mailing_id, version):
+            return
+        mailing = get_mailing(mailing_id, version)
+        if is_stale(mailing, version):
+            return
+        if timezone.now() > mailing.end_date:
+            mailing_logger.info(
+                f'Время действия рассылки {mailing_id} истекло, '
+                f'пачка из {len(client_ids)} сообщений не отправлена.'
+            )
+            return
+
+        client_ids = get_clients_in_window(mailing, client_ids)
+        if not client_ids:
+            return
+        new_client_ids = (
+            Client.objects.filter(id__in=client_ids)
+            .exclude(clients__mailing=mailing)
+            .values_list('id', flat=True)
         )
+        new_messages = [
+            Message(mailing=mailing, client_id=client_id)
+            for client_id in new_client_ids
+        ]
+        if new_messages:
+            create_messages(mailing_id, client_ids, new_messages)
 
-        start_datetime = datetime.combine(
-            datetime.now().date(), mailing.start_time
+        messages = list(
+            Message.objects.filter(mailing=mailing, client_id__in=client_ids)
+            .exclude(status=MessageStatus.SENT)
+            .select_related('client')
+            .only(
+                'id', 'status', 'send_date', 'attempts', 'next_attempt_at',
+                'parked', 'last_error', 'mailing_id', 'client__id',
+                'client__phone_number', 'client__code_operator',
+                'client__timezone'
+            )
         )
+        mark_sending(mailing_id, messages)
 
-        if mailing.start_time <= current_time <= mailing.end_time:
-            return
-        elif current_time < mailing.start_time:
-            time_difference = start_datetime - client_datetime
-            send_time = (
-                (datetime.now() + time_difference).astimezone(client_timezone)
+        try:
+            deliver_messages(
+                messages, mailing.text,
+                lambda results: save_delivery_results(mailing, results)
             )
+        finally:
+            get_status_buffer().flush()
+
+    except Exception as e:
+        mailing_logger.error(
+            f'Ошибка пакетной отправки рассылки {mailing_id}: {e}'
+        )
+
+
+def create_messages(mailing_id, client_ids, messages):
+    """Создает сообщения пачки и учитывает их в статистике рассылки.
+
+    Сообщения, уже созданные другой задачей, пропускаются. В статистику
+    попадает только число вставленных строк: оно считается по числу
+    сообщений клиентов пачки до и после вставки в одной транзакции.
+    """
+    with transaction.atomic():
+        batch_messages = Message.objects.filter(
+            mailing_id=mailing_id, client_id__in=client_ids
+        )
+        existing = batch_messages.count()
+        Message.objects.bulk_create(messages, ignore_conflicts=True)
+        update_mailing_stats(
+            mailing_id, created=batch_messages.count() - existing
+        )
+
+
+def get_clients_in_window(mailing, client_ids):
+    """Возвращает id клиентов, которым можно отправить сообщение сейчас.
+
+    Время отправки считается один раз на часовой пояс пачки. Для
+    остальных клиентов пачка ставится в очередь заново, по одной задаче на
+    время открытия интервала. Клиенты, чей интервал откроется после
+    окончания рассылки, и удаляемые клиенты пропускаются.
+    """
+    clients = list(
+        Client.objects.filter(id__in=client_ids, is_deleting=False)
+        .only('id', 'timezone')
+    )
+    send_times = get_send_times(
+        mailing, [client.timezone for client in clients]
+    )
+    delayed_client_ids = {}
+    for client in clients:
+        send_time = send_times[client.timezone]
+        if send_time and send_time <= mailing.end_date:
+            delayed_client_ids.setdefault(send_time, []).append(client.id)
+    for send_time, delayed_ids in delayed_client_ids.items():
+        mailing_logger.info(
+            f'Интервал отправки рассылки {mailing.id} закрыт для '
+            f'{len(delayed_ids)} клиентов пачки, отправка перенесена на '
+            f'{send_time}.'
+        )
+        apply_at(
+            send_message_batch, send_time,
+            args=[mailing.id, delayed_ids],
+            kwargs={'version': mailing.version},
+            priority=get_task_priority(mailing)
+        )
+    return [
+        client.id for client in clients if not send_times[client.timezone]
+    ]
+
+
+def mark_sending(mailing_id, messages):
+    """Отмечает пачку сообщений переданной в отправку одним UPDATE.
+
+    В базе next_attempt_at получает время начала попытки: по нему
+    reschedule_deferred_messages находит сообщения прерванной пачки.
+    В объектах сообщений остается плановое время попытки.
+    """
+    transitions = []
+    for message in messages:
+        old_bucket = get_stats_bucket(message)
+        message.status = MessageStatus.SENDING
+        transitions.append((old_bucket, get_stats_bucket(message)))
+    Message.objects.filter(
+        id__in=[message.id for message in messages]
+    ).update(status=MessageStatus.SENDING, next_attempt_at=timezone.now())
+    update_mailing_stats(mailing_id, transitions=transitions)
+
+
+def save_delivery_results(mailing, results):
+    """Передает статусы пачки отправленных сообщений в буфер статусов."""
+    mailing_id = mailing.id
+    status_buffer = get_status_buffer()
+    sent_at = timezone.now()
+    for message, status_code, error, latency in results:
+        client_id = message.client_id
+        old_bucket = get_stats_bucket(message)
+        if isinstance(error, CircuitOpenError):
+            park_message(message, error.retry_after)
+            status_buffer.add(message, old_bucket)
+            continue
+
+        message.attempts += 1
+        message.parked = False
+        observe_lag(
+            message.next_attempt_at or get_planned_send_time(
+                mailing, message.client.timezone
+            ),
+            sent_at
+        )
+        if error is not None:
+            set_last_error(message, repr(error))
+            message_logger.warning(
+                'Ошибка соединения при отправке сообщения %s рассылки %s '
+                'клиенту %s: %r',
+                message.id, mailing_id, client_id, error,
+                extra=get_log_extra(message, latency=latency)
+            )
+        elif status_code == 200:
+            mark_sent(message)
             message_logger.info(
-                f'Сообщение клиенту - {client.id} рассылки - '
-                f'{mailing.id} будет отправлено {send_time}'
+                'Сообщение - %s рассылки - %s успешно отправлено '
+                'клиенту %s.',
+                message.id, mailing_id, client_id,
+                extra=get_log_extra(message, status=200, latency=latency)
+            )
+            client_logger.info(
+                'Клиенту %s отправлено сообщение %s.',
+                client_id, message.id,
+                extra=get_log_extra(message)
+            )
+        else:
+            set_last_error(message, status_code)
+            message_logger.warning(
+                'Ошибка запроса %s при отправке сообщения %s рассылки %s '
+                'клиенту %s.',
+                status_code, message.id, mailing_id, client_id,
+                extra=get_log_extra(
+                    message, status=status_code, latency=latency
+                )
+            )
+
+        callback = None
+        if message.status != MessageStatus.SENT:
+            defer_message(message, get_retry_time(mailing, message.attempts))
+            if message.next_attempt_at is not None:
+                callback = partial(schedule_message, mailing, message)
+        status_buffer.add(message, old_bucket, callback=callback)
+
+
+@shared_task(ignore_result=True)
+def release_parked_messages():
+    """Возвращает в отправку сообщения, отложенные автоматом отправки.
+
+    Пока автомат разомкнут, сообщения остаются отложенными. Когда пора
+    выполнить пробный запрос, в отправку возвращается одно сообщение, а
+    после восстановления API - все остальные.
+    """
+    state = get_circuit_breaker().get_state()['state']
+    if state == OPEN:
+        return
+
+    chunk_size = settings.MAILING_DISPATCH_CHUNK_SIZE
+    if state == HALF_OPEN:
+        chunk_size = 1
+    released = 0
+    after_id = 0
+    while True:
+        messages = list(
+            Message.objects.filter(parked=True, id__gt=after_id)
+            .select_related('mailing')
+            .only(
+                'id', 'client_id', 'next_attempt_at',
+                'mailing__id', 'mailing__version', 'mailing__priority'
+            )
+            .order_by('id')[:chunk_size]
+        )
+        if not messages:
+            break
+        Message.objects.filter(
+            id__in=[message.id for message in messages]
+        ).update(parked=False)
+        for message in messages:
+            schedule_message(message.mailing, message)
+        released += len(messages)
+        if state == HALF_OPEN:
+            break
+        after_id = messages[-1].id
+
+    if released:
+        message_logger.info(
+            f'В отправку возвращено {released} отложенных сообщений.'
+        )
+
+
+@shared_task(ignore_result=True)
+def reschedule_deferred_messages():
+    """Возвращает в очередь сообщения, потерявшие задачу отправки.
+
+    Следующая попытка ставится в очередь после записи буфера статусов,
+    когда задача отправки уже подтверждена. Если воркер остановится до
+    записи, у отложенного сообщения не останется задачи. Сообщения
+    прерванной пачки остаются в статусе sending. Такие сообщения
+    находятся по времени попытки, просроченному больше чем на
+    SEND_RETRY_SWEEP_DELAY секунд, и ставятся в очередь заново.
+    """
+    now = timezone.now()
+    deadline = now - timedelta(seconds=settings.SEND_RETRY_SWEEP_DELAY)
+    rescheduled = 0
+    after_id = 0
+    while True:
+        messages = list(
+            Message.objects.filter(
+                status__in=RESCHEDULED_STATUSES,
+                parked=False,
+                next_attempt_at__lt=deadline,
+                mailing__state=MailingState.ACTIVE,
+                id__gt=after_id
             )
-            return send_time
-        elif current_time > mailing.end_time:
-            time_difference = client_datetime - start_datetime
-            send_time = (
-                (datetime.now() + timedelta(days=1) - time_difference)
-                .astimezone(client_timezone)
+            .select_related('mailing')
+            .only(
+                'id', 'client_id', 'next_attempt_at',
+                'mailing__id', 'mailing__version', 'mailing__priority'
             )
+            .order_by('id')[:settings.MAILING_DISPATCH_CHUNK_SIZE]
+        )
+        if not messages:
+            break
+        Message.objects.filter(
+            id__in=[message.id for message in messages]
+        ).update(next_attempt_at=now)
+        for message in messages:
+            message.next_attempt_at = now
+            schedule_message(message.mailing, message)
+        rescheduled += len(messages)
+        after_id = messages[-1].id
+
+    if rescheduled:
+        message_logger.warning(
+            f'Заново поставлено в очередь {rescheduled} сообщений без '
+            f'задачи отправки.'
+        )
+
+
+def calculate_send_time(mailing, client):
+    """Возвращает время отправки сообщения с учетом часового пояса клиента."""
+    try:
+        send_time = get_send_time(mailing, client.timezone)
+        if send_time:
             message_logger.info(
-                f'Сообщение клиенту - {client.id} рассылки - '
-                f'{mailing.id} будет отправлено {send_time}'
+                'Сообщение клиенту - %s рассылки - %s будет отправлено %s',
+                client.id, mailing.id, send_time,
+                extra={'mailing_id': mailing.id, 'client_id': client.id}
             )
-            return send_time
+        return send_time
 
     except Exception as e:
         message_logger.error(
@@ -189,9 +918,74 @@ def send_mail_statistic():
     command.handle()
 
 
+@shared_task()
+def archive_messages():
+    """Запуск выгрузки сообщений закончившихся рассылок в архив"""
+    command = ArchiveMessages()
+    command.handle()
+
+
+@shared_task(acks_late=True)
+def delete_mailing(mailing_id):
+    """Удаляет рассылку с сообщениями и возвращает число сообщений.
+
+    Сообщения удаляются пачками, затем удаляется сама рассылка. Отправка
+    к этому моменту отменена сменой версии рассылки.
+    """
+    deleted = delete_in_chunks(Message.objects.filter(mailing_id=mailing_id))
+    Mailing.objects.filter(id=mailing_id).delete()
+    mailing_logger.info(
+        f'Рассылка {mailing_id} удалена вместе с {deleted} сообщениями.'
+    )
+    return deleted
+
+
+@shared_task(acks_late=True)
+def delete_client(client_id):
+    """Удаляет клиента с сообщениями и возвращает число сообщений.
+
+    Перед удалением каждой пачки ее сообщения вычитаются из счетчиков
+    статистики рассылок. Сообщения, созданные задачами, начатыми до
+    пометки клиента удаляемым, удаляются вместе с клиентом в одной
+    транзакции и тоже вычитаются.
+    """
+    messages = Message.objects.filter(client_id=client_id)
+    deleted = delete_in_chunks(messages, on_delete=subtract_mailing_stats)
+    with transaction.atomic():
+        # Блокировка клиента не дает создать ему новые сообщения
+        list(Client.objects.select_for_update().filter(id=client_id))
+        deleted += delete_in_chunks(
+            messages, on_delete=subtract_mailing_stats
+        )
+        Client.objects.filter(id=client_id).delete()
+    client_logger.info(
+        f'Клиент {client_id} удален вместе с {deleted} сообщениями.'
+    )
+    return deleted
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_status_buffer(**kwargs):
+    """Записывает буфер статусов перед остановкой воркера."""
+    get_status_buffer().flush()
+
+
 celery_app.conf.beat_schedule = {
     'send_mail_statistic': {
         'task': 'notifications.tasks.send_mail_statistic',
         'schedule': crontab(hour=20, minute=00),
     },
+    'archive_messages': {
+        'task': 'notifications.tasks.archive_messages',
+        'schedule': crontab(hour=3, minute=00),
+    },
+    'release_parked_messages': {
+        'task': 'notifications.tasks.release_parked_messages',
+        'schedule': settings.SEND_CIRCUIT_RELEASE_INTERVAL,
+    },
+    'reschedule_deferred_messages': {
+        'task': 'notifications.tasks.reschedule_deferred_messages',
+        'schedule': settings.SEND_RETRY_SWEEP_INTERVAL,
+    },
 }
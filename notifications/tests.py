@@ -1,3 +1,1870 @@
-from django.test import TestCase
+import asyncio
+import json
+import logging
+import os
+import random
+import tempfile
+import tracemalloc
+from contextlib import nullcontext
+from datetime import datetime, time, timedelta
+from io import StringIO
+from time import perf_counter
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import pytz
+import redis
+import requests
+from django.core import mail
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from notification_service.celery import app as celery_app
+
+from . import (
+    buffers, circuit, delivery, logs, ratelimit, state, tasks, views
+)
+from .imports import import_clients
+from .logs import QueueFileHandler
+from .models import (
+    Client, Mailing, MailingState, MailingStats, Message, MessageStatus
+)
+from .scheduling import (
+    get_send_time, get_send_times, group_timezones_by_send_time
+)
+from .services import (
+    ConvertMessageStatuses, RebuildMailingStats, SendStatisticEmail
+)
+from .statistics import update_mailing_stats
+from .views import export_messages
+
+
+def create_mailing(**kwargs):
+    """Создает активную рассылку по тегу tag."""
+    now = timezone.now()
+    return Mailing.objects.create(**{
+        'text': 'Текст рассылки',
+        'start_date': now - timedelta(hours=1),
+        'end_date': now + timedelta(days=1),
+        'filter_tag': 'tag',
+        **kwargs
+    })
+
+
+def create_clients(count, start=0, **kwargs):
+    """Создает count клиентов с тегом tag и возвращает их по id."""
+    Client.objects.bulk_create(
+        Client(**{
+            'phone_number': f'7916{number:07d}',
+            'code_operator': 916,
+            'tag': 'tag',
+            'timezone': 'Europe/Moscow',
+            **kwargs
+        })
+        for number in range(start, start + count)
+    )
+    return list(Client.objects.order_by('id')[start:start + count])
+
+
+def get_response(status_code=200):
+    """Возвращает ответ API отправки с заданным статусом."""
+    return mock.Mock(status_code=status_code, text='')
+
+
+@override_settings(
+    SEND_RATE_LIMIT=0,
+    SEND_RATE_LIMIT_BACKEND='memory',
+    SEND_CIRCUIT_BREAKER_BACKEND='memory',
+    SEND_STATUS_BUFFER_SIZE=1,
+)
+class NotificationsTestCase(TestCase):
+    """Тесты без Redis с общими для процесса объектами, созданными заново.
+
+    Redis недоступен, поэтому состояние рассылок читается из базы, а
+    ограничитель частоты и автомат отправки хранят состояние в памяти.
+    Буфер статусов записывает каждое изменение сразу.
+    """
+
+    def setUp(self):
+        redis_patcher = mock.patch.object(
+            state, 'get_redis', side_effect=redis.ConnectionError
+        )
+        redis_patcher.start()
+        self.addCleanup(redis_patcher.stop)
+        self.reset_process_state()
+        self.addCleanup(self.reset_process_state)
+
+    def run_tasks_eagerly(self):
+        """Выполняет задачи Celery сразу при постановке в очередь."""
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(
+            setattr, celery_app.conf, 'task_always_eager', False
+        )
+
+    @staticmethod
+    def reset_process_state():
+        state._mailing_states.clear()
+        state._mailings.clear()
+        buffers._status_buffer = None
+        circuit._circuit_breaker = None
+        ratelimit._rate_limiter = None
+
+
+class RetrySchedulingTests(NotificationsTestCase):
+    """Повторные попытки не занимают воркер до времени попытки."""
+
+    # Ошибки первых попыток не должны размыкать автомат отправки
+    @override_settings(SEND_CIRCUIT_MIN_REQUESTS=1000)
+    def test_single_worker_progresses_deferred_messages(self):
+        mailing = create_mailing()
+        clients = create_clients(50)
+        scheduled = []
+        responses = {}
+
+        def send_message_request(message_id, phone_number, text):
+            # Первая попытка каждого сообщения завершается ошибкой
+            status_code = 200 if message_id in responses else 500
+            responses[message_id] = status_code
+            return get_response(status_code)
+
+        with mock.patch.object(
+            tasks, 'send_message_request', side_effect=send_message_request
+        ), mock.patch.object(
+            tasks, 'schedule_message',
+            side_effect=lambda mailing, message: scheduled.append(message)
+        ), mock.patch('time.sleep') as sleep:
+            # Один воркер выполняет задачи по очереди
+            for client in clients:
+                tasks.send_message(
+                    mailing.id, client.id, version=mailing.version
+                )
+
+            deferred = Message.objects.filter(status=MessageStatus.DEFERRED)
+            self.assertEqual(deferred.count(), len(clients))
+            self.assertEqual(len(scheduled), len(clients))
+            self.assertTrue(all(
+                message.next_attempt_at > timezone.now()
+                for message in scheduled
+            ))
+
+            retries, scheduled = scheduled, []
+            for message in retries:
+                tasks.send_message(
+                    mailing.id, message.client_id, message_id=message.id,
+                    version=mailing.version
+                )
+
+        sleep.assert_not_called()
+        self.assertEqual(scheduled, [])
+        self.assertEqual(
+            Message.objects.filter(
+                status=MessageStatus.SENT, attempts=2
+            ).count(),
+            len(clients)
+        )
+
+    def test_sweep_reschedules_lost_retries(self):
+        mailing = create_mailing()
+        paused_mailing = create_mailing(state=MailingState.PAUSED)
+        clients = create_clients(4)
+        now = timezone.now()
+        # Потерявшее задачу, еще ожидающее в очереди, отложенное
+        # автоматом и сообщение приостановленной рассылки
+        lost, _, _, _ = [
+            Message.objects.create(
+                mailing=message_mailing, client=client,
+                status=MessageStatus.DEFERRED, attempts=1,
+                next_attempt_at=now - timedelta(seconds=seconds),
+                parked=is_parked
+            )
+            for message_mailing, client, seconds, is_parked in (
+                (mailing, clients[0], 3600, False),
+                (mailing, clients[1], 60, False),
+                (mailing, clients[2], 3600, True),
+                (paused_mailing, clients[3], 3600, False),
+            )
+        ]
+
+        with mock.patch.object(tasks, 'schedule_message') as schedule:
+            tasks.reschedule_deferred_messages()
+            tasks.reschedule_deferred_messages()
+
+        schedule.assert_called_once()
+        scheduled_mailing, message = schedule.call_args.args
+        self.assertEqual(
+            (scheduled_mailing.id, message.id), (mailing.id, lost.id)
+        )
+        lost.refresh_from_db()
+        self.assertGreaterEqual(lost.next_attempt_at, now)
+
+    @override_settings(SEND_DELIVERY_BACKEND='sync')
+    def test_sweep_reschedules_interrupted_batch(self):
+        mailing = create_mailing()
+        clients = create_clients(3)
+
+        with mock.patch.object(
+            tasks, 'deliver_messages', side_effect=RuntimeError
+        ):
+            tasks.send_message_batch(
+                mailing.id, [client.id for client in clients],
+                version=mailing.version
+            )
+
+        sending = Message.objects.filter(status=MessageStatus.SENDING)
+        self.assertEqual(sending.count(), 3)
+        self.assertFalse(sending.filter(next_attempt_at=None).exists())
+        sending.update(next_attempt_at=timezone.now() - timedelta(hours=1))
+
+        with mock.patch.object(tasks, 'schedule_message') as schedule:
+            tasks.reschedule_deferred_messages()
+
+        self.assertEqual(
+            {call.args[1].client_id for call in schedule.call_args_list},
+            {client.id for client in clients}
+        )
+
+
+class MailingStateTests(NotificationsTestCase):
+    """Задачи из очереди не отправляют сообщения остановленной рассылки."""
+
+    def setUp(self):
+        super().setUp()
+        self.run_tasks_eagerly()
+        patcher = mock.patch.object(
+            tasks, 'send_message_request', return_value=get_response()
+        )
+        self.send_message_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_sent_ids(self):
+        return [
+            call.args[0] for call in self.send_message_request.call_args_list
+        ]
+
+    def change_state(self, mailing, action, status_code=200):
+        response = self.client.post(f'/api/mailings/{mailing.id}/{action}/')
+        self.assertEqual(response.status_code, status_code)
+
+    def test_pause_and_resume(self):
+        mailing = create_mailing()
+        clients = create_clients(1000)
+        # Очередь задач, поставленных до паузы
+        backlog = tasks.build_message_tasks(mailing, clients)
+        for task in backlog[:100]:
+            task.apply()
+        self.assertEqual(len(self.get_sent_ids()), 100)
+
+        self.change_state(mailing, 'pause')
+        for task in backlog[100:]:
+            task.apply()
+        self.assertEqual(len(self.get_sent_ids()), 100)
+        self.assertEqual(mailing.messages.count(), 100)
+
+        self.change_state(mailing, 'resume')
+        for task in backlog:
+            task.apply()
+
+        sent_ids = self.get_sent_ids()
+        self.assertEqual(len(sent_ids), 1000)
+        self.assertEqual(len(set(sent_ids)), 1000)
+        self.assertEqual(
+            mailing.messages.filter(status=MessageStatus.SENT).count(), 1000
+        )
+
+    def test_update_before_start(self):
+        create_clients(100)
+        now = timezone.now()
+        with mock.patch.object(
+            views.send_messages_for_mailing, 'apply_async'
+        ) as apply_async:
+            response = self.client.post(
+                '/api/mailings/',
+                {
+                    'text': 'Текст рассылки',
+                    'start_date': now + timedelta(hours=1),
+                    'end_date': now + timedelta(days=1),
+                    'start_time': '09:00',
+                    'end_time': '18:00',
+                    'filter_tag': 'tag',
+                },
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 201)
+            mailing = Mailing.objects.get()
+            response = self.client.patch(
+                f'/api/mailings/{mailing.id}/',
+                {
+                    'text': 'Новый текст', 'start_date': now,
+                    'start_time': None, 'end_time': None,
+                },
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 200)
+
+        # Запуск созданной рассылки устарел после изменения
+        with mock.patch.object(
+            tasks, 'build_message_tasks', wraps=tasks.build_message_tasks
+        ) as build_message_tasks:
+            for call in apply_async.call_args_list:
+                tasks.send_messages_for_mailing.apply(**call.kwargs)
+
+        self.assertEqual(
+            sum(len(call.args[1]) for call in build_message_tasks.mock_calls),
+            100
+        )
+        sent_ids = self.get_sent_ids()
+        self.assertEqual(len(sent_ids), 100)
+        self.assertEqual(len(set(sent_ids)), 100)
+        texts = {
+            call.args[2] for call in self.send_message_request.call_args_list
+        }
+        self.assertEqual(texts, {'Новый текст'})
+
+    def test_cancel(self):
+        mailing = create_mailing()
+        clients = create_clients(1000)
+        backlog = tasks.build_message_tasks(mailing, clients)
+        for task in backlog[:100]:
+            task.apply()
+
+        self.change_state(mailing, 'cancel')
+        for task in backlog[100:]:
+            task.apply()
+        self.change_state(mailing, 'resume', status_code=400)
+        tasks.send_messages_for_mailing.delay(mailing.id)
+        for task in backlog:
+            task.apply()
+
+        self.assertEqual(len(self.get_sent_ids()), 100)
+        self.assertEqual(mailing.messages.count(), 100)
+
+    @override_settings(MAILING_DISPATCH_CHUNK_SIZE=2)
+    def test_cancel_finishes_unsent_messages(self):
+        mailing = create_mailing()
+        clients = create_clients(6)
+        for client, (status, attempts, parked) in zip(clients, [
+            (MessageStatus.SENT, 1, False),
+            (MessageStatus.QUEUED, 0, False),
+            (MessageStatus.DEFERRED, 0, False),
+            (MessageStatus.DEFERRED, 2, False),
+            (MessageStatus.DEFERRED, 1, True),
+            (MessageStatus.SENDING, 1, False),
+        ]):
+            Message.objects.create(
+                mailing=mailing, client=client, status=status,
+                attempts=attempts, parked=parked,
+                next_attempt_at=timezone.now()
+            )
+        RebuildMailingStats(stdout=StringIO()).handle()
+
+        self.change_state(mailing, 'cancel')
+
+        self.assertEqual(
+            list(
+                mailing.messages.order_by('client_id')
+                .values_list('status', 'parked')
+            ),
+            [
+                (MessageStatus.SENT, False),
+                (MessageStatus.EXPIRED, False),
+                (MessageStatus.EXPIRED, False),
+                (MessageStatus.FAILED, False),
+                (MessageStatus.FAILED, False),
+                (MessageStatus.SENDING, False),
+            ]
+        )
+        self.assertFalse(
+            mailing.messages.filter(
+                status__in=[MessageStatus.EXPIRED, MessageStatus.FAILED]
+            ).exclude(next_attempt_at=None).exists()
+        )
+        stats = MailingStats.objects.values_list(
+            'total', 'successful', 'failed', 'pending'
+        )
+        self.assertEqual(list(stats), [(6, 1, 4, 1)])
+        RebuildMailingStats(stdout=StringIO()).handle()
+        self.assertEqual(list(stats), [(6, 1, 4, 1)])
+
+
+class MemoryRedis:
+    """Хранилище в памяти с нужными состоянию рассылок командами Redis."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.values:
+            return None
+        self.values[key] = str(value).encode()
+        return True
+
+    def delete(self, key):
+        return int(self.values.pop(key, None) is not None)
+
+
+class MailingCacheTests(NotificationsTestCase):
+    """Снимок рассылки в кеше процесса обновляется после ее изменения."""
+
+    def setUp(self):
+        super().setUp()
+        redis_patcher = mock.patch.object(
+            state, 'get_redis', return_value=MemoryRedis()
+        )
+        redis_patcher.start()
+        self.addCleanup(redis_patcher.stop)
+        patcher = mock.patch.object(
+            tasks, 'send_message_request', return_value=get_response()
+        )
+        self.send_message_request = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send_message(self, mailing, client):
+        """Отправляет сообщение в новом процессе кеша состояний.
+
+        Состояние рассылки, прочитанное раньше, считается истекшим, как
+        у воркера, который не видел изменения рассылки.
+        """
+        state._mailing_states.clear()
+        tasks.send_message(mailing.id, client.id, version=mailing.version)
+
+    def get_sent_texts(self):
+        return [
+            call.args[2] for call in self.send_message_request.call_args_list
+        ]
+
+    def test_patch_updates_text(self):
+        mailing = create_mailing()
+        clients = create_clients(2)
+        self.send_message(mailing, clients[0])
+
+        with mock.patch.object(
+            views.send_messages_for_mailing, 'apply_async'
+        ):
+            response = self.client.patch(
+                f'/api/mailings/{mailing.id}/', {'text': 'Новый текст'},
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        mailing.refresh_from_db()
+        self.send_message(mailing, clients[1])
+
+        self.assertEqual(
+            self.get_sent_texts(), ['Текст рассылки', 'Новый текст']
+        )
+
+    def test_model_save_updates_text_and_window(self):
+        mailing = create_mailing()
+        clients = create_clients(3)
+        self.send_message(mailing, clients[0])
+
+        # Изменение из админки не меняет версию рассылки
+        mailing.text = 'Новый текст'
+        mailing.save()
+        self.send_message(mailing, clients[1])
+
+        start_time = (
+            timezone.now().astimezone(pytz.timezone(clients[2].timezone)) +
+            timedelta(hours=2)
+        ).time()
+        mailing.start_time = start_time
+        mailing.end_time = start_time.replace(minute=59)
+        mailing.save()
+        with mock.patch.object(tasks, 'schedule_message') as schedule:
+            self.send_message(mailing, clients[2])
+
+        self.assertEqual(
+            self.get_sent_texts(), ['Текст рассылки', 'Новый текст']
+        )
+        schedule.assert_called_once()
+        self.assertEqual(
+            Message.objects.get(client=clients[2]).status,
+            MessageStatus.DEFERRED
+        )
+
+    def test_mailing_is_read_once_per_stamp(self):
+        mailing = create_mailing()
+        state.set_mailing_state(mailing)
+
+        for text in ('Текст рассылки', 'Новый текст'):
+            with self.assertNumQueries(1):
+                for _ in range(10):
+                    state._mailing_states.clear()
+                    self.assertEqual(
+                        state.get_mailing(mailing.id, mailing.version).text,
+                        text
+                    )
+            Mailing.objects.filter(id=mailing.id).update(text='Новый текст')
+            state.set_mailing_state(mailing)
+
+
+class DeletingClientTests(NotificationsTestCase):
+    """Удаляемым клиентам сообщения не отправляются."""
+
+    def test_single_send(self):
+        mailing = create_mailing()
+        client, retried_client = create_clients(2)
+        message = Message.objects.create(
+            mailing=mailing, client=retried_client,
+            status=MessageStatus.DEFERRED, attempts=1
+        )
+        Client.objects.update(is_deleting=True)
+
+        with mock.patch.object(
+            tasks, 'send_message_request', return_value=get_response()
+        ) as send_message_request:
+            tasks.send_message(mailing.id, client.id, version=mailing.version)
+            tasks.send_message(
+                mailing.id, retried_client.id, message_id=message.id,
+                version=mailing.version
+            )
+            # Задача клиента, удаленного до ее выполнения
+            tasks.send_message(mailing.id, 0, version=mailing.version)
+
+        send_message_request.assert_not_called()
+        self.assertEqual(
+            list(Message.objects.values_list('id', 'status')),
+            [(message.id, MessageStatus.DEFERRED)]
+        )
+
+    @override_settings(SEND_DELIVERY_BACKEND='sync')
+    def test_batch_send(self):
+        mailing = create_mailing()
+        clients = create_clients(3)
+        Client.objects.filter(id=clients[0].id).update(is_deleting=True)
+
+        with mock.patch(
+            'notifications.delivery.send_message_request',
+            return_value=get_response()
+        ) as send_message_request, mock.patch.object(
+            tasks, 'schedule_message'
+        ) as schedule_message:
+            tasks.send_message_batch(
+                mailing.id, [client.id for client in clients],
+                version=mailing.version
+            )
+
+        self.assertEqual(send_message_request.call_count, 2)
+        schedule_message.assert_not_called()
+        self.assertEqual(
+            set(Message.objects.values_list('client_id', flat=True)),
+            {clients[1].id, clients[2].id}
+        )
+
+
+def split_timezones_by_window():
+    """Делит пояса на те, где сейчас 10-14 часов, и далекие от интервала.
+
+    Пояса у границ интервала пропускаются, чтобы он не открылся или не
+    закрылся во время теста.
+    """
+    now = timezone.now()
+    in_window, out_of_window = [], []
+    for timezone_name in pytz.common_timezones:
+        local_time = now.astimezone(pytz.timezone(timezone_name)).time()
+        if time(10) <= local_time <= time(14):
+            in_window.append(timezone_name)
+        elif local_time < time(9) or local_time > time(15):
+            out_of_window.append(timezone_name)
+    return in_window, out_of_window
+
+
+class BatchDeliveryTests(NotificationsTestCase):
+    """Пакетная отправка учитывает интервал отправки клиентов."""
+
+    @override_settings(
+        SEND_DELIVERY_BACKEND='sync', CELERY_TASK_MAX_ETA=2 * 24 * 3600
+    )
+    def test_clients_outside_window_are_deferred(self):
+        mailing = create_mailing(start_time=time(10), end_time=time(14))
+        in_window, out_of_window = split_timezones_by_window()
+        clients = (
+            create_clients(3, timezone=in_window[0]) +
+            create_clients(2, start=3, timezone=out_of_window[0])
+        )
+        self.run_tasks_eagerly()
+
+        with mock.patch(
+            'notifications.delivery.send_message_request',
+            return_value=get_response()
+        ) as send_message_request, mock.patch.object(
+            tasks, 'send_message_request'
+        ) as single_send_message_request, mock.patch.object(
+            tasks, 'schedule_message'
+        ) as schedule_message, mock.patch.object(
+            tasks.send_message_batch, 'apply_async'
+        ) as delayed_batch:
+            tasks.send_message_batch(
+                mailing.id, [client.id for client in clients],
+                version=mailing.version
+            )
+
+        self.assertEqual(send_message_request.call_count, 3)
+        single_send_message_request.assert_not_called()
+        schedule_message.assert_not_called()
+        self.assertEqual(
+            Message.objects.filter(status=MessageStatus.SENT).count(), 3
+        )
+        self.assertEqual(Message.objects.count(), 3)
+        # Клиенты вне интервала отправляются одной пачкой при его открытии
+        delayed_batch.assert_called_once()
+        call = delayed_batch.call_args
+        self.assertEqual(
+            call.kwargs['args'],
+            [mailing.id, [client.id for client in clients[3:]]]
+        )
+        self.assertEqual(
+            call.kwargs['eta'],
+            get_send_time(mailing, out_of_window[0])
+        )
+
+    @override_settings(SEND_DELIVERY_BACKEND='sync')
+    def test_stats_count_inserted_messages(self):
+        mailing = create_mailing()
+        clients = create_clients(3)
+        create_messages = tasks.create_messages
+
+        def create_concurrently(*args):
+            # Сообщение клиенту пачки создала задача, выполнявшаяся
+            # одновременно, и учла его в статистике
+            Message.objects.create(mailing=mailing, client=clients[0])
+            update_mailing_stats(mailing.id, created=1)
+            return create_messages(*args)
+
+        with mock.patch(
+            'notifications.delivery.send_message_request',
+            return_value=get_response()
+        ), mock.patch.object(
+            tasks, 'create_messages', side_effect=create_concurrently
+        ):
+            tasks.send_message_batch(
+                mailing.id, [client.id for client in clients],
+                version=mailing.version
+            )
+
+        stats = MailingStats.objects.values_list(
+            'total', 'successful', 'failed', 'pending'
+        )
+        self.assertEqual(list(stats), [(3, 3, 0, 0)])
+        RebuildMailingStats(stdout=StringIO()).handle()
+        self.assertEqual(list(stats), [(3, 3, 0, 0)])
+
+
+# Интервал отправки откроется раньше, чем отсрочку нужно продлевать
+@override_settings(CELERY_TASK_MAX_ETA=2 * 24 * 3600)
+class MailingWaveTests(NotificationsTestCase):
+    """Волна рассылки переносится, если интервал отправки закрылся."""
+
+    def test_closed_window_delays_wave_from_same_chunk(self):
+        mailing = create_mailing(start_time=time(10), end_time=time(14))
+        in_window, out_of_window = split_timezones_by_window()
+        clients = (
+            create_clients(2, timezone=in_window[0]) +
+            create_clients(2, start=2, timezone=out_of_window[0])
+        )
+
+        with mock.patch.object(
+            tasks, 'build_message_tasks', return_value=[]
+        ) as build_message_tasks, mock.patch.object(
+            tasks.dispatch_mailing_wave, 'apply_async'
+        ) as dispatch:
+            tasks.dispatch_mailing_wave(
+                mailing.id, [in_window[0], out_of_window[0]],
+                after_id=clients[0].id, version=mailing.version
+            )
+
+        # Сообщения ставятся только клиентам с открытым интервалом
+        build_message_tasks.assert_called_once()
+        self.assertEqual(
+            [client.id for client in build_message_tasks.call_args.args[1]],
+            [clients[1].id]
+        )
+        delayed, following = dispatch.call_args_list
+        self.assertEqual(
+            delayed.kwargs['args'],
+            [mailing.id, [out_of_window[0]], clients[0].id]
+        )
+        self.assertEqual(
+            delayed.kwargs['eta'], get_send_time(mailing, out_of_window[0])
+        )
+        self.assertEqual(
+            following.kwargs['args'],
+            [mailing.id, [in_window[0]], clients[1].id]
+        )
+
+    def test_wave_stops_when_window_opens_after_end(self):
+        in_window, out_of_window = split_timezones_by_window()
+        mailing = create_mailing(
+            start_time=time(10), end_time=time(14),
+            end_date=timezone.now() + timedelta(minutes=30)
+        )
+        create_clients(2, timezone=out_of_window[0])
+
+        with mock.patch.object(
+            tasks, 'build_message_tasks'
+        ) as build_message_tasks, mock.patch.object(
+            tasks.dispatch_mailing_wave, 'apply_async'
+        ) as dispatch:
+            tasks.dispatch_mailing_wave(
+                mailing.id, [out_of_window[0]], version=mailing.version
+            )
+
+        build_message_tasks.assert_not_called()
+        dispatch.assert_not_called()
+
+
+@override_settings(CELERY_TASK_MAX_ETA=3600)
+class TaskEtaTests(SimpleTestCase):
+    """Долгие отсрочки задач не превышают CELERY_TASK_MAX_ETA."""
+
+    def test_long_eta_is_extended_by_hops(self):
+        now = timezone.now()
+        eta = now + timedelta(hours=2, minutes=30)
+
+        with mock.patch.object(
+            tasks.wait_until, 'apply_async'
+        ) as wait_until, mock.patch.object(
+            tasks.send_message, 'apply_async'
+        ) as send_message, mock.patch.object(
+            tasks.timezone, 'now', return_value=now
+        ) as get_now:
+            tasks.apply_at(
+                tasks.send_message, eta, args=[1, 2],
+                kwargs={'version': 3}, priority=4
+            )
+            hops = 0
+            while wait_until.called:
+                hop = wait_until.call_args.kwargs
+                self.assertLessEqual(
+                    hop['eta'],
+                    get_now.return_value + timedelta(hours=1)
+                )
+                wait_until.reset_mock()
+                get_now.return_value = hop['eta']
+                tasks.wait_until(*hop['args'])
+                hops += 1
+
+        self.assertEqual(hops, 2)
+        send_message.assert_called_once_with(
+            args=[1, 2], kwargs={'version': 3}, eta=eta, priority=4
+        )
+
+
+@override_settings(
+    SEND_STATUS_BUFFER_SIZE=100, SEND_STATUS_FLUSH_INTERVAL=3600
+)
+class StatusBufferTests(NotificationsTestCase):
+    """Доставленные сообщения записываются до подтверждения задачи."""
+
+    def test_sent_status_is_saved_before_flush(self):
+        mailing = create_mailing()
+        client, = create_clients(1)
+        status_buffer = tasks.get_status_buffer()
+        self.addCleanup(status_buffer.flush)
+
+        with mock.patch.object(
+            tasks, 'send_message_request', return_value=get_response()
+        ) as send_message_request:
+            # Задача доставлена повторно до записи буфера
+            for _ in range(2):
+                tasks.send_message(
+                    mailing.id, client.id, version=mailing.version
+                )
+
+        send_message_request.assert_called_once()
+        message = Message.objects.get()
+        self.assertEqual(message.status, MessageStatus.SENT)
+        self.assertEqual(message.attempts, 1)
+        self.assertEqual(status_buffer.messages, {})
+
+        status_buffer.flush()
+        stats = mailing.stats
+        stats.refresh_from_db()
+        self.assertEqual(
+            (stats.total, stats.successful, stats.pending), (1, 1, 0)
+        )
+
+    def test_first_attempt_is_saved_before_flush(self):
+        mailing = create_mailing()
+        client, = create_clients(1)
+        status_buffer = tasks.get_status_buffer()
+        self.addCleanup(status_buffer.flush)
+
+        with mock.patch.object(
+            tasks, 'send_message_request', return_value=get_response(503)
+        ), mock.patch.object(tasks, 'schedule_message') as schedule:
+            tasks.send_message(mailing.id, client.id, version=mailing.version)
+
+        message = Message.objects.get()
+        self.assertEqual(message.status, MessageStatus.DEFERRED)
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNotNone(message.next_attempt_at)
+        # Следующая попытка не ждет записи буфера
+        schedule.assert_called_once()
+        self.assertEqual(status_buffer.messages, {})
+
+    def test_saved_status_is_not_overwritten(self):
+        mailing = create_mailing()
+        client, = create_clients(1)
+        message = Message.objects.create(mailing=mailing, client=client)
+        status_buffer = tasks.get_status_buffer()
+        self.addCleanup(status_buffer.flush)
+
+        deferred = Message.objects.get()
+        deferred.status = MessageStatus.DEFERRED
+        status_buffer.add(deferred, 'pending', created=True)
+        message.status = MessageStatus.SENT
+        message.save(update_fields=buffers.STATUS_FIELDS)
+        status_buffer.add(message, 'pending', saved=True)
+        status_buffer.flush()
+
+        message.refresh_from_db()
+        self.assertEqual(message.status, MessageStatus.SENT)
+
+    @override_settings(SEND_DELIVERY_BACKEND='sync')
+    def test_batch_statuses_are_saved_before_ack(self):
+        mailing = create_mailing()
+        clients = create_clients(5)
+
+        with mock.patch(
+            'notifications.delivery.send_message_request',
+            side_effect=[get_response(200)] * 4 + [get_response(503)]
+        ), mock.patch.object(tasks, 'schedule_message') as schedule:
+            tasks.send_message_batch(
+                mailing.id, [client.id for client in clients],
+                version=mailing.version
+            )
+
+        self.assertEqual(tasks.get_status_buffer().messages, {})
+        self.assertEqual(
+            Message.objects.filter(status=MessageStatus.SENT).count(), 4
+        )
+        self.assertEqual(
+            Message.objects.filter(status=MessageStatus.DEFERRED).count(), 1
+        )
+        schedule.assert_called_once()
+
+
+@skipUnless(connection.vendor == 'sqlite', 'План запроса в формате SQLite')
+class IndexUsageTests(TestCase):
+    """Выборка получателей и статистика используют индексы."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.mailing = create_mailing(
+            filter_tag='tag0', filter_code_operator=900
+        )
+        Client.objects.bulk_create(
+            Client(
+                phone_number=f'7916{number:07d}',
+                code_operator=900 + number % 100,
+                tag=f'tag{number % 20}',
+                timezone='Europe/Moscow'
+            )
+            for number in range(2000)
+        )
+        Message.objects.bulk_create(
+            Message(
+                mailing=cls.mailing,
+                client=client,
+                status=MessageStatus.values[client.id % 6]
+            )
+            for client in Client.objects.only('id')
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan, plan)
+
+    def test_recipients_by_tag_and_operator(self):
+        self.assertUsesIndex(
+            Client.objects.for_mailing(self.mailing),
+            'client_tag_operator_idx'
+        )
+
+    def test_recipients_by_operator(self):
+        mailing = Mailing(filter_code_operator=900)
+        self.assertUsesIndex(
+            Client.objects.for_mailing(mailing), 'client_operator_idx'
+        )
+
+    def test_messages_by_mailing_and_status(self):
+        self.assertUsesIndex(
+            self.mailing.messages.filter(status=MessageStatus.SENT),
+            'message_mailing_status_idx'
+        )
+
+    def test_messages_by_send_date(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            Message.objects.filter(
+                send_date__range=(now - timedelta(days=1), now)
+            ),
+            'message_send_date_idx'
+        )
+
+
+class StatisticEmailTests(TestCase):
+    """Ежедневная статистика строится одним запросом."""
+
+    def create_mailings(self, count):
+        clients = create_clients(4)
+        statuses = [
+            MessageStatus.SENT, MessageStatus.SENT, MessageStatus.FAILED,
+            MessageStatus.DEFERRED
+        ]
+        for _ in range(count):
+            mailing = create_mailing()
+            Message.objects.bulk_create(
+                Message(
+                    mailing=mailing,
+                    client=client,
+                    status=status,
+                    send_date=(
+                        timezone.now() if status == MessageStatus.SENT
+                        else None
+                    )
+                )
+                for client, status in zip(clients, statuses)
+            )
+
+    def send_statistics(self):
+        SendStatisticEmail(stdout=StringIO(), stderr=StringIO()).handle()
+
+    def test_digest_query_count_does_not_depend_on_mailings(self):
+        for count in (1, 10):
+            Mailing.objects.all().delete()
+            Client.objects.all().delete()
+            mail.outbox = []
+            self.create_mailings(count)
+
+            with self.assertNumQueries(1):
+                self.send_statistics()
+
+            self.assertEqual(len(mail.outbox), 1)
+            self.assertEqual(len(mail.outbox[0].body.splitlines()), count)
+
+    @override_settings(MAILING_STATISTIC_DIGEST=False)
+    def test_mail_per_mailing_query_count_does_not_depend_on_mailings(self):
+        for count in (1, 10):
+            Mailing.objects.all().delete()
+            Client.objects.all().delete()
+            mail.outbox = []
+            self.create_mailings(count)
+
+            with self.assertNumQueries(1):
+                self.send_statistics()
+
+            self.assertEqual(len(mail.outbox), count)
+
+    def test_statistic_text(self):
+        self.create_mailings(1)
+        # Одно из двух сообщений отправлено раньше, чем за сутки
+        message = Message.objects.filter(status=MessageStatus.SENT).first()
+        Message.objects.filter(id=message.id).update(
+            send_date=timezone.now() - timedelta(days=2)
+        )
+
+        self.send_statistics()
+
+        self.assertIn(
+            'За сутки - 1 успешно отправленных сообщений. '
+            'Всего сообщений - 4: отправлено - 2, не отправлено - 1, '
+            'ожидают отправки - 1.',
+            mail.outbox[0].body
+        )
+
+
+class ConvertMessageStatusesTests(TestCase):
+    """Прежние статусы - коды ответа API - переводятся в новые."""
+
+    def test_legacy_statuses(self):
+        now = timezone.now()
+        mailing = create_mailing()
+        ended_mailing = create_mailing(
+            start_date=now - timedelta(days=2),
+            end_date=now - timedelta(days=1)
+        )
+        clients = create_clients(3)
+        legacy_statuses = {}
+        for message_mailing in (mailing, ended_mailing):
+            for client, status in zip(clients, ('200', '0', '500')):
+                message = Message.objects.create(
+                    mailing=message_mailing, client=client,
+                    send_date=now if status == '200' else None
+                )
+                legacy_statuses[message.id] = status
+        for message_id, status in legacy_statuses.items():
+            Message.objects.filter(id=message_id).update(status=status)
+
+        ConvertMessageStatuses(stdout=StringIO(), stderr=StringIO()).handle()
+
+        self.assertEqual(
+            {
+                (message.mailing_id, legacy_statuses[message.id]): (
+                    message.status, message.attempts, message.last_error,
+                    message.next_attempt_at is not None
+                )
+                for message in Message.objects.all()
+            },
+            {
+                (mailing.id, '200'): (MessageStatus.SENT, 1, '', False),
+                (mailing.id, '0'): (MessageStatus.DEFERRED, 0, '', True),
+                (mailing.id, '500'): (
+                    MessageStatus.DEFERRED, 1, '500', True
+                ),
+                (ended_mailing.id, '200'): (
+                    MessageStatus.SENT, 1, '', False
+                ),
+                (ended_mailing.id, '0'): (
+                    MessageStatus.EXPIRED, 0, '', False
+                ),
+                (ended_mailing.id, '500'): (
+                    MessageStatus.FAILED, 1, '500', False
+                ),
+            }
+        )
+        self.assertEqual(
+            [
+                (stats.total, stats.successful, stats.failed, stats.pending)
+                for stats in MailingStats.objects.order_by('mailing_id')
+            ],
+            [(3, 1, 0, 2), (3, 1, 2, 0)]
+        )
+
+
+@override_settings(MESSAGE_DELETE_CHUNK_SIZE=100)
+class DeleteClientTests(TestCase):
+    """Удаление клиента вычитает его сообщения из статистики рассылок."""
+
+    def create_messages(self, mailings, clients):
+        statuses = (
+            MessageStatus.SENT, MessageStatus.FAILED, MessageStatus.DEFERRED
+        )
+        Message.objects.bulk_create(
+            (
+                Message(
+                    mailing=mailing, client=client,
+                    status=statuses[(mailing.id + client.id) % 3]
+                )
+                for mailing in mailings
+                for client in clients
+            ),
+            batch_size=5000
+        )
+        RebuildMailingStats(stdout=StringIO()).handle()
+
+    def get_stats(self):
+        return list(
+            MailingStats.objects.order_by('mailing_id').values_list(
+                'mailing_id', 'total', 'successful', 'failed', 'pending'
+            )
+        )
+
+    def test_stats_match_rebuild(self):
+        mailings = [create_mailing() for _ in range(3)]
+        clients = create_clients(3)
+        self.create_messages(mailings, clients)
+        MailingStats.objects.filter(mailing=mailings[2]).update(
+            archived=True
+        )
+        archived_stats = self.get_stats()[2]
+
+        # Пачки сообщений меньше числа рассылок клиента
+        with self.settings(MESSAGE_DELETE_CHUNK_SIZE=2):
+            self.assertEqual(tasks.delete_client(clients[0].id), 3)
+
+        stats = self.get_stats()
+        self.assertEqual(stats[2], archived_stats)
+        RebuildMailingStats(stdout=StringIO()).handle()
+        self.assertEqual(stats[:2], self.get_stats()[:2])
+
+    def delete_client(self, client):
+        """Удаляет клиента и возвращает пик памяти и время удаления."""
+        tracemalloc.start()
+        started = perf_counter()
+        try:
+            tasks.delete_client(client.id)
+            return tracemalloc.get_traced_memory()[1], perf_counter() - started
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_and_time_grow_with_messages(self):
+        now = timezone.now()
+        Mailing.objects.bulk_create(
+            Mailing(
+                text='Текст рассылки', filter_tag='tag',
+                start_date=now - timedelta(hours=1),
+                end_date=now + timedelta(days=1)
+            )
+            for _ in range(2000)
+        )
+        mailings = list(Mailing.objects.order_by('id'))
+        warmup_client, small_client, large_client = create_clients(3)
+        self.create_messages(mailings[:10], [warmup_client])
+        self.create_messages(mailings[:200], [small_client])
+        self.create_messages(mailings, [large_client])
+
+        # Первое удаление заполняет кеши запросов и не измеряется
+        tasks.delete_client(warmup_client.id)
+        small_peak, small_time = self.delete_client(small_client)
+        large_peak, large_time = self.delete_client(large_client)
+
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(
+            MailingStats.objects.exclude(
+                total=0, successful=0, failed=0, pending=0
+            ).exists()
+        )
+        # В 10 раз больше сообщений: сообщения не загружаются в память,
+        # она растет только за счет еще не собранного мусора запросов, а
+        # время растет линейно
+        self.assertLess(large_peak, small_peak * 3)
+        self.assertLess(large_time, small_time * 10 * 2)
+
+
+class ImportClientsTests(TestCase):
+    """Импорт клиентов проверяет строки так же, как API клиента."""
+
+    def test_code_operator_out_of_range(self):
+        report = import_clients([
+            {
+                'phone_number': '71234567890',
+                'code_operator': 123,
+                'tag': 'tag',
+                'timezone': 'Europe/Moscow',
+            },
+            {
+                'phone_number': '79161234567',
+                'code_operator': 916,
+                'tag': 'tag',
+                'timezone': 'Europe/Moscow',
+            },
+        ])
+
+        self.assertEqual(report['created'], 1)
+        self.assertEqual(report['errors_count'], 1)
+        self.assertEqual(report['errors'][0]['row'], 1)
+        self.assertIn('code_operator', report['errors'][0]['errors'])
+        self.assertQuerysetEqual(
+            Client.objects.values_list('phone_number', flat=True),
+            ['79161234567']
+        )
+
+    def post_bulk(self, body, content_type):
+        return self.client.generic(
+            'POST', '/api/clients/bulk/', body, content_type
+        )
+
+    def assert_imported(self, *phone_numbers):
+        self.assertQuerysetEqual(
+            Client.objects.order_by('phone_number').values_list(
+                'phone_number', flat=True
+            ),
+            list(phone_numbers)
+        )
+
+    def test_csv(self):
+        response = self.post_bulk(
+            'phone_number,code_operator,tag,timezone\n'
+            '79161234567,916,tag,Europe/Moscow\n'
+            '79261234567,926,тег,Europe/Moscow\n',
+            'text/csv'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(Client.objects.get(code_operator=926).tag, 'тег')
+
+    def test_ndjson(self):
+        response = self.post_bulk(
+            '{"phone_number": "79161234567", "code_operator": 916, '
+            '"tag": "tag", "timezone": "Europe/Moscow"}\n'
+            '\n'
+            'not json\n',
+            'application/x-ndjson'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 1)
+        self.assertEqual(response.json()['errors'][0]['row'], 2)
+
+    def test_csv_in_wrong_encoding_reports_rows(self):
+        body = (
+            'phone_number,code_operator,tag,timezone\n'
+            '79161234567,916,tag,Europe/Moscow\n'
+            '79261234567,926,тег,Europe/Moscow\n'
+            '79361234567,936,tag,Europe/Moscow\n'
+        ).encode('cp1251')
+
+        response = self.post_bulk(body, 'text/csv')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 2)
+        self.assertEqual(response.json()['errors'][0]['row'], 2)
+        self.assert_imported('79161234567', '79361234567')
+
+    def test_csv_with_charset(self):
+        body = (
+            'phone_number,code_operator,tag,timezone\n'
+            '79261234567,926,тег,Europe/Moscow\n'
+        ).encode('cp1251')
+
+        response = self.post_bulk(body, 'text/csv; charset=cp1251')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Client.objects.get().tag, 'тег')
+
+    def test_csv_format_error_reports_row(self):
+        response = self.post_bulk(
+            'phone_number,code_operator,tag,timezone\n'
+            f'79161234567,916,{"t" * 200000},Europe/Moscow\n'
+            '79261234567,926,tag,Europe/Moscow\n',
+            'text/csv'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['errors'][0]['row'], 1)
+        self.assert_imported('79261234567')
+
+    @override_settings(CLIENT_IMPORT_CHUNK_SIZE=1)
+    def test_csv_header_in_wrong_encoding(self):
+        body = (
+            'телефон,code_operator,tag,timezone\n'
+            '79161234567,916,tag,Europe/Moscow\n'
+        ).encode('cp1251')
+
+        response = self.post_bulk(body, 'text/csv')
+
+        self.assertEqual(response.status_code, 400)
+        self.assert_imported()
+
+    def test_ndjson_in_wrong_encoding_reports_rows(self):
+        body = (
+            '{"phone_number": "79161234567", "code_operator": 916, '
+            '"tag": "тег", "timezone": "Europe/Moscow"}\n'
+        ).encode('cp1251') + (
+            '{"phone_number": "79261234567", "code_operator": 926, '
+            '"tag": "тег", "timezone": "Europe/Moscow"}\n'
+        ).encode()
+
+        response = self.post_bulk(body, 'application/x-ndjson')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['errors'][0]['row'], 1)
+        self.assert_imported('79261234567')
+
+
+@override_settings(
+    SEND_RATE_LIMIT_INCREASE=0.5, SEND_RATE_LIMIT_DECREASE=0.5,
+    SEND_RATE_LIMIT_REPORT_BATCH=10
+)
+class RateLimiterTests(SimpleTestCase):
+    """Ограничитель частоты повышает скорость пачками успешных ответов."""
+
+    def get_rate(self, rate_limiter):
+        return rate_limiter.buckets['send_rate:provider']['rate']
+
+    def test_successes_are_reported_in_batches(self):
+        rate_limiter = ratelimit.LocalRateLimiter('provider', 100, 10)
+        rate_limiter.acquire(916)
+        rate_limiter.report(916, 429)
+        self.assertEqual(self.get_rate(rate_limiter), 50)
+
+        with mock.patch.object(
+            rate_limiter, 'adapt', wraps=rate_limiter.adapt
+        ) as adapt:
+            for _ in range(25):
+                rate_limiter.report(916, 200)
+
+        self.assertEqual(adapt.call_count, 2)
+        self.assertEqual(self.get_rate(rate_limiter), 60)
+
+    def test_throttling_drops_pending_successes(self):
+        rate_limiter = ratelimit.LocalRateLimiter('provider', 100, 10)
+        rate_limiter.acquire(916)
+        for _ in range(9):
+            rate_limiter.report(916, 200)
+        rate_limiter.report(916, 503)
+        rate_limiter.report(916, 200)
+
+        self.assertEqual(self.get_rate(rate_limiter), 50)
+
+
+@override_settings(
+    SEND_CIRCUIT_FAILURE_RATIO=0.5, SEND_CIRCUIT_MIN_REQUESTS=4,
+    SEND_CIRCUIT_WINDOW=60, SEND_CIRCUIT_OPEN_TIMEOUT=30,
+    SEND_CIRCUIT_PROBE_TIMEOUT=10
+)
+class CircuitBreakerTests(SimpleTestCase):
+    """Переходы автомата отправки с состоянием в памяти процесса."""
+
+    def setUp(self):
+        time_patcher = mock.patch.object(circuit, 'time')
+        self.time = time_patcher.start().time
+        self.time.return_value = 1000
+        self.addCleanup(time_patcher.stop)
+        self.circuit_breaker = circuit.LocalCircuitBreaker('provider')
+
+    def open_circuit(self):
+        for failed in (False, False, True):
+            self.assertEqual(self.circuit_breaker.record(failed), '')
+        self.assertEqual(self.circuit_breaker.record(True), circuit.OPENED)
+
+    def test_opened(self):
+        self.open_circuit()
+
+        self.assertEqual(self.circuit_breaker.allow(), (False, 30))
+        self.assertEqual(self.circuit_breaker.get_state(), {
+            'state': circuit.OPEN, 'retry_after': 30,
+            'requests': 0, 'failures': 0,
+        })
+        # Ответы на запросы, начатые до размыкания, не меняют состояние
+        self.assertEqual(self.circuit_breaker.record(False), '')
+        self.assertEqual(self.circuit_breaker.allow(), (False, 30))
+
+    def test_failures_outside_window_are_forgotten(self):
+        for failed in (False, True, True):
+            self.circuit_breaker.record(failed)
+        self.time.return_value += 60
+
+        self.assertEqual(self.circuit_breaker.record(True), '')
+        self.assertEqual(
+            self.circuit_breaker.get_state()['state'], circuit.CLOSED
+        )
+
+    def test_half_open_probe(self):
+        self.open_circuit()
+        self.time.return_value += 30
+
+        self.assertEqual(
+            self.circuit_breaker.get_state()['state'], circuit.HALF_OPEN
+        )
+        self.assertEqual(self.circuit_breaker.allow(), (True, 0))
+        # Пока пробный запрос выполняется, остальные запросы не проходят
+        self.assertEqual(self.circuit_breaker.allow(), (False, 10))
+        self.time.return_value += 10
+        self.assertEqual(self.circuit_breaker.allow(), (True, 0))
+
+    def test_reopened(self):
+        self.open_circuit()
+        self.time.return_value += 30
+        self.circuit_breaker.allow()
+
+        self.assertEqual(self.circuit_breaker.record(True), circuit.REOPENED)
+        self.assertEqual(self.circuit_breaker.allow(), (False, 30))
+        self.assertEqual(
+            self.circuit_breaker.get_state()['state'], circuit.OPEN
+        )
+
+    def test_recovered(self):
+        self.open_circuit()
+        self.time.return_value += 30
+        self.circuit_breaker.allow()
+
+        self.assertEqual(
+            self.circuit_breaker.record(False), circuit.RECOVERED
+        )
+        self.assertEqual(self.circuit_breaker.allow(), (True, 0))
+        self.assertEqual(
+            self.circuit_breaker.get_state()['state'], circuit.CLOSED
+        )
+
+
+@override_settings(
+    SEND_CIRCUIT_FAILURE_RATIO=0.5, SEND_CIRCUIT_MIN_REQUESTS=2,
+    SEND_CIRCUIT_OPEN_TIMEOUT=30, MAILING_DISPATCH_CHUNK_SIZE=2
+)
+class ParkedMessagesTests(NotificationsTestCase):
+    """Сообщения откладываются автоматом и возвращаются в отправку."""
+
+    def test_parking_and_release(self):
+        mailing = create_mailing()
+        clients = create_clients(5)
+        scheduled = []
+        provider_up = False
+
+        def send_message_request(message_id, phone_number, text):
+            return get_response(200 if provider_up else 503)
+
+        def send_scheduled():
+            messages = scheduled[:]
+            scheduled.clear()
+            for message in messages:
+                tasks.send_message(
+                    mailing.id, message.client_id, message_id=message.id,
+                    version=mailing.version
+                )
+            return messages
+
+        time_patcher = mock.patch.object(circuit, 'time')
+        clock = time_patcher.start().time
+        clock.return_value = 1000
+        self.addCleanup(time_patcher.stop)
+
+        with mock.patch.object(
+            tasks, 'send_message_request', side_effect=send_message_request
+        ) as request, mock.patch.object(
+            tasks, 'schedule_message',
+            side_effect=lambda mailing, message: scheduled.append(message)
+        ):
+            for client in clients:
+                tasks.send_message(
+                    mailing.id, client.id, version=mailing.version
+                )
+
+            # Две ошибки разомкнули автомат, остальные сообщения отложены
+            # без запросов и без задач в очереди
+            self.assertEqual(request.call_count, 2)
+            self.assertEqual(len(scheduled), 2)
+            scheduled.clear()
+            parked = Message.objects.filter(
+                status=MessageStatus.DEFERRED, parked=True
+            )
+            self.assertEqual(parked.count(), 3)
+
+            tasks.release_parked_messages()
+            self.assertEqual(scheduled, [])
+
+            # Пробный запрос: возвращается одно сообщение
+            clock.return_value += 30
+            provider_up = True
+            tasks.release_parked_messages()
+            self.assertEqual(len(scheduled), 1)
+            self.assertEqual(parked.count(), 2)
+            send_scheduled()
+            self.assertEqual(
+                circuit.get_circuit_breaker().get_state()['state'],
+                circuit.CLOSED
+            )
+
+            # После восстановления возвращаются все остальные сообщения
+            tasks.release_parked_messages()
+            self.assertEqual(parked.count(), 0)
+            self.assertEqual(len(send_scheduled()), 2)
+
+        self.assertEqual(request.call_count, 5)
+        self.assertEqual(
+            Message.objects.filter(status=MessageStatus.SENT).count(), 3
+        )
+
+
+# Ошибки отправки не должны размыкать автомат отправки
+@override_settings(SEND_CIRCUIT_MIN_REQUESTS=1000)
+class SendMetricsTests(NotificationsTestCase):
+    """Метрики отправки учитывают ответы, время запросов и отставание."""
+
+    def get_samples(self, backend):
+        samples = (
+            ('notifications_send_responses_total', {'status': '200'}),
+            ('notifications_send_responses_total', {'status': '503'}),
+            ('notifications_send_responses_total', {'status': 'error'}),
+            ('notifications_send_request_seconds_count', {'backend': backend}),
+            ('notifications_send_lag_seconds_count', {}),
+            ('notifications_send_lag_seconds_bucket', {'le': '900.0'}),
+            ('notifications_send_lag_seconds_bucket', {'le': '14400.0'}),
+        )
+        return [
+            REGISTRY.get_sample_value(name, labels) or 0
+            for name, labels in samples
+        ]
+
+    def assertMetrics(self, target, backend, send):
+        # Сообщения отправляются через час после начала рассылки
+        mailing = create_mailing()
+        clients = create_clients(5)
+        responses = [
+            get_response(200), get_response(200), get_response(200),
+            get_response(503), requests.ConnectionError(),
+        ]
+        before = self.get_samples(backend)
+
+        with mock.patch(target, side_effect=responses), mock.patch.object(
+            tasks, 'schedule_message'
+        ):
+            send(mailing, clients)
+
+        after = self.get_samples(backend)
+        self.assertEqual(
+            [value - before[i] for i, value in enumerate(after)],
+            [3, 1, 1, 5, 5, 0, 5]
+        )
+
+    def test_single_send_metrics(self):
+        def send(mailing, clients):
+            for client in clients:
+                tasks.send_message(
+                    mailing.id, client.id, version=mailing.version
+                )
+
+        self.assertMetrics(
+            'notifications.tasks.send_message_request', 'single', send
+        )
+
+    @override_settings(SEND_DELIVERY_BACKEND='sync')
+    def test_batch_send_metrics(self):
+        def send(mailing, clients):
+            tasks.send_message_batch(
+                mailing.id, [client.id for client in clients],
+                version=mailing.version
+            )
+
+        self.assertMetrics(
+            'notifications.delivery.send_message_request', 'sync', send
+        )
+
+
+class AsyncDeliveryTests(NotificationsTestCase):
+    """Асинхронный бэкенд отправки с подмененным транспортом httpx."""
+
+    def create_messages(self, count):
+        mailing = create_mailing()
+        for client in create_clients(count, start=Client.objects.count()):
+            Message.objects.create(mailing=mailing, client=client)
+        RebuildMailingStats(stdout=StringIO()).handle()
+        return mailing, list(
+            mailing.messages.select_related('client').order_by('id')
+        )
+
+    def deliver(self, backend, messages, outcomes, circuit_open=False):
+        """Отправляет сообщения и возвращает пачки результатов.
+
+        outcomes - ответ API по номеру сообщения в списке: код ответа или
+        None для ошибки соединения.
+        """
+        import httpx
+
+        outcome_by_phone = {
+            int(message.client.phone_number): outcome
+            for message, outcome in zip(messages, outcomes)
+        }
+
+        def send_message_request(message_id, phone_number, text, session):
+            outcome = outcome_by_phone[int(phone_number)]
+            if outcome is None:
+                raise requests.ConnectionError('connection refused')
+            return get_response(outcome)
+
+        async def handle(request):
+            outcome = outcome_by_phone[json.loads(request.content)['phone']]
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            if outcome is None:
+                raise httpx.ConnectError('connection refused', request=request)
+            return httpx.Response(outcome)
+
+        async_client = httpx.AsyncClient
+        self.in_flight = self.max_in_flight = 0
+        batches = []
+        with self.settings(SEND_DELIVERY_BACKEND=backend), mock.patch(
+            'httpx.AsyncClient',
+            side_effect=lambda **kwargs: async_client(
+                transport=httpx.MockTransport(handle), **kwargs
+            )
+        ), mock.patch(
+            'notifications.delivery.send_message_request',
+            side_effect=send_message_request
+        ), mock.patch.object(
+            circuit.LocalCircuitBreaker, 'allow',
+            return_value=(False, 30)
+        ) if circuit_open else nullcontext():
+            delivery.deliver_messages(
+                messages, 'Текст рассылки', batches.append
+            )
+        return batches
+
+    @override_settings(SEND_API_CONCURRENCY=3, SEND_RESULTS_BATCH_SIZE=4)
+    def test_concurrency_and_result_batches(self):
+        _, messages = self.create_messages(10)
+
+        batches = self.deliver('async', messages, [200] * 10)
+
+        self.assertEqual(self.max_in_flight, 3)
+        self.assertEqual(
+            sorted(result.message.id for batch in batches for result in batch),
+            [message.id for message in messages]
+        )
+        self.assertTrue(all(len(batch) >= 4 for batch in batches[:-1]))
+        self.assertLess(len(batches), 4)
+
+    def assertSameResults(self, outcomes, circuit_open=False):
+        """Проверяет, что бэкенды одинаково меняют статусы сообщений."""
+        statuses = {}
+        for backend in ('sync', 'async'):
+            mailing, messages = self.create_messages(len(outcomes))
+            batches = self.deliver(backend, messages, outcomes, circuit_open)
+            with mock.patch.object(tasks, 'schedule_message'):
+                for batch in batches:
+                    tasks.save_delivery_results(mailing, batch)
+            statuses[backend] = [
+                (
+                    message.status, message.attempts, message.parked,
+                    bool(message.last_error)
+                )
+                for message in mailing.messages.order_by('id')
+            ]
+        self.assertEqual(statuses['sync'], statuses['async'])
+        return statuses['async']
+
+    def test_responses_map_like_sync_backend(self):
+        self.assertEqual(
+            self.assertSameResults([200, 503, None]),
+            [
+                (MessageStatus.SENT, 1, False, False),
+                (MessageStatus.DEFERRED, 1, False, True),
+                (MessageStatus.DEFERRED, 1, False, True),
+            ]
+        )
+
+    def test_open_circuit_maps_like_sync_backend(self):
+        self.assertEqual(
+            self.assertSameResults([200, None], circuit_open=True),
+            [(MessageStatus.DEFERRED, 0, True, False)] * 2
+        )
+
+
+class LogFilesTests(SimpleTestCase):
+    """Процессы пишут журналы в файлы с переиспользуемыми номерами."""
+
+    def create_handler(self, directory):
+        handler = QueueFileHandler(
+            os.path.join(directory, 'test.%(slot)d.log')
+        )
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.addCleanup(handler.close)
+        return handler
+
+    @skipUnless(logs.fcntl, 'Номера файлов занимаются через fcntl')
+    def test_slots_are_reused(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = self.create_handler(directory)
+            second = self.create_handler(directory)
+            self.assertEqual(
+                [
+                    os.path.basename(handler.target.baseFilename)
+                    for handler in (first, second)
+                ],
+                ['test.0.log', 'test.1.log']
+            )
+
+            first.close()
+            third = self.create_handler(directory)
+            third.handle(logging.makeLogRecord({'msg': 'запись'}))
+            third.close()
+
+            self.assertEqual(
+                third.target.baseFilename, first.target.baseFilename
+            )
+            with open(third.target.baseFilename, encoding='utf-8') as file:
+                self.assertEqual(file.read(), 'запись\n')
+
+
+class ExportMessagesTests(TestCase):
+    """Выгрузка сообщений рассылки не держит их в памяти."""
+
+    @classmethod
+    def setUpTestData(cls):
+        clients = create_clients(10000)
+        cls.small_mailing = create_mailing()
+        cls.large_mailing = create_mailing()
+        Message.objects.bulk_create(
+            (
+                Message(
+                    mailing=mailing,
+                    client=client,
+                    status=MessageStatus.SENT,
+                    send_date=timezone.now()
+                )
+                for mailing, mailing_clients in (
+                    (cls.small_mailing, clients[:1000]),
+                    (cls.large_mailing, clients),
+                )
+                for client in mailing_clients
+            ),
+            batch_size=5000
+        )
+
+    def get_export_peak(self, mailing, export_format):
+        """Выгружает сообщения и возвращает число строк и пик памяти."""
+        tracemalloc.start()
+        try:
+            messages = mailing.messages.all()
+            rows = sum(1 for _ in export_messages(messages, export_format))
+            return rows, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    # Обе выгрузки читают сообщения в несколько пачек
+    @mock.patch('notifications.views.EXPORT_CHUNK_SIZE', 200)
+    def test_memory_does_not_grow_with_messages(self):
+        for export_format, header_rows in (('csv', 1), ('ndjson', 0)):
+            with self.subTest(export_format=export_format):
+                small_rows, small_peak = self.get_export_peak(
+                    self.small_mailing, export_format
+                )
+                large_rows, large_peak = self.get_export_peak(
+                    self.large_mailing, export_format
+                )
+
+                self.assertEqual(small_rows, 1000 + header_rows)
+                self.assertEqual(large_rows, 10000 + header_rows)
+                # В 10 раз больше сообщений, а память почти та же
+                self.assertLess(large_peak, small_peak * 1.2)
+
+
+def get_legacy_send_time(mailing, timezone_name, now):
+    """Расчет прежнего calculate_send_time для момента now.
+
+    Прежняя функция прибавляла к текущему моменту разницу местного
+    времени с началом интервала, взяв дату начала интервала с часов
+    сервера. Здесь дата берется по местному времени клиента: только в
+    этом случае прежний расчет был верным.
+    """
+    client_timezone = pytz.timezone(timezone_name)
+    local_now = now.astimezone(client_timezone)
+    current_time = local_now.time()
+    if mailing.start_time <= current_time <= mailing.end_time:
+        return None
+    client_datetime = local_now.replace(tzinfo=None)
+    start_datetime = datetime.combine(local_now.date(), mailing.start_time)
+    if current_time < mailing.start_time:
+        return now + (start_datetime - client_datetime)
+    return now + timedelta(days=1) - (client_datetime - start_datetime)
+
+
+class SendTimeTests(SimpleTestCase):
+    """Свойства расчета времени отправки по часовым поясам."""
+
+    def get_mailing(self, start_time, end_time):
+        return Mailing(
+            start_date=datetime(2021, 1, 1, tzinfo=pytz.utc),
+            start_time=start_time,
+            end_time=end_time,
+        )
+
+    def get_samples(self, count=2000):
+        """Возвращает случайные рассылки, пояса и моменты 2021 года."""
+        rand = random.Random(6)
+        timezone_names = pytz.common_timezones
+        year_start = datetime(2021, 1, 1, tzinfo=pytz.utc)
+        for _ in range(count):
+            start_minute, end_minute = sorted(rand.sample(range(24 * 60), 2))
+            mailing = self.get_mailing(
+                time(*divmod(start_minute, 60)), time(*divmod(end_minute, 60))
+            )
+            now = year_start + timedelta(
+                seconds=rand.randrange(365 * 24 * 3600)
+            )
+            yield mailing, rand.choice(timezone_names), now
+
+    def test_send_time_opens_window(self):
+        for mailing, timezone_name, now in self.get_samples():
+            with self.subTest(timezone=timezone_name, now=now):
+                client_timezone = pytz.timezone(timezone_name)
+                send_time = get_send_time(mailing, timezone_name, now)
+                local_time = now.astimezone(client_timezone).time()
+                in_window = (
+                    mailing.start_time <= local_time <= mailing.end_time
+                )
+                self.assertEqual(send_time is None, in_window)
+                if send_time is None:
+                    continue
+
+                self.assertGreater(send_time, now)
+                self.assertLessEqual(
+                    send_time - now, timedelta(days=1, hours=1)
+                )
+                local_send_time = send_time.astimezone(client_timezone)
+                if local_send_time.time() != mailing.start_time:
+                    # Начало интервала попало на перевод часов вперед
+                    with self.assertRaises(pytz.NonExistentTimeError):
+                        client_timezone.localize(
+                            datetime.combine(
+                                local_send_time.date(), mailing.start_time
+                            ),
+                            is_dst=None
+                        )
+
+    def test_matches_legacy_send_time_without_clock_change(self):
+        checked = 0
+        for mailing, timezone_name, now in self.get_samples():
+            send_time = get_send_time(mailing, timezone_name, now)
+            if send_time is not None and send_time.utcoffset() != (
+                now.astimezone(send_time.tzinfo).utcoffset()
+            ):
+                continue
+            with self.subTest(timezone=timezone_name, now=now):
+                self.assertEqual(
+                    send_time,
+                    get_legacy_send_time(mailing, timezone_name, now)
+                )
+            checked += 1
+        self.assertGreater(checked, 1900)
+
+    def test_spring_forward_gap(self):
+        mailing = self.get_mailing(time(2, 30), time(5))
+        now = datetime(2021, 3, 14, 6, tzinfo=pytz.utc)
+
+        send_time = get_send_time(mailing, 'America/New_York', now)
+
+        # 02:30 не существует, отправка в 03:30 по летнему времени
+        self.assertEqual(
+            send_time, datetime(2021, 3, 14, 7, 30, tzinfo=pytz.utc)
+        )
+        self.assertEqual(send_time.utcoffset(), timedelta(hours=-4))
+
+    def test_fall_back_overlap(self):
+        mailing = self.get_mailing(time(1, 30), time(1, 45))
+        now = datetime(2021, 11, 7, 4, tzinfo=pytz.utc)
+
+        send_time = get_send_time(mailing, 'America/New_York', now)
+
+        # 01:30 бывает дважды, выбирается одно из этих времен
+        self.assertIn(send_time, [
+            datetime(2021, 11, 7, 5, 30, tzinfo=pytz.utc),
+            datetime(2021, 11, 7, 6, 30, tzinfo=pytz.utc),
+        ])
+        self.assertEqual(
+            send_time.astimezone(pytz.timezone('America/New_York')).time(),
+            time(1, 30)
+        )
+
+    def test_next_day_across_clock_change(self):
+        mailing = self.get_mailing(time(9), time(18))
+        now = datetime(2021, 3, 27, 20, tzinfo=pytz.utc)
+
+        send_time = get_send_time(mailing, 'Europe/Berlin', now)
+
+        # Ночью переводятся часы, до 09:00 по местному времени 11 часов
+        self.assertEqual(send_time, datetime(2021, 3, 28, 7, tzinfo=pytz.utc))
+
+    def test_times_computed_once_per_timezone(self):
+        mailing = self.get_mailing(time(9), time(18))
+        now = datetime(2021, 6, 1, 12, tzinfo=pytz.utc)
+        timezone_names = [
+            'Europe/Moscow', 'Asia/Tokyo', 'America/New_York',
+            'Asia/Tokyo', 'Europe/Moscow'
+        ]
+
+        with mock.patch(
+            'notifications.scheduling.get_send_time', wraps=get_send_time
+        ) as send_time_mock:
+            send_times = get_send_times(mailing, timezone_names, now)
+
+        self.assertEqual(send_time_mock.call_count, 3)
+        self.assertEqual(send_times, {
+            name: get_send_time(mailing, name, now)
+            for name in timezone_names
+        })
+        waves = group_timezones_by_send_time(mailing, timezone_names, now)
+        self.assertEqual(
+            sorted(name for names in waves.values() for name in names),
+            sorted(set(timezone_names))
+        )
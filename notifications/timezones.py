@@ -0,0 +1,30 @@
+from functools import lru_cache
+
+import pytz
+from django.core.exceptions import ValidationError
+
+
+@lru_cache(maxsize=None)
+def get_timezone_names():
+    """Возвращает множество названий часовых поясов.
+
+    Список поясов pytz строится при первом обращении, а не при импорте.
+    """
+    return frozenset(pytz.all_timezones)
+
+
+def is_valid_timezone(name):
+    """Проверяет, что часовой пояс с таким названием существует."""
+    return isinstance(name, str) and name in get_timezone_names()
+
+
+def validate_timezone(value):
+    """Валидатор названия часового пояса."""
+    if not is_valid_timezone(value):
+        raise ValidationError(f'Неизвестный часовой пояс {value}')
+
+
+@lru_cache(maxsize=None)
+def get_timezone(name):
+    """Возвращает объект часового пояса, создавая его один раз."""
+    return pytz.timezone(name)
@@ -1,7 +1,9 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
-from .views import ClientViewSet, MailingViewSet
+from .views import (
+    CircuitBreakerView, ClientViewSet, JobView, MailingViewSet
+)
 
 
 router = DefaultRouter()
@@ -9,5 +11,11 @@ router.register('clients', ClientViewSet, basename='client')
 router.register('mailings', MailingViewSet, basename='mailing')
 
 urlpatterns = [
+    path(
+        'delivery/circuit/',
+        CircuitBreakerView.as_view(),
+        name='circuit-breaker'
+    ),
+    path('jobs/<str:job_id>/', JobView.as_view(), name='job'),
     path('', include(router.urls))
 ]
@@ -1,40 +1,181 @@
+import csv
+import json
 import logging
-from rest_framework import viewsets
-from django.db import models
-from django.db.models import Count
+import os
+from collections.abc import Iterable
+from datetime import datetime
+from celery.result import AsyncResult
+from rest_framework import status as http_status, viewsets
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import (
-    extend_schema, extend_schema_view
+    OpenApiParameter, extend_schema, extend_schema_view
+)
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest,
+    multiprocess
 )
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from notifications.models import Client, Mailing
+from notifications.models import (
+    Client, Mailing, MailingState, Message, MessageStatus
+)
+from .circuit import get_circuit_breaker
+from .imports import import_clients
+from .metrics import VIEW_SECONDS
+from .pagination import IdCursorPagination
+from .parsers import CSVParser, NDJSONParser
+from .services import expire_unsent_messages
+from .state import set_mailing_state
 from .serializers import (
     ClientSerializer,
     MailingSerializer,
-    StatisticSerializer
+    StatisticSerializer,
+    serialize_values
+)
+from .tasks import (
+    apply_at,
+    delete_client,
+    delete_mailing,
+    get_task_priority,
+    send_messages_for_mailing
 )
-from .tasks import send_messages_for_mailing
 
 mailing_logger = logging.getLogger('mailing')
 message_logger = logging.getLogger('message')
 client_logger = logging.getLogger('client')
 
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+EXPORT_FORMATS = ', '.join(EXPORT_CONTENT_TYPES)
+EXPORT_COLUMNS = {
+    'id': 'id',
+    'send_date': 'send_date',
+    'status': 'status',
+    'attempts': 'attempts',
+    'last_error': 'last_error',
+    'next_attempt_at': 'next_attempt_at',
+    'mailing': 'mailing_id',
+    'client': 'client_id',
+}
+
+
+FIELDS_PARAMETER = OpenApiParameter(
+    'fields', str, description='Список возвращаемых полей через запятую'
+)
+
+JOB_RESPONSE = {
+    'type': 'object',
+    'properties': {'job_id': {'type': 'string'}},
+}
+
+
+class BackgroundDestroyMixin:
+    """Примесь удаления объекта фоновой задачей.
+
+    perform_destroy помечает объект удаляемым и возвращает задачу
+    удаления, ответ 202 содержит ее id для проверки в /api/jobs/.
+    """
+
+    def destroy(self, request, *args, **kwargs):
+        job = self.perform_destroy(self.get_object())
+        return Response(
+            {'job_id': job.id}, status=http_status.HTTP_202_ACCEPTED
+        )
+
+
+class FastListMixin:
+    """Примесь быстрого списка объектов.
+
+    Список читается через .values() и сериализуется полями сериализатора
+    без создания экземпляров моделей. Параметр fields ограничивает набор
+    полей, параметры из list_filter_fields фильтруют выборку.
+    """
+
+    list_filter_fields = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action != 'list':
+            return queryset
+        filters = {
+            field: self.request.query_params[field]
+            for field in self.list_filter_fields
+            if field in self.request.query_params
+        }
+        try:
+            return queryset.filter(**filters)
+        except (ValueError, DjangoValidationError) as e:
+            raise ValidationError(str(e))
+
+    def get_list_fields(self, serializer):
+        """Возвращает поля списка с учетом параметра fields."""
+        fields = self.request.query_params.get('fields')
+        if not fields:
+            return list(serializer.fields)
+        fields = [field.strip() for field in fields.split(',')]
+        unknown_fields = set(fields) - set(serializer.fields)
+        if unknown_fields:
+            raise ValidationError({
+                'fields': f'Неизвестные поля: {", ".join(unknown_fields)}'
+            })
+        return fields
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer()
+        fields = self.get_list_fields(serializer)
+        sources = {serializer.fields[field].source for field in fields}
+        queryset = self.filter_queryset(self.get_queryset()).values(
+            'id', *sources
+        )
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return Response(serialize_values(serializer, queryset, fields))
+        return self.get_paginated_response(
+            serialize_values(serializer, page, fields)
+        )
+
 
 @extend_schema(tags=['Клиенты'])
 @extend_schema_view(
-    list=extend_schema(summary='Просмотр списка клиентов'),
+    list=extend_schema(
+        summary='Просмотр списка клиентов',
+        parameters=[
+            OpenApiParameter('tag', str),
+            OpenApiParameter('code_operator', int),
+            OpenApiParameter('timezone', str),
+            FIELDS_PARAMETER,
+        ]
+    ),
     retrieve=extend_schema(summary='Получение данных одного клиента'),
     create=extend_schema(summary='Добавление нового клиента'),
     partial_update=extend_schema(summary='Обновление данных клиента'),
-    destroy=extend_schema(summary='Удаление клиента')
+    destroy=extend_schema(
+        summary='Удаление клиента',
+        responses={202: JOB_RESPONSE}
+    )
 )
-class ClientViewSet(viewsets.ModelViewSet):
+class ClientViewSet(
+    BackgroundDestroyMixin, FastListMixin, viewsets.ModelViewSet
+):
     """API-вью для работы с клиентами."""
 
     http_method_names = ['get', 'post', 'patch', 'delete']
-    queryset = Client.objects.all()
+    queryset = Client.objects.filter(is_deleting=False)
     serializer_class = ClientSerializer
+    list_filter_fields = ('tag', 'code_operator', 'timezone')
 
     def perform_create(self, serializer):
         response = super().perform_create(serializer)
@@ -53,24 +194,90 @@ class ClientViewSet(viewsets.ModelViewSet):
 
     def perform_destroy(self, instance):
         client_id = instance.id
-        client_logger.info(f'Удален клиент {client_id}')
-        return super().perform_destroy(instance)
+        client_logger.info(f'Клиент {client_id} поставлен на удаление')
+        Client.objects.filter(id=client_id).update(is_deleting=True)
+        return delete_client.delay(client_id)
+
+    @extend_schema(
+        summary='Массовый импорт клиентов',
+        description=(
+            'Принимает массив клиентов в JSON, NDJSON или CSV с заголовком. '
+            'Клиенты с уже существующим номером телефона обновляются.'
+        ),
+        request={
+            'application/json': ClientSerializer(many=True),
+            'application/x-ndjson': OpenApiTypes.BINARY,
+            'text/csv': OpenApiTypes.BINARY,
+        },
+        responses={
+            200: {
+                'type': 'object',
+                'properties': {
+                    'created': {'type': 'integer'},
+                    'updated': {'type': 'integer'},
+                    'errors_count': {'type': 'integer'},
+                    'errors': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'row': {'type': 'integer'},
+                                'errors': {'type': 'object'},
+                            }
+                        }
+                    },
+                }
+            }
+        },
+    )
+    @action(
+        detail=False,
+        methods=['POST'],
+        parser_classes=[JSONParser, NDJSONParser, CSVParser]
+    )
+    def bulk(self, request):
+        """Импортирует клиентов пачками с отчетом об ошибках по строкам."""
+        if not isinstance(request.data, Iterable) or isinstance(
+            request.data, (dict, str)
+        ):
+            raise ValidationError('Ожидается список клиентов')
+
+        report = import_clients(request.data)
+        client_logger.info(
+            f'Импорт клиентов: создано {report["created"]}, '
+            f'обновлено {report["updated"]}, '
+            f'строк с ошибками {report["errors_count"]}'
+        )
+        return Response(report)
 
 
 @extend_schema(tags=['Рассылки'])
 @extend_schema_view(
-    list=extend_schema(summary='Просмотр всех рассылок'),
+    list=extend_schema(
+        summary='Просмотр всех рассылок',
+        parameters=[
+            OpenApiParameter('filter_tag', str),
+            OpenApiParameter('filter_code_operator', int),
+            FIELDS_PARAMETER,
+        ]
+    ),
     retrieve=extend_schema(summary='Получение данных одной рассылки'),
     create=extend_schema(summary='Создание новой рассылки',),
     partial_update=extend_schema(summary='Обновление рассылки'),
-    destroy=extend_schema(summary='Удаление рассылки')
+    destroy=extend_schema(
+        summary='Удаление рассылки',
+        responses={202: JOB_RESPONSE}
+    )
 )
-class MailingViewSet(viewsets.ModelViewSet):
+class MailingViewSet(
+    BackgroundDestroyMixin, FastListMixin, viewsets.ModelViewSet
+):
     """API-вью для работы с рассылками."""
 
     http_method_names = ['get', 'post', 'patch', 'delete']
-    queryset = Mailing.objects.all()
+    queryset = Mailing.objects.exclude(state=MailingState.DELETING)
     serializer_class = MailingSerializer
+    list_filter_fields = ('filter_tag', 'filter_code_operator')
 
     def perform_create(self, serializer):
         response = super().perform_create(serializer)
@@ -80,8 +287,12 @@ class MailingViewSet(viewsets.ModelViewSet):
             f'Создана рассылка под номером {mailing_id}',
         )
         mailing = serializer.save()
-        send_messages_for_mailing.apply_async(
-            args=[mailing.id], eta=mailing.start_date
+        set_mailing_state(mailing)
+        apply_at(
+            send_messages_for_mailing, mailing.start_date,
+            args=[mailing.id],
+            kwargs={'version': mailing.version},
+            priority=get_task_priority(mailing)
         )
         return response
 
@@ -89,16 +300,95 @@ class MailingViewSet(viewsets.ModelViewSet):
         instance = serializer.instance
         mailing_id = instance.id
         mailing_logger.info(f'Изменена рассылка {mailing_id}')
-        mailing = serializer.save()
-        send_messages_for_mailing.apply_async(
-            args=[mailing.id], eta=mailing.start_date
+        mailing = serializer.save(version=F('version') + 1)
+        mailing.refresh_from_db(fields=['version'])
+        set_mailing_state(mailing)
+        apply_at(
+            send_messages_for_mailing, mailing.start_date,
+            args=[mailing.id],
+            kwargs={'version': mailing.version},
+            priority=get_task_priority(mailing)
         )
-        return super().perform_update(serializer)
 
     def perform_destroy(self, instance):
         mailing_id = instance.id
-        mailing_logger.info(f'Удалена рыссылка {mailing_id}')
-        return super().perform_destroy(instance)
+        mailing_logger.info(f'Рассылка {mailing_id} поставлена на удаление')
+        self.change_state(
+            instance,
+            [MailingState.ACTIVE, MailingState.PAUSED, MailingState.CANCELLED],
+            MailingState.DELETING
+        )
+        return delete_mailing.delay(mailing_id)
+
+    def change_state(self, mailing, states, new_state):
+        """Переводит рассылку в new_state из одного из состояний states.
+
+        Версия рассылки увеличивается, поэтому задачи, поставленные до
+        смены состояния, ничего не делают. Новое состояние сразу
+        публикуется для воркеров. У отмененной рассылки неотправленные
+        сообщения завершаются, так как отправлены они уже не будут.
+        """
+        changed = Mailing.objects.filter(
+            id=mailing.id, state__in=states
+        ).update(state=new_state, version=F('version') + 1)
+        if not changed:
+            raise ValidationError({
+                'state': f'Действие недоступно для рассылки в состоянии '
+                         f'"{mailing.get_state_display()}"'
+            })
+        mailing.refresh_from_db(fields=['state', 'version'])
+        set_mailing_state(mailing)
+        mailing_logger.info(
+            f'Рассылка {mailing.id} переведена в состояние {new_state}'
+        )
+        if new_state == MailingState.CANCELLED:
+            expired = expire_unsent_messages(mailing.id)
+            mailing_logger.info(
+                f'Отмена рассылки {mailing.id}: завершено {expired} '
+                f'неотправленных сообщений'
+            )
+        return mailing
+
+    @extend_schema(
+        summary='Отменить рассылку',
+        description='Неотправленные сообщения отменяются без возобновления.',
+        request=None
+    )
+    @action(detail=True, methods=['POST'])
+    def cancel(self, request, pk=None):
+        mailing = self.change_state(
+            self.get_object(),
+            [MailingState.ACTIVE, MailingState.PAUSED],
+            MailingState.CANCELLED
+        )
+        return Response(self.get_serializer(mailing).data)
+
+    @extend_schema(summary='Приостановить рассылку', request=None)
+    @action(detail=True, methods=['POST'])
+    def pause(self, request, pk=None):
+        mailing = self.change_state(
+            self.get_object(), [MailingState.ACTIVE], MailingState.PAUSED
+        )
+        return Response(self.get_serializer(mailing).data)
+
+    @extend_schema(
+        summary='Возобновить рассылку',
+        description='Сообщения, не отправленные до паузы, отправляются '
+                    'заново.',
+        request=None
+    )
+    @action(detail=True, methods=['POST'])
+    def resume(self, request, pk=None):
+        mailing = self.change_state(
+            self.get_object(), [MailingState.PAUSED], MailingState.ACTIVE
+        )
+        apply_at(
+            send_messages_for_mailing, mailing.start_date,
+            args=[mailing.id],
+            kwargs={'version': mailing.version},
+            priority=get_task_priority(mailing)
+        )
+        return Response(self.get_serializer(mailing).data)
 
     @extend_schema(
         tags=['Статистика'],
@@ -113,24 +403,31 @@ class MailingViewSet(viewsets.ModelViewSet):
                         'total_messages': {'type': 'integer'},
                         'successful_messages': {'type': 'integer'},
                         'failed_messages': {'type': 'integer'},
+                        'pending_messages': {'type': 'integer'},
+                        'last_sent_at': {
+                            'type': 'string', 'format': 'date-time'
+                        },
                     }
                 }
             }
         },
     )
     @action(detail=False, methods=['GET'])
+    @VIEW_SECONDS.labels('statistics').time()
     def statistics(self, request):
-        """Возвращает статистику по всем рассылкам."""
-        statistics = Mailing.objects.annotate(
-            total_messages=Count('messages'),
-            successful_messages=Count(
-                'messages', filter=models.Q(messages__status=200)
-            ),
-            failed_messages=Count(
-                'messages', filter=~models.Q(messages__status=200)
-            )
-        ).values(
-            'id', 'total_messages', 'successful_messages', 'failed_messages'
+        """Возвращает статистику по всем рассылкам.
+
+        Счетчики читаются из MailingStats, которые обновляются по мере
+        отправки сообщений.
+        """
+        statistics = Mailing.objects.exclude(
+            state=MailingState.DELETING
+        ).values('id').annotate(
+            total_messages=Coalesce('stats__total', 0),
+            successful_messages=Coalesce('stats__successful', 0),
+            failed_messages=Coalesce('stats__failed', 0),
+            pending_messages=Coalesce('stats__pending', 0),
+            last_sent_at=F('stats__last_sent_at'),
         )
 
         return Response(statistics)
@@ -138,16 +435,188 @@ class MailingViewSet(viewsets.ModelViewSet):
     @extend_schema(
         tags=['Статистика'],
         summary='Получить статистику по одной рассылке',
+        parameters=[
+            OpenApiParameter(
+                'status', str, enum=MessageStatus.values,
+                description='Статус сообщения'
+            ),
+            OpenApiParameter(
+                'send_date_after', OpenApiTypes.DATETIME,
+                description='Отправлено не раньше'
+            ),
+            OpenApiParameter(
+                'send_date_before', OpenApiTypes.DATETIME,
+                description='Отправлено не позже'
+            ),
+            OpenApiParameter(
+                'export', str, enum=list(EXPORT_CONTENT_TYPES),
+                description='Выгрузить все сообщения потоком в формате'
+            ),
+        ],
         responses={
             200: StatisticSerializer(many=True)
         },
     )
     @action(detail=True, methods=['GET'])
+    @VIEW_SECONDS.labels('detail_statistics').time()
     def detail_statistics(self, request, pk=None):
-        """Возвращает статистику по конкретной рассылке."""
+        """Возвращает статистику по конкретной рассылке.
+
+        Сообщения отдаются постранично с курсором по id либо, при
+        указании export, выгружаются потоком без загрузки в память.
+        """
         mailing = self.get_object()
-        messages = mailing.messages.all()
-        serializer = StatisticSerializer(
-            messages, many=True
+        messages = filter_messages(
+            mailing.messages.all(), request.query_params
         )
-        return Response(serializer.data)
+
+        export_format = request.query_params.get('export')
+        if export_format is not None:
+            if export_format not in EXPORT_CONTENT_TYPES:
+                raise ValidationError({
+                    'export': f'Доступные форматы: {EXPORT_FORMATS}'
+                })
+            response = StreamingHttpResponse(
+                export_messages(messages, export_format),
+                content_type=EXPORT_CONTENT_TYPES[export_format]
+            )
+            response['Content-Disposition'] = (
+                f'attachment; filename="mailing_{mailing.id}.{export_format}"'
+            )
+            return response
+
+        paginator = IdCursorPagination()
+        page = paginator.paginate_queryset(messages, request, view=self)
+        serializer = StatisticSerializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+class CircuitBreakerView(APIView):
+    """API-вью состояния автомата отправки."""
+
+    @extend_schema(
+        tags=['Отправка'],
+        summary='Состояние автомата отправки',
+        description=(
+            'Автомат размыкается при недоступности API отправки. Пока он '
+            'разомкнут, сообщения откладываются и не отправляются.'
+        ),
+        responses={
+            200: {
+                'type': 'object',
+                'properties': {
+                    'state': {
+                        'type': 'string',
+                        'enum': ['closed', 'open', 'half_open']
+                    },
+                    'retry_after': {'type': 'number'},
+                    'requests': {'type': 'integer'},
+                    'failures': {'type': 'integer'},
+                    'parked_messages': {'type': 'integer'},
+                }
+            }
+        }
+    )
+    def get(self, request):
+        state = get_circuit_breaker().get_state()
+        state['parked_messages'] = Message.objects.filter(parked=True).count()
+        return Response(state)
+
+
+class JobView(APIView):
+    """API-вью состояния фоновой задачи."""
+
+    @extend_schema(
+        tags=['Задачи'],
+        summary='Состояние фоновой задачи',
+        responses={
+            200: {
+                'type': 'object',
+                'properties': {
+                    'job_id': {'type': 'string'},
+                    'status': {'type': 'string'},
+                    'result': {},
+                }
+            }
+        }
+    )
+    def get(self, request, job_id):
+        job = AsyncResult(job_id)
+        result = None
+        if job.successful():
+            result = job.result
+        elif job.failed():
+            result = str(job.result)
+        return Response(
+            {'job_id': job_id, 'status': job.status, 'result': result}
+        )
+
+
+def metrics(request):
+    """Отдает метрики сервиса в формате Prometheus.
+
+    Если задан PROMETHEUS_MULTIPROC_DIR, метрики собираются со всех
+    процессов: веб-сервера и воркеров Celery.
+    """
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return HttpResponse(
+        generate_latest(registry), content_type=CONTENT_TYPE_LATEST
+    )
+
+
+def filter_messages(messages, query_params):
+    """Фильтрует сообщения по статусу и периоду отправки."""
+    status = query_params.get('status')
+    if status is not None:
+        if status not in MessageStatus.values:
+            raise ValidationError({'status': 'Неизвестный статус сообщения'})
+        messages = messages.filter(status=status)
+
+    for param, lookup in (
+        ('send_date_after', 'send_date__gte'),
+        ('send_date_before', 'send_date__lte'),
+    ):
+        value = query_params.get(param)
+        if value is None:
+            continue
+        send_date = parse_datetime(value)
+        if send_date is None:
+            raise ValidationError({param: 'Некорректный формат даты'})
+        messages = messages.filter(**{lookup: send_date})
+    return messages
+
+
+class Echo:
+    """Псевдобуфер, возвращающий записанную строку вместо ее хранения."""
+
+    def write(self, value):
+        return value
+
+
+def export_messages(messages, export_format):
+    """Построчно выгружает сообщения в формате ndjson или csv.
+
+    Строки читаются из базы серверным курсором пачками по
+    EXPORT_CHUNK_SIZE, поэтому память не зависит от числа сообщений.
+    """
+    rows = messages.order_by('id').values_list(
+        *EXPORT_COLUMNS.values()
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+    if export_format == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(EXPORT_COLUMNS)
+        for row in rows:
+            yield writer.writerow(
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in row
+            )
+        return
+
+    for row in rows:
+        yield json.dumps(
+            dict(zip(EXPORT_COLUMNS, row)), cls=DjangoJSONEncoder
+        ) + '\n'
@@ -1,13 +1,25 @@
 #!/bin/sh
+echo "Removing duplicate messages..."
+python manage.py deduplicate_messages;
+
 echo "Running migrations..."
 python manage.py makemigrations;
 python manage.py migrate;
 
+echo "Converting legacy message statuses..."
+python manage.py convert_message_statuses;
+
 echo "Collecting static files..."
 python manage.py collectstatic --noinput;
 
-echo "Starting Celery worker..."
-celery -A notification_service worker -l info -P threads &
+echo "Preparing metrics directory..."
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+echo "Starting Celery workers..."
+celery -A notification_service worker -l info -P threads -Q dispatch,reporting -n dispatch@%h &
+celery -A notification_service worker -l info -P threads -Q delivery -n delivery@%h &
 
 echo "Starting Celery beat..."
 celery -A notification_service beat --loglevel=info &